@@ -6,25 +6,12 @@
 #    import auxil
 
 import numpy as np  
-import math, ctypes  
-from numpy.ctypeslib import ndpointer
+import math  
+from functools import lru_cache
 from scipy.special import betainc  
 from numpy.fft import fft2, ifft2, fftshift 
 import scipy.ndimage.interpolation as ndii 
 
-# wrap the provisional means dll
-lib = ctypes.cdll.LoadLibrary('libprov_means.so')    
-provmeans = lib.provmeans 
-provmeans.restype = None   
-c_double_p = ctypes.POINTER(ctypes.c_double) 
-provmeans.argtypes = [ndpointer(np.float64), 
-                      ndpointer(np.float64),
-                      ctypes.c_int,
-                      ctypes.c_int,
-                      c_double_p,
-                      ndpointer(np.float64),
-                      ndpointer(np.float64)]  
-
 # color table
 ctable = [ 0,0,0,       255,0,0,    0,255,0,     0,0,255, \
            255,255,0,   0,255,255,  255,0,255,   176,48,96, \
@@ -97,29 +84,57 @@ def gaussfilter(sigma,n,m):
 # -----------------
 
 class Cpm(object):
-    '''Provisional means algorithm'''
+    '''Provisional means algorithm. Each batch of observations is reduced
+       to its weighted means and centered cross products (one matrix
+       product) and merged into the running sums with the pairwise formulas
+       of Chan, Golub and LeVeque. Accumulators filled in parallel, e.g.
+       one per thread, are combined with merge()'''
     def __init__(self,N):
         self.mn = np.zeros(N)
         self.cov = np.zeros((N,N))
-        self.sw = 0.0000001
-         
+        self.sw = 0.0
+
     def update(self,Xs,Ws=None):
-        n,N = np.shape(Xs)       
+        Xs = np.asarray(Xs,dtype=np.float64)
+        n,N = np.shape(Xs)
         if Ws is None:
             Ws = np.ones(n)
-        sw = ctypes.c_double(self.sw)        
-        mn = self.mn
-        cov = self.cov
-        provmeans(Xs,Ws,N,n,ctypes.byref(sw),mn,cov)
-        self.sw = sw.value
-        self.mn = mn
-        self.cov = cov
-          
+        else:
+            Ws = np.asarray(Ws,dtype=np.float64)
+        sw = np.sum(Ws)
+        if sw == 0:
+            return
+        mn = Ws.dot(Xs)/sw
+        d = Xs - mn
+        self._merge(sw,mn,(d*Ws[:,np.newaxis]).T.dot(d))
+
+    def _merge(self,sw,mn,cov):
+        if sw == 0:
+            return
+        if self.sw == 0:
+            self.sw, self.mn, self.cov = sw, np.array(mn), np.array(cov)
+            return
+        total = self.sw + sw
+        delta = mn - self.mn
+        self.mn = self.mn + delta*(sw/total)
+        self.cov = self.cov + cov + np.outer(delta,delta)*(self.sw*sw/total)
+        self.sw = total
+
+    def merge(self,other):
+        '''add the statistics accumulated by another Cpm or given
+           as a tuple returned by moments()'''
+        if isinstance(other,Cpm):
+            other = other.moments()
+        self._merge(*other)
+        return self
+
+    def moments(self):
+        '''sum of weights, means and centered cross products'''
+        return self.sw, self.mn, self.cov
+
     def covariance(self):
-        c = np.mat(self.cov/(self.sw-1.0))
-        d = np.diag(np.diag(c))
-        return c + c.T - d
-    
+        return np.mat(self.cov/(self.sw-1.0))
+
     def means(self):
         return self.mn                     
 
@@ -180,67 +195,163 @@ def geneiv(A,B):
     lambdas,V = np.linalg.eig(C)
     return lambdas, Li.transpose()*V     
 
-def similarity(bn0, bn1):
+# number of high-pass filters and log-polar grids kept in the LRU caches
+GRIDCACHE = 16
+
+@lru_cache(maxsize=GRIDCACHE)
+def _highpass(shape):
+    x = np.outer(
+                np.cos(np.linspace(-math.pi/2., math.pi/2., shape[0])),
+                np.cos(np.linspace(-math.pi/2., math.pi/2., shape[1])))
+    hp = (1.0 - x) * (2.0 - x)
+    hp.flags.writeable = False
+    return hp
+
+def highpass(shape):
+    """Return highpass filter to be multiplied with fourier transform
+(cached, read-only)."""
+    return _highpass(tuple(int(n) for n in shape))
+
+@lru_cache(maxsize=GRIDCACHE)
+def _logpolar_grid(shape, angles, radii):
+    center = shape[0] / 2, shape[1] / 2
+    theta = np.empty((angles, radii), dtype=np.float64)
+    theta.T[:] = -np.linspace(0, np.pi, angles, endpoint=False)
+#  d = radii
+    d = np.hypot(shape[0]-center[0], shape[1]-center[1])
+    log_base = 10.0 ** (math.log10(d) / (radii))
+    radius = np.empty_like(theta)
+    radius[:] = np.power(log_base, np.arange(radii,
+                                               dtype=np.float64)) - 1.0
+    coords = np.array([radius * np.sin(theta) + center[0],
+                       radius * np.cos(theta) + center[1]])
+    coords.flags.writeable = False
+    return coords, log_base
+
+def logpolar_grid(shape, angles=None, radii=None):
+    """Return the coordinates at which logpolar() samples an image
+of the given shape and the log base (cached, read-only)."""
+    if angles is None:
+        angles = shape[0]
+        if radii is None:
+            radii = shape[1]
+    return _logpolar_grid(tuple(int(n) for n in shape), int(angles), int(radii))
+
+def logpolar(image, angles=None, radii=None, prefilter=True):
+    """Return log-polar transformed image and log base.
+prefilter=False: image already holds the cubic spline coefficients
+(ndii.spline_filter) of the image to be transformed."""
+    coords, log_base = logpolar_grid(image.shape, angles, radii)
+    output = np.empty(coords.shape[1:])
+    ndii.map_coordinates(image, coords, output=output, prefilter=prefilter)
+    return output, log_base
+
+def _fft2(bn, shape):
+#  fft2 of mean-free band zero-padded to shape
+    return fft2(bn - np.mean(bn), s=shape)
+
+def _fastshape(shape):
+#  shape padded to fast FFT lengths
+    from scipy.fft import next_fast_len
+    return tuple(next_fast_len(int(n)) for n in shape)
+
+def _downsample(bn):
+#  2x2 block means
+    b = bn[:bn.shape[0]//2*2, :bn.shape[1]//2*2]
+    return 0.25*(b[0::2, 0::2] + b[1::2, 0::2] + b[0::2, 1::2] + b[1::2, 1::2])
+
+def _phasecorr(f0, f1):
+#  phase correlation surface of two spectra
+    r = np.maximum(abs(f0) * abs(f1), np.finfo(float).tiny)
+    return abs(ifft2((f0 * f1.conjugate()) / r))
+
+def _peak(ir):
+#  position of the maximum of the phase correlation ir, refined to sub-pixel
+#  accuracy from the larger (periodic) neighbour along each axis, 
+#  Foroosh et al. (2002) IEEE Transactions on Image Processing 11(3) 
+    i = np.unravel_index(np.argmax(ir), ir.shape)
+    peak = []
+    for axis in range(2):
+        lo, hi = list(i), list(i)
+        lo[axis] = (i[axis] - 1) % ir.shape[axis]
+        hi[axis] = (i[axis] + 1) % ir.shape[axis]
+        l, c, r = ir[tuple(lo)], ir[i], ir[tuple(hi)]
+        if r >= l:
+            peak.append(i[axis] + r/(r + c))
+        else:
+            peak.append(i[axis] - l/(l + c))
+    return peak
+
+def _window(shape, maxsize):
+#  central window (row, col, rows, cols) of at most maxsize x maxsize
+    rows, cols = min(shape[0], maxsize), min(shape[1], maxsize)
+    return ((shape[0] - rows)//2, (shape[1] - cols)//2, rows, cols)
+
+def _crop(bn, r0, c0, rows, cols):
+#  window of bn, zero-filled outside
+    out = np.zeros((rows, cols))
+    ra, ca = max(r0, 0), max(c0, 0)
+    rb, cb = min(r0 + rows, bn.shape[0]), min(c0 + cols, bn.shape[1])
+    if (rb > ra) and (cb > ca):
+        out[ra-r0:rb-r0, ca-c0:cb-c0] = bn[ra:rb, ca:cb]
+    return out
+
+def similarity_reference(bn0, maxsize=1024):
+    """Return the spectra of the reference band bn0 used by 
+similarity(bn0, bn1, ref): the FFT of the log-polar transformed, 
+highpass filtered amplitude spectrum of the coarsest level of an
+image pyramid of bn0 (halved until at most maxsize x maxsize), its
+log base and the FFTs of the central maxsize x maxsize windows of all
+levels. Computing them once saves their cost when registering many 
+bands to the same reference."""
+    pyramid = [np.asarray(bn0, dtype=np.float64)]
+    while max(pyramid[-1].shape) > maxsize:
+        pyramid.append(_downsample(pyramid[-1]))
+    shape = _fastshape(pyramid[-1].shape)
+    f0 = fftshift(abs(_fft2(pyramid[-1], shape)))
+    f0 *= highpass(shape)
+    f0, log_base = logpolar(f0)
+    windows = [_window(bn.shape, maxsize) for bn in pyramid]
+    spectra = [_fft2(bn[r0:r0+rows, c0:c0+cols], _fastshape((rows, cols)))
+               for bn, (r0, c0, rows, cols) in zip(pyramid, windows)]
+    return {'f0': fft2(f0), 'log_base': log_base, 'windows': windows, 
+            'spectra': spectra}
+
+def similarity(bn0, bn1, ref=None, maxsize=1024):
     """Register bn1 to bn0 ,  M. Canty 2012
-bn0, bn1 and returned result are image bands      
+bn0, bn1 and returned result are image bands, 
+ref (optional) = similarity_reference(bn0, maxsize)
+Scale and angle are determined at the coarsest level of an image
+pyramid (at most maxsize x maxsize), the shift coarse to fine on 
+windows of at most that size. All peaks are located to sub-pixel 
+accuracy and the FFTs are padded to fast lengths.
 Modified from Imreg.py, see http://www.lfd.uci.edu/~gohlke/:
  Copyright (c) 2011-2012, Christoph Gohlke
  Copyright (c) 2011-2012, The Regents of the University of California
  Produced at the Laboratory for Fluorescence Dynamics
  All rights reserved.    
     """
- 
-    def highpass(shape):
-        """Return highpass filter to be multiplied with fourier transform."""
-        x = np.outer(
-                        np.cos(np.linspace(-math.pi/2., math.pi/2., shape[0])),
-                        np.cos(np.linspace(-math.pi/2., math.pi/2., shape[1])))
-        return (1.0 - x) * (2.0 - x)    
-
-    def logpolar(image, angles=None, radii=None):
-        """Return log-polar transformed image and log base."""
-        shape = image.shape
-        center = shape[0] / 2, shape[1] / 2
-        if angles is None:
-            angles = shape[0]
-            if radii is None:
-                radii = shape[1]
-        theta = np.empty((angles, radii), dtype=np.float64)
-        theta.T[:] = -np.linspace(0, np.pi, angles, endpoint=False)
-#      d = radii
-        d = np.hypot(shape[0]-center[0], shape[1]-center[1])
-        log_base = 10.0 ** (math.log10(d) / (radii))
-        radius = np.empty_like(theta)
-        radius[:] = np.power(log_base, np.arange(radii,
-                                                   dtype=np.float64)) - 1.0
-        x = radius * np.sin(theta) + center[0]
-        y = radius * np.cos(theta) + center[1]
-        output = np.empty_like(x)
-        ndii.map_coordinates(image, [x, y], output=output)
-        return output, log_base
-             
+    if ref is None:
+        ref = similarity_reference(bn0, maxsize)
+    f0, log_base = ref['f0'], ref['log_base']
     lines0,samples0 = bn0.shape
 #  make reference and warp bands same shape    
-    bn1 = bn1[0:lines0,0:samples0]   
+    bn1 = np.asarray(bn1[0:lines0,0:samples0], dtype=np.float64)
+    pyramid = [bn1]
+    for _ in ref['windows'][1:]:
+        pyramid.append(_downsample(pyramid[-1]))
 #  get scale, angle      
-    f0 = fftshift(abs(fft2(bn0)))
-    f1 = fftshift(abs(fft2(bn1)))
-    h = highpass(f0.shape)
-    f0 *= h
-    f1 *= h
-    del h
-    f0, log_base = logpolar(f0)
-    f1, log_base = logpolar(f1)
-    f0 = fft2(f0)
+    f1 = fftshift(abs(_fft2(pyramid[-1], f0.shape)))
+    f1 *= highpass(f0.shape)
+    f1, _ = logpolar(f1)
     f1 = fft2(f1)
-    r0 = abs(f0) * abs(f1)
-    ir = abs(ifft2((f0 * f1.conjugate()) / r0))
-    i0, i1 = np.unravel_index(np.argmax(ir), ir.shape)
+    ir = _phasecorr(f0, f1)
+    i0, i1 = _peak(ir)
     angle = 180.0 * i0 / ir.shape[0]
     scale = log_base ** i1 
     if scale > 1.8:
-        ir = abs(ifft2((f1 * f0.conjugate()) / r0))
-        i0, i1 = np.unravel_index(np.argmax(ir), ir.shape)
+        ir = _phasecorr(f1, f0)
+        i0, i1 = _peak(ir)
         angle = -180.0 * i0 / ir.shape[0]
         scale = 1.0 / (log_base ** i1)
         if scale > 1.8:
@@ -249,25 +360,62 @@ Modified from Imreg.py, see http://www.lfd.uci.edu/~gohlke/:
         angle += 180.0
     elif angle > 90.0:
         angle -= 180.0           
-#  re-scale and rotate and then get shift                   
-    bn2 = ndii.zoom(bn1, 1.0/scale)
-    bn2 = ndii.rotate(bn2, angle)
-    if bn2.shape < bn0.shape:
-        t = np.zeros_like(bn0)
-        t[:bn2.shape[0], :bn2.shape[1]] = bn2
-        bn2 = t
-    elif bn2.shape > bn0.shape:
-        bn2 = bn2[:bn0.shape[0], :bn0.shape[1]] 
-    f0 = fft2(bn0)
-    f1 = fft2(bn2)
-    ir = abs(ifft2((f0 * f1.conjugate()) / (abs(f0) * abs(f1))))
-    t0, t1 = np.unravel_index(np.argmax(ir), ir.shape)
-    if t0 > f0.shape[0] // 2:
-        t0 -= f0.shape[0]
-    if t1 > f0.shape[1] // 2:
-        t1 -= f0.shape[1]                                               
-#  return result   
-    return (scale,angle,[t0,t1])                 
+#  re-scale and rotate (one resampling) and then get shift coarse to fine
+    matrix, offset = similarity_affine(bn1.shape, scale, angle, [0, 0])
+    bn2 = ndii.affine_transform(bn1, matrix, offset, output_shape=bn0.shape, order=3)
+    pyramid = [bn2]
+    for _ in ref['windows'][1:]:
+        pyramid.append(_downsample(pyramid[-1]))
+    t = np.zeros(2)
+    for bn, (r0, c0, rows, cols), F0 in list(zip(pyramid, ref['windows'], ref['spectra']))[::-1]:
+        ti = np.round(t).astype(int)
+        F1 = _fft2(_crop(bn, r0 - ti[0], c0 - ti[1], rows, cols), F0.shape)
+        d = np.array(_peak(_phasecorr(F0, F1)))
+        d = np.where(d > np.array(F0.shape) // 2, d - F0.shape, d)
+        t = 2*(ti + d)
+    t /= 2
+#  return result
+    return (scale,angle,[float(t[0]),float(t[1])])
+
+def similarity_affine(shape, scale, angle, shift, origin=(0,0)):
+    """Return (matrix, offset) of the affine map x_in = matrix.x_out + offset
+equivalent to warping a band of the given shape with
+ndii.zoom(., 1/scale), ndii.rotate(., angle) and ndii.shift(., shift),
+where x_out is relative to origin = (row, col) in the warped band."""
+    from scipy.special import cosdg, sindg
+    shape = np.asarray(shape)
+#  zoom: x_in = zf*x_zoomed
+    zshape = np.array([int(round(n / scale)) for n in shape])
+    zf = np.ones(2)
+    np.divide(shape - 1, zshape - 1, out=zf, where=zshape > 1)
+#  rotate (with reshape): x_zoomed = rot.x_rotated + roffset
+    c, s = cosdg(angle), sindg(angle)
+    rot = np.array([[c, s], [-s, c]])
+    bounds = rot @ [[0, 0, zshape[0], zshape[0]], [0, zshape[1], 0, zshape[1]]]
+    rshape = (np.ptp(bounds, axis=1) + 0.5).astype(int)
+    roffset = (zshape - 1) / 2.0 - rot @ ((rshape - 1) / 2.0)
+#  shift: x_rotated = x_shifted - shift
+    matrix = zf[:, np.newaxis] * rot
+    offset = zf * (rot @ (np.asarray(origin) - np.asarray(shift)) + roffset)
+    return matrix, offset
+
+def similarity_warp(band, scale, angle, shift, window, margin=16):
+    """Return the window = (x, y, cols, rows) of band warped with
+the parameters returned by similarity(), resampling the band only once.
+band is a GDAL raster band, of which just the part under the window
+(plus margin pixels for the spline prefilter) is read."""
+    x, y, cols, rows = window
+    matrix, offset = similarity_affine((band.YSize, band.XSize), scale, angle, shift, (y, x))
+#  bounding box of the window in the band
+    corners = matrix @ [[0, 0, rows - 1, rows - 1], [0, cols - 1, 0, cols - 1]] + offset[:, np.newaxis]
+    y0, x0 = np.maximum(np.floor(corners.min(axis=1)).astype(int) - margin, 0)
+    y1, x1 = np.minimum(np.ceil(corners.max(axis=1)).astype(int) + margin + 1,
+                        [band.YSize, band.XSize])
+    if (y1 <= y0) or (x1 <= x0):
+        return np.zeros((rows, cols), dtype=np.float32)
+    bn = np.nan_to_num(band.ReadAsArray(int(x0), int(y0), int(x1 - x0), int(y1 - y0)).astype(np.float32))
+    return ndii.affine_transform(bn, matrix, offset - [y0, x0], output_shape=(rows, cols),
+                                 output=np.float32, order=3)
 
 # ---------------------------
 # discrete wavelet transform
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     chi2mix.py
+#  Purpose:  survival function of the two-term chi-square mixture
+#
+#              P(Z > z) = (1-omega2)*P(chi2(f) > z) + omega2*P(chi2(f+4) > z)
+#
+#            which approximates the distribution of -2*rho*lnR for the
+#            Wishart change detection statistics. Only one regularized upper
+#            incomplete gamma function Q(a,y) = P(chi2(2a) > 2y) is evaluated,
+#            the second term follows from the recurrence
+#
+#              Q(a+2,y) = Q(a,y) + y^a*exp(-y)/Gamma(a+1)*(1 + y/(a+1))
+#
+#            The survival function is computed directly rather than as
+#            1 - cdf, so small p-values keep their relative accuracy.
+#  Usage:
+#    from auxil import chi2mix
+#    pv = chi2mix.sf(Z,f,omega2)
+#    z = chi2mix.isf(significance,f,omega2)
+#
+# MIT License
+#
+# Copyright (c) 2018 Mort Canty
+
+import numpy as np
+from scipy import special
+
+def sf(Z,f,omega2,out=None):
+    '''return (1-omega2)*P(chi2(f) > Z) + omega2*P(chi2(f+4) > Z) for
+       a float32 or float64 array Z, negative Z are treated as 0. The
+       evaluation is in float64, the result has the type of Z (at least 
+       float32) or of out'''
+    Z = np.asarray(Z)
+    a = f/2.0
+    y = np.array(Z,dtype=np.float64)
+    np.maximum(y,0.0,out=y)
+    y *= 0.5
+    result = np.empty_like(y)
+    special.gammaincc(a,y,out=result)
+    t = np.empty_like(y)
+#  omega2*y^a*exp(-y)/Gamma(a+1)*(1 + y/(a+1))
+    with np.errstate(divide='ignore'):
+        np.log(y,out=t)
+    t *= a
+    t -= y
+    t -= special.gammaln(a+1)
+    np.exp(t,out=t)
+    y /= a+1
+    y += 1
+    t *= y
+    t *= omega2
+    result += t
+    if out is None:
+        return result.astype(np.result_type(Z.dtype,np.float32),copy=False)
+    out[...] = result
+    return out
+
+def isf(p,f,omega2):
+    '''return the critical value z with sf(z,f,omega2) = p, 0 < p < 1'''
+    from scipy import optimize
+    hi = f+4.0
+    while sf(hi,f,omega2) > p:
+        hi *= 2
+    return optimize.brentq(lambda z: sf(z,f,omega2)-p,0.0,hi,xtol=1e-12,rtol=4*np.finfo(float).eps)
@@ -9,6 +9,7 @@ usage: from auxil.eeWishart import omnibus
 '''
 
 import ee
+from auxil.hermitian import DET_EXPR
 
 def chi2cdf(chi2,df):
     ''' Chi square cumulative distribution function '''
@@ -16,15 +17,12 @@ def chi2cdf(chi2,df):
 
 def det(image):
     '''return determinant of 1, 2, 3, 4, or 9-band polarimetric image ''' 
-    detmap = {'k':image.select(0),'ar':image.select(1),'ai':image.select(2),'pr':image.select(3),'pi':image.select(4),
-              's':image.select(5),'br':image.select(6),'bi':image.select(7),'z':image.select(8)}
-    expr = 'k*s*z+2*(ar*br*pr-ai*bi*pr+ai*br*pi+ar*bi*pi)-s*(pr*pr+pi*pi)-k*(br*br+bi*bi)-s*(ar*ar+ai*ai)'
     bands = image.bandNames().length()
     result = ee.Image(ee.Algorithms.If(bands.eq(1),image,None))
-    result = ee.Image(ee.Algorithms.If(bands.eq(2),image.expression('b(0)*b(1)'),result))
-    result = ee.Image(ee.Algorithms.If(bands.eq(3),image.expression('b(0)*b(1)*b(2)'),result))
-    result = ee.Image(ee.Algorithms.If(bands.eq(4),image.expression('b(0)*b(3)-b(1)*b(1)-b(2)*b(2)'),result))
-    return ee.Image(ee.Algorithms.If(bands.eq(9),image.expression(expr,detmap),result))
+    result = ee.Image(ee.Algorithms.If(bands.eq(2),image.expression(DET_EXPR[2]),result))
+    result = ee.Image(ee.Algorithms.If(bands.eq(3),image.expression(DET_EXPR[3]),result))
+    result = ee.Image(ee.Algorithms.If(bands.eq(4),image.expression(DET_EXPR[4]),result))
+    return ee.Image(ee.Algorithms.If(bands.eq(9),image.expression(DET_EXPR[9]),result))
 
 def log_det_sum(imList,j):
     '''return the log of the the determinant of the sum of the first j images in imList'''
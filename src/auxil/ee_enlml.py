@@ -14,6 +14,7 @@
 
 import ee
 import auxil.lookup as lookup
+from auxil.hermitian import DET_EXPR
 import numpy as np
 
 def enl_iter(current,prev):
@@ -29,13 +30,10 @@ def enl_iter(current,prev):
        
 def enl(image,scale=10):
 #  construct the determinant image     
-    detmap = {'k':image.select(0),'ar':image.select(1),'ai':image.select(2),'pr':image.select(3),'pi':image.select(4),
-              's':image.select(5),'br':image.select(6),'bi':image.select(7),'z':image.select(8)}
-    expr = 'k*s*z+2*(ar*br*pr-ai*bi*pr+ai*br*pi+ar*bi*pi)-s*(pr*pr+pi*pi)-k*(br*br+bi*bi)-s*(ar*ar+ai*ai)'
     bands = image.bandNames().length()
     result = ee.Image(ee.Algorithms.If(bands.lte(3),image.select(0),None))
-    result = ee.Image(ee.Algorithms.If(bands.eq(4),image.expression('b(0)*b(3)-b(1)*b(1)-b(2)*b(2)'),result))
-    detimg = ee.Image(ee.Algorithms.If(bands.eq(9),image.expression(expr,detmap),result))    
+    result = ee.Image(ee.Algorithms.If(bands.eq(4),image.expression(DET_EXPR[4]),result))
+    detimg = ee.Image(ee.Algorithms.If(bands.eq(9),image.expression(DET_EXPR[9]),result))    
 #  7x7 window average of log of determinant image        
     avlogdetimg = detimg.log().reduceNeighborhood(ee.Reducer.mean(),ee.Kernel.square(3.5)) 
 #  log of 7x7 wíndow average of the determinant image    
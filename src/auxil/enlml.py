@@ -6,6 +6,8 @@
 #    using ML method with full covariance matrix (quad, dual or single)
 #    If image diagonal-only, just use first band (C11)
 #    Anfinsen et al. (2009) IEEE TGARS 47(11), 3795-3809
+#    7x7 window statistics as box filters over blocks of rows,
+#    processed in parallel
 #    
 #  Usage:
 #    from auxil.enlml import enl
@@ -15,29 +17,74 @@
 # Copyright (c) 2018 Mort Canty
 
 import auxil.lookup as lookup
+import auxil.hermitian as hermitian
 import os, sys, getopt, time
 import numpy as np
 import matplotlib.pyplot as plt
 from osgeo import gdal
 from osgeo.gdalconst import GA_ReadOnly, GDT_Float32
    
-six = np.array([0,1,2,3,4,5,6])   
-   
-def get_windex(j,cols):
-#  first window for row j    
-    windex = np.zeros(49,dtype=int)   
-    windex[0:7]   = (j-3)*cols + six
-    windex[7:14]  = (j-2)*cols + six
-    windex[14:21] = (j-1)*cols + six
-    windex[21:28] = (j)*cols   + six 
-    windex[28:35] = (j+1)*cols + six 
-    windex[35:42] = (j+2)*cols + six
-    windex[42:49] = (j+3)*cols + six
-    return windex
+# rows processed at a time
+BLOCKROWS = 256
+
+def crossings(c,lu):
+    '''ENL times 10 for all pixels: the index of the last sign change of
+       arr = c + lu (with arr[-1] preceding arr[0]) or 0 if there is none'''
+    n = len(lu)
+    start = np.nonzero(lu)[0][0]
+    tail = lu[start:]
+    with np.errstate(invalid='ignore'):
+        if np.all(lu[:start] == 0) and np.all(np.diff(tail) < 0):
+#          monotone lookup: arr = c before start, then strictly decreasing
+#          so there is at most one crossing down, with index i ...
+            i = start + len(tail) - np.searchsorted(tail[::-1],-c,side='left')
+            i = np.minimum(i,n-1)
+            down = (i > start) & ((c+lu[i])*(c+lu[i-1]) < 0)
+#          ... otherwise the last crossing is the one up at start (if any)
+            up = (c+lu[start])*c < 0
+            return np.where(down,i,np.where(up,start,0))
+#      vectorized scan over the lookup table
+        result = np.zeros(c.shape,dtype=int)
+        prev = c + lu[-1]
+        for ell in range(n):
+            arr = c + lu[ell]
+            result[arr*prev < 0] = ell
+            prev = arr
+        return result
 
+def enl_block(args):
+    '''ENL image of the rows ja to jb-1 of the subset (x0,y0,cols,rows) of 
+       infile, pixels closer than 3 to the block border are set to 0'''
+    from scipy.ndimage import uniform_filter, minimum_filter
+    infile,x0,y0,cols,ja,jb,d = args
+    inDataset = gdal.Open(infile,GA_ReadOnly)
+    bands = inDataset.RasterCount
+#  packed matrix elements, C11 only if diagonal-only            
+    if bands in (9,4):
+        img = np.array([np.nan_to_num(inDataset.GetRasterBand(i+1).ReadAsArray(x0,y0+ja,cols,jb-ja))
+                        for i in range(bands)],dtype=float)
+    else:
+        img = inDataset.GetRasterBand(1).ReadAsArray(x0,y0+ja,cols,jb-ja)[np.newaxis,:].astype(float) 
+    inDataset = None
+    enl_ml = np.zeros((jb-ja,cols),dtype=np.float32)
+    if (jb-ja <= 6) or (cols <= 6):
+        return enl_ml
+    inner = (slice(3,-3),slice(3,-3))
+    det = hermitian.det(img)
+#  windows with all determinants positive 
+    valid = minimum_filter(det,size=7)[inner] > 0.0
+    with np.errstate(divide='ignore',invalid='ignore'):
+        avlogdetC = uniform_filter(np.log(np.where(det>0,det,1.0)),size=7)[inner]
+        detavC = hermitian.det([uniform_filter(band,size=7)[inner] for band in img])
+        logdetavC = np.log(detavC)    
+    c = np.where(valid,avlogdetC - logdetavC,np.nan)
+    lu = lookup.table()
+    enl_ml[inner] = crossings(c,lu[:,d])/10.0
+    return enl_ml
 
-def enl(infile,dims=None,outfile='enl.tif',fileout=False,xrange=50,sfn=None):    
+def enl(infile,dims=None,outfile='enl.tif',fileout=False,xrange=50,sfn=None,workers=None):    
     try:
+        from concurrent.futures import ProcessPoolExecutor
         gdal.AllRegister()         
         inDataset = gdal.Open(infile,GA_ReadOnly)     
         cols = inDataset.RasterXSize
@@ -53,92 +100,27 @@ def enl(infile,dims=None,outfile='enl.tif',fileout=False,xrange=50,sfn=None):
         print( 'infile:  %s'%infile )   
         if bands == 9:
             print( 'Quad polarimetry' )  
-    #      T11 (k)
-            band = inDataset.GetRasterBand(1)
-            k = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-    #      T12  (a)
-            band = inDataset.GetRasterBand(2)
-            a = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-            band = inDataset.GetRasterBand(3)    
-            im = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-            a = a + 1j*im
-    #      T13  (rho)
-            band = inDataset.GetRasterBand(4)
-            rho = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-            band = inDataset.GetRasterBand(5)
-            im = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-            rho = rho + 1j*im     
-    #      T22 (xsi)
-            band = inDataset.GetRasterBand(6)
-            xsi = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()    
-    #      T23 (b)        
-            band = inDataset.GetRasterBand(7)
-            b = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-            band = inDataset.GetRasterBand(8)
-            im = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-            b = b + 1j*im     
-    #      T33 (zeta)
-            band = inDataset.GetRasterBand(9)
-            zeta = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()                
-            det = k*xsi*zeta + 2*np.real(a*b*np.conj(rho)) - xsi*(abs(rho)**2) - k*(abs(b)**2) - zeta*(abs(a)**2)
             d = 2
         elif bands == 4:
             print( 'Dual polarimetry' )  
-    #      C11 (k)
-            band = inDataset.GetRasterBand(1)
-            k = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-    #      C12  (a)
-            band = inDataset.GetRasterBand(2)
-            a = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-            band = inDataset.GetRasterBand(3)
-            im = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel()
-            a = a + 1j*im       
-    #      C22 (xsi)
-            band = inDataset.GetRasterBand(4)
-            xsi = np.nan_to_num(band.ReadAsArray(x0,y0,cols,rows)).ravel() 
-            det = k*xsi - abs(a)**2   
-            d = 1   
+            d = 1
         elif bands <= 3:
             print( 'Diagonal-only polarimetry, using first band' )         
-    #      C11 (k)
-            band = inDataset.GetRasterBand(1)
-            k = band.ReadAsArray(x0,y0,cols,rows).ravel() 
-            det = k
-            d = 0      
+            d = 0
         enl_ml = np.zeros((rows,cols), dtype= np.float32)
-        lu = lookup.table()
-        print( 'filtering...' )
-        print( 'row: ',end='' )   
+        print( 'filtering in blocks of %i rows ...'%BLOCKROWS )
         start = time.time()
-        for i in range(3,rows-3):
-            if i%100 == 0:
-                print( '%i '%i,end='' ) 
-            windex = get_windex(i,cols)  
-            for j in range(3,cols-3):  
-                detC = det[windex]
-                if np.min(detC) > 0.0:
-                    avlogdetC = np.sum(np.log(detC))/49
-                    if bands == 9:
-                        k1 = np.sum(k[windex])/49
-                        a1 = np.sum(a[windex])/49
-                        rho1 = np.sum(rho[windex])/49
-                        xsi1 = np.sum(xsi[windex])/49
-                        b1 = np.sum(b[windex])/49
-                        zeta1 = np.sum(zeta[windex])/49                       
-                        detavC = k1*xsi1*zeta1 + 2*np.real(a1*b1*np.conj(rho1)) - xsi1*(np.abs(rho1)**2) - k1*(np.abs(b1)**2) - zeta1*(np.abs(a1)**2)
-                    elif bands == 4:
-                        k1 = np.sum(k[windex])/49
-                        xsi1 = np.sum(xsi[windex])/49
-                        a1 = np.sum(a[windex])/49   
-                        detavC =  k1*xsi1 - np.abs(a1)**2
-                    else:
-                        detavC = np.sum(k[windex])/49
-                    logdetavC = np.log(detavC)    
-                    arr =  avlogdetC - logdetavC + lu[:,d]    
-                    ell = np.where(arr*np.roll(arr,1)<0)[0]
-                    if len(ell)>0:
-                        enl_ml[i,j] = float(ell[-1])/10.0
-                windex += 1
+#      blocks with 3 halo rows        
+        blocks = [(j0,min(j0+BLOCKROWS,rows)) for j0 in range(0,rows,BLOCKROWS)]
+        args = [(infile,x0,y0,cols,max(j0-3,0),min(j1+3,rows),d) for j0,j1 in blocks]
+        def paste(results):
+            for (j0,j1),(_,_,_,_,ja,_,_),result in zip(blocks,args,results):
+                enl_ml[j0:j1] = result[j0-ja:j1-ja]
+        if workers == 1:
+            paste(map(enl_block,args))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                paste(pool.map(enl_block,args))
         if fileout:
             driver = inDataset.GetDriver()   
             outDataset = driver.Create(outfile,cols,rows,1,GDT_Float32)
@@ -189,12 +171,14 @@ Options:
    -s <str>    save histogram image
    -x <int>    x-axis range (default 50)
    -d <list>   spatial subset list e.g. -d [0,0,400,400]
+   -w <int>    number of worker processes (default: number of CPUs)
 
 An ENL image will be written to the same directory with '_enl' appended.
 
 ------------------------------------------------''' %sys.argv[0]
-    options,args = getopt.getopt(sys.argv[1:],'hfd:x:s:')
+    options,args = getopt.getopt(sys.argv[1:],'hfd:x:s:w:')
     dims = None
+    workers = None
     fileout = False
     xrange = 50
     sfn = None
@@ -210,6 +194,8 @@ An ENL image will be written to the same directory with '_enl' appended.
             fileout = True  
         elif option == '-s':
             sfn = value       
+        elif option == '-w':
+            workers = eval(value)
     if len(args) != 1:
         print( 'Incorrect number of arguments' )
         print( usage )
@@ -219,7 +205,7 @@ An ENL image will be written to the same directory with '_enl' appended.
     basename = os.path.basename(infile)
     root, ext = os.path.splitext(basename)
     outfile = path + '/' + root + '_enl' + ext       
-    enl(infile,dims,outfile,fileout,xrange,sfn)                
+    enl(infile,dims,outfile,fileout,xrange,sfn,workers)                
         
 if __name__ == '__main__':
     main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     geotiff.py
+#  Purpose:  writer for tiled, compressed Cloud-Optimized GeoTIFFs with
+#            internal overviews, in two passes: blocks are written to a
+#            temporary tiled GeoTIFF as they are produced, when it is closed
+#            the overviews are built and the file is copied to COG layout
+#            with gdal.Translate (so the temporary file needs disk space
+#            too). Without the GDAL COG driver (GDAL < 3.1) the tiled
+#            GeoTIFF is written directly. The temporary or unfinished file
+#            is removed if the writer is aborted, e.g. on an exception
+#  Usage:
+#    from auxil.geotiff import Writer
+#    with Writer(fn,cols,rows,bands,GDT_Byte,geotransform,projection) as w:
+#        w.write(block,x,y)
+#
+# MIT License
+#
+# Copyright (c) 2018 Mort Canty
+
+import os
+import numpy as np
+from osgeo import gdal
+from osgeo.gdalconst import GDT_Float32, GDT_Float64
+
+class Writer(object):
+    '''Tiled, compressed GeoTIFF written block by block, finished by close()
+       or, on an exception, removed by abort() (also as a context manager)'''
+
+    def __init__(self,fn,cols,rows,bands,dtype,geotransform=None,projection=None,
+                 descriptions=None,cog=True,compress='DEFLATE',blocksize=256):
+        self.fn = fn
+        self.cols = cols
+        self.rows = rows
+        self.blocksize = blocksize
+        self.compress = compress
+        self.floating = dtype in (GDT_Float32,GDT_Float64)
+        self.cog = cog and (gdal.GetDriverByName('COG') is not None)
+        options = ['TILED=YES','BLOCKXSIZE=%i'%blocksize,'BLOCKYSIZE=%i'%blocksize,
+                   'COMPRESS=%s'%compress,'BIGTIFF=IF_SAFER']
+        if compress in ('DEFLATE','LZW','ZSTD'):
+            options.append('PREDICTOR=%i'%(3 if self.floating else 2))
+#      with COG the data are first streamed to a temporary tiled GeoTIFF
+        self.tmpfn = fn+'.tmp.tif' if self.cog else fn
+        driver = gdal.GetDriverByName('GTiff')
+        self.dataset = driver.Create(self.tmpfn,cols,rows,bands,dtype,options=options)
+        if geotransform is not None:
+            self.dataset.SetGeoTransform(geotransform)
+        if projection is not None:
+            self.dataset.SetProjection(projection)
+        if descriptions is not None:
+            for i,description in enumerate(descriptions):
+                self.dataset.GetRasterBand(i+1).SetDescription(description)
+
+    def write(self,block,x=0,y=0,band=1):
+        '''write a block of shape (rows,cols) or (rows,cols,nb) at pixel
+           offset (x,y) into the bands band ... band+nb-1'''
+        block = np.asarray(block)
+        if block.ndim == 2:
+            block = block[:,:,np.newaxis]
+        for i in range(block.shape[2]):
+            self.dataset.GetRasterBand(band+i).WriteArray(block[:,:,i],x,y)
+
+    def close(self):
+        '''build the internal overviews (nearest neighbour for maps, average for
+           floating point images) and finish the file'''
+        try:
+            factors = []
+            factor = 2
+            while max(self.cols,self.rows)//factor >= self.blocksize:
+                factors.append(factor)
+                factor *= 2
+            if factors:
+                self.dataset.BuildOverviews('AVERAGE' if self.floating else 'NEAREST',factors)
+            self.dataset.FlushCache()
+            self.dataset = None
+            if self.cog:
+                options = ['COMPRESS=%s'%self.compress,'BLOCKSIZE=%i'%self.blocksize,
+                           'OVERVIEWS=AUTO','BIGTIFF=IF_SAFER']
+                if self.compress in ('DEFLATE','LZW','ZSTD'):
+                    options.append('PREDICTOR=YES')
+                gdal.Translate(self.fn,self.tmpfn,format='COG',creationOptions=options)
+        finally:
+            self.dataset = None
+            if self.cog:
+                self._remove(self.tmpfn)
+
+    def abort(self):
+        '''discard the temporary or unfinished file, nothing to do after close()'''
+        if self.dataset is not None:
+            self.dataset = None
+            self._remove(self.tmpfn)
+
+    def _remove(self,fn):
+        if os.path.exists(fn):
+            gdal.GetDriverByName('GTiff').Delete(fn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
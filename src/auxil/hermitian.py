@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     hermitian.py
+#  Purpose:  batched determinants, log-determinants, spans and Loewner order
+#            of Hermitian polarimetric matrices in their packed band layouts:
+#
+#            9 bands (quad pol):  T11, Re T12, Im T12, Re T13, Im T13, T22, Re T23, Im T23, T33
+#            4 bands (dual pol):  C11, Re C12, Im C12, C22
+#            3 bands (quad pol diagonal only): T11, T22, T33
+#            2 bands (dual pol diagonal only): C11, C22
+#            1 band  (single pol): C11
+#
+#            img is indexed by band, i.e. img[0], img[1], ... are arrays of
+#            identical shape, e.g. an array of shape (bands,n) or a list of bands.
+#            Results are written into out= and temporaries into work= if these
+#            are given, so that nothing is allocated in inner loops. The data
+#            type (float32 or float64) follows the input.
+#  Usage:
+#    from auxil import hermitian
+#    d = hermitian.det(img)
+#
+# MIT License
+#
+# Copyright (c) 2018 Mort Canty
+
+import numpy as np
+
+# determinant expressions for ee.Image.expression()
+DET_EXPR = {1: 'b(0)',
+            2: 'b(0)*b(1)',
+            3: 'b(0)*b(1)*b(2)',
+            4: 'b(0)*b(3)-b(1)*b(1)-b(2)*b(2)',
+            9: 'b(0)*b(5)*b(8)+2*(b(1)*b(6)*b(3)-b(2)*b(7)*b(3)+b(2)*b(6)*b(4)+b(1)*b(7)*b(4))'
+               '-b(5)*(b(3)*b(3)+b(4)*b(4))-b(0)*(b(6)*b(6)+b(7)*b(7))-b(8)*(b(1)*b(1)+b(2)*b(2))'}
+
+# band positions of the diagonal matrix elements
+DIAGONAL = {1: [0], 2: [0,1], 3: [0,1,2], 4: [0,3], 9: [0,5,8]}
+
+def _buffers(img,out,work,nwork):
+#  allocate output and work arrays if not supplied
+    shape = np.shape(img[0])
+    dtype = np.result_type(img[0],np.float32)
+    if out is None:
+        out = np.empty(shape,dtype=dtype)
+    if work is None:
+        work = np.empty((nwork,)+shape,dtype=dtype)
+    return out, work
+
+def det(img,out=None,work=None):
+    '''return determinant of 1, 2, 3, 4, or 9-band polarimetric image,
+       work: 2 temporary arrays'''
+    bands = len(img)
+    out, work = _buffers(img,out,work,2)
+    if bands == 1:
+        np.copyto(out,img[0])
+    elif bands == 2:
+        np.multiply(img[0],img[1],out=out)
+    elif bands == 3:
+        np.multiply(img[0],img[1],out=out)
+        out *= img[2]
+    elif bands == 4:
+        w = work[0,...]
+        np.multiply(img[0],img[3],out=out)
+        np.multiply(img[1],img[1],out=w)
+        out -= w
+        np.multiply(img[2],img[2],out=w)
+        out -= w
+    elif bands == 9:
+        k,ar,ai,pr,pi,xsi,br,bi,zeta = [img[i] for i in range(9)]
+        w0 = work[0,...]
+        w1 = work[1,...]
+#      k*xsi*zeta
+        np.multiply(k,xsi,out=out)
+        out *= zeta
+#      + 2*Re(a*b*conj(rho)) = 2*( pr*(ar*br-ai*bi) + pi*(ai*br+ar*bi) )
+        np.multiply(ar,br,out=w0)
+        np.multiply(ai,bi,out=w1)
+        w0 -= w1
+        w0 *= pr
+        out += w0
+        out += w0
+        np.multiply(ai,br,out=w0)
+        np.multiply(ar,bi,out=w1)
+        w0 += w1
+        w0 *= pi
+        out += w0
+        out += w0
+#      - xsi*|rho|^2
+        np.multiply(pr,pr,out=w0)
+        np.multiply(pi,pi,out=w1)
+        w0 += w1
+        w0 *= xsi
+        out -= w0
+#      - k*|b|^2
+        np.multiply(br,br,out=w0)
+        np.multiply(bi,bi,out=w1)
+        w0 += w1
+        w0 *= k
+        out -= w0
+#      - zeta*|a|^2
+        np.multiply(ar,ar,out=w0)
+        np.multiply(ai,ai,out=w1)
+        w0 += w1
+        w0 *= zeta
+        out -= w0
+    else:
+        raise ValueError('number of bands must be 1, 2, 3, 4 or 9')
+    return out
+
+def logdet(img,out=None,work=None,eps=None):
+    '''return log of determinant of 1, 2, 3, 4, or 9-band polarimetric image,
+       determinants <= eps (default: smallest normal float) are set to eps,
+       work: 2 temporary arrays'''
+    out = det(img,out,work)
+    if eps is None:
+        eps = np.finfo(out.dtype).tiny
+    np.nan_to_num(out,copy=False)
+    np.maximum(out,eps,out=out)
+    return np.log(out,out=out)
+
+def logdet_ldl(img,out=None,work=None,eps=None):
+    '''return log of determinant of 1, 2, 3, 4, or 9-band polarimetric image as
+       the sum of the logs of the pivots of its LDL^H decomposition. This avoids
+       the cancellation and underflow of the closed-form determinant in single
+       precision. Matrices with a pivot <= eps (default: smallest normal float)
+       get the log-determinant log(eps), work: 4 temporary arrays'''
+    bands = len(img)
+    out, work = _buffers(img,out,work,4)
+    if eps is None:
+        eps = np.finfo(out.dtype).tiny
+#  zero or nan pivots are caught below
+    with np.errstate(divide='ignore',invalid='ignore'):
+        if bands <= 3:
+            pivots = [img[i] for i in range(bands)]
+        elif bands == 4:
+#          d2 = C22 - |C12|^2/C11
+            d2 = work[0,...]
+            w = work[1,...]
+            np.multiply(img[1],img[1],out=d2)
+            np.multiply(img[2],img[2],out=w)
+            d2 += w
+            d2 /= img[0]
+            np.subtract(img[3],d2,out=d2)
+            pivots = [img[0],d2]
+        elif bands == 9:
+            k,ar,ai,pr,pi,xsi,br,bi,zeta = [img[i] for i in range(9)]
+            d2 = work[0,...]
+            sr = work[1,...]
+            si = work[2,...]
+            w = work[3,...]
+#          d2 = xsi - |a|^2/k
+            np.multiply(ar,ar,out=d2)
+            np.multiply(ai,ai,out=w)
+            d2 += w
+            d2 /= k
+            np.subtract(xsi,d2,out=d2)
+#          Schur complement off-diagonal element s = b - conj(a)*rho/k
+            np.multiply(ar,pr,out=sr)
+            np.multiply(ai,pi,out=w)
+            sr += w
+            sr /= k
+            np.subtract(br,sr,out=sr)
+            np.multiply(ar,pi,out=si)
+            np.multiply(ai,pr,out=w)
+            si -= w
+            si /= k
+            np.subtract(bi,si,out=si)
+#          d3 = zeta - |rho|^2/k - |s|^2/d2
+            sr *= sr
+            si *= si
+            sr += si
+            sr /= d2
+            np.multiply(pr,pr,out=w)
+            np.multiply(pi,pi,out=si)
+            w += si
+            w /= k
+            sr += w
+            np.subtract(zeta,sr,out=sr)
+            pivots = [k,d2,sr]
+        else:
+            raise ValueError('number of bands must be 1, 2, 3, 4 or 9')
+    mn = work[2,...]
+    w = work[3,...]
+    np.copyto(mn,pivots[0])
+    out[...] = 0
+    for d in pivots:
+        np.minimum(mn,d,out=mn)
+        np.maximum(d,eps,out=w)
+        out += np.log(w,out=w)
+#  not positive definite (or nan)
+    np.copyto(out,np.log(eps),where=~(mn>eps),casting='unsafe')
+    return out
+
+def span(img,out=None):
+    '''return span (trace) of 1, 2, 3, 4, or 9-band polarimetric image'''
+    diagonal = DIAGONAL[len(img)]
+    out,_ = _buffers(img,out,0,0)
+    np.copyto(out,img[diagonal[0]])
+    for i in diagonal[1:]:
+        out += img[i]
+    return out
+
+def loewner(img,out=None,work=None):
+    '''return Loewner order of 1, 2, 3, 4, or 9-band polarimetric (difference) image
+                                        1 positive definite
+                                        2 negative definite
+                                        3 neither
+       from the signs of the leading principal minors (Sylvester's criterion),
+       work: 4 temporary arrays'''
+    bands = len(img)
+    if out is None:
+        out = np.empty(np.shape(img[0]),dtype=np.uint8)
+    _,work = _buffers(img,0,work,4)
+    out[...] = 3
+    if bands <= 3:
+#      diagonal matrices: all diagonal elements positive or all negative
+        mn = work[0,...]
+        mx = work[1,...]
+        np.copyto(mn,img[0])
+        np.copyto(mx,img[0])
+        for i in range(1,bands):
+            np.minimum(mn,img[i],out=mn)
+            np.maximum(mx,img[i],out=mx)
+        np.copyto(out,1,where=mn>0)
+        np.copyto(out,2,where=mx<0)
+    elif bands == 4:
+        d2 = det(img,work[0,...],work[1:3])
+        pd = d2 > 0
+        np.copyto(out,1,where=pd&(img[0]>0))
+        np.copyto(out,2,where=pd&(img[0]<0))
+    elif bands == 9:
+        d2 = det([img[0],img[1],img[2],img[5]],work[0,...],work[2:4])
+        d3 = det(img,work[1,...],work[2:4])
+        pd = d2 > 0
+        np.copyto(out,1,where=pd&(img[0]>0)&(d3>0))
+        np.copyto(out,2,where=pd&(img[0]<0)&(d3<0))
+    else:
+        raise ValueError('number of bands must be 1, 2, 3, 4 or 9')
+    return out
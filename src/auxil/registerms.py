@@ -13,11 +13,10 @@
 #
 #  Copyright (c) 2018 Mort Canty
 
-from auxil.auxil1 import similarity
+from auxil.auxil1 import similarity, similarity_warp
 import os, sys, getopt, time
 import numpy as np
 from osgeo import gdal
-import scipy.ndimage.interpolation as ndii
 from osgeo.gdalconst import GA_ReadOnly, GDT_Float32
   
 def register(fn1, fn2, warpband, dims1=None, outfile=None):                  
@@ -74,15 +73,12 @@ def register(fn1, fn2, warpband, dims1=None, outfile=None):
         if projection is not None:
             outDataset.SetProjection(projection) 
     
-    #  warp 
+    #  warp, single resampling within the output window 
         for k in range(bands2):       
             inband = inDataset2.GetRasterBand(k+1)      
             outBand = outDataset.GetRasterBand(k+1)
-            bn1 = inband.ReadAsArray(0,0,cols2,rows2).astype(np.float32)
-            bn2 = ndii.zoom(bn1, 1.0 / scale)
-            bn2 = ndii.rotate(bn2, angle)
-            bn2 = ndii.shift(bn2, shift)       
-            outBand.WriteArray(bn2[y0:y0+rows1, x0:x0+cols1]) 
+            bn2 = similarity_warp(inband, scale, angle, shift, (x0, y0, cols1, rows1))
+            outBand.WriteArray(bn2) 
             outBand.FlushCache() 
         inDataset1 = None
         inDataset2 = None
@@ -11,222 +11,196 @@
 #
 #  Usage:     
 #    import registersar
-#    register.register[sar|vnir] (reffilename,warpfilename,dims,outfile) 
+#    registersar.register(reffilename,warpfilename,dims,outfile) 
+#    registersar.register_stack(reffilename,warpfilenames,dims,workers) 
 #          or        
-#    python registersar.py [OPTIONS] reffilename warpfilename
+#    python registersar.py [OPTIONS] reffilename warpfilename [warpfilename ...]
 #
 #  Copyright (c) 2018 Mort Canty
 
 import sys, getopt
-  
-def register(file0, file1, dims=None, outfile=None): 
+
+def span(inDataset, x0, y0, cols, rows):
+    '''Return the log of the span image in the window (x0,y0,cols,rows) 
+       of a 9-, 4-, 3-, 2- or 1-band polarimetric SAR dataset'''
+    import numpy as np
+    from auxil.hermitian import DIAGONAL
+    diagonal = DIAGONAL[inDataset.RasterCount]
+    result = inDataset.GetRasterBand(diagonal[0]+1).ReadAsArray(x0, y0, cols, rows)
+    for i in diagonal[1:]:
+        result += inDataset.GetRasterBand(i+1).ReadAsArray(x0, y0, cols, rows)
+    return np.log(np.nan_to_num(result)+0.001)
+
+def reference(file0, dims=None):
+    '''Return the reference for registration to (the spatial subset dims of)
+       file0: a dict with its georeferencing, spatial subset, number of bands, 
+       log span image and the spectra from auxil.similarity_reference()'''
     import auxil.auxil1 as auxil
-    import os, time
+    from osgeo import gdal
+    from osgeo.gdalconst import GA_ReadOnly
+    gdal.AllRegister()
+    inDataset0 = gdal.Open(file0, GA_ReadOnly)     
+    cols = inDataset0.RasterXSize
+    rows = inDataset0.RasterYSize
+    bands = inDataset0.RasterCount
+    if dims == None:
+        dims = [0,0,cols,rows]
+    x0,y0,cols,rows = dims 
+    span0 = span(inDataset0, x0, y0, cols, rows)
+    ref = {'file':file0, 'dims':list(dims), 'bands':bands,
+           'geotransform':inDataset0.GetGeoTransform(),
+           'projection':inDataset0.GetProjection(),
+           'span':span0, 'spectra':auxil.similarity_reference(span0)}
+    inDataset0 = None
+    return ref
+
+def warp(ref, file1, outfile=None):
+    '''Register file1 to the reference ref (see reference()), write the warped
+       image trimmed to the reference subset to outfile and return 
+       (outfile, scale, angle, shift)'''
+    import auxil.auxil1 as auxil
+    import os
     import numpy as np
     from osgeo import gdal
-    import scipy.ndimage.interpolation as ndii
     from osgeo.gdalconst import GA_ReadOnly, GDT_Float32
-    
+    if outfile is None:
+        path = os.path.abspath(file1)    
+        dirn = os.path.dirname(path)
+        basename = os.path.basename(file1)
+        root, ext = os.path.splitext(basename)
+        outfile = dirn + '/' + root + '_warp' + ext  
+    bands = ref['bands']
+    x0,y0,cols,rows = ref['dims']
+    inDataset1 = gdal.Open(file1, GA_ReadOnly)   
+    if inDataset1.RasterCount != bands:
+        raise ValueError('Number of bands must be equal')
+#  create the output file 
+    driver = inDataset1.GetDriver() 
+    outDataset = driver.Create(outfile,cols,rows,bands,GDT_Float32)
+    projection0 = ref['projection']
+    gt0 = list(ref['geotransform'])               
+    gt1 = list(inDataset1.GetGeoTransform())    
+    if projection0 is not None:
+        outDataset.SetProjection(projection0)                          
+#  find the upper left corner (x0,y0) of reference subset in target (x1,y1)    
+    ulx0 = gt0[0] + x0*gt0[1] + y0*gt0[2]
+    uly0 = gt0[3] + x0*gt0[4] + y0*gt0[5]
+    GT1 = np.array([[gt1[1],gt1[2]],[gt1[4],gt1[5]]])
+    ul1 = np.array([ulx0-gt1[0],uly0-gt1[3]])
+    tmp = np.linalg.solve(GT1,ul1)
+    x1 = int(round(tmp[0]))
+    y1 = int(round(tmp[1]))
+#  create output geotransform 
+    gt1 = gt0   
+    gt1[0] = ulx0 
+    gt1[3] = uly0   
+    outDataset.SetGeoTransform(tuple(gt1)) 
+#  get warp parameters using span images of matching subsets
+    span1 = span(inDataset1, x1, y1, cols, rows)
+    scale, angle, shift = auxil.similarity(ref['span'], span1, ref['spectra'])   
+#  warp the target to the reference, evaluated only within the clip window
+    for k in range(bands): 
+        rasterBand = inDataset1.GetRasterBand(k+1)
+        bn = auxil.similarity_warp(rasterBand, scale, angle, shift, (x1, y1, cols, rows))
+        outBand = outDataset.GetRasterBand(k+1)
+        outBand.WriteArray(bn)
+        outBand.FlushCache()
+    inDataset1 = None
+    outDataset = None
+    return (outfile, scale, angle, shift)
+  
+def register(file0, file1, dims=None, outfile=None): 
+    import time
     print( '========================= ' )
     print( '       Register SAR'        )
     print( '========================='  )
     print( time.asctime() )     
     try: 
-        if outfile is None:
-            path = os.path.abspath(file1)    
-            dirn = os.path.dirname(path)
-            path = os.path.dirname(file1)    
-            basename = os.path.basename(file1)
-            root, ext = os.path.splitext(basename)
-            outfile = dirn + '/' + root + '_warp' + ext  
         start = time.time()   
-        gdal.AllRegister()
-    #  reference    
-        inDataset0 = gdal.Open(file0, GA_ReadOnly)     
-        cols = inDataset0.RasterXSize
-        rows = inDataset0.RasterYSize
-        bands = inDataset0.RasterCount
         print( 'Reference SAR image:\n %s' % file0 )  
-        if dims == None:
-            dims = [0,0,cols,rows]
-        x0,y0,cols,rows = dims 
-    #  target                   
-        inDataset1 = gdal.Open(file1, GA_ReadOnly)   
-        cols1 = inDataset1.RasterXSize
-        rows1 = inDataset1.RasterYSize  
-        bands1 = inDataset1.RasterCount
+        ref = reference(file0, dims)
         print( 'Target SAR image:\n %s' % file1  )    
-        if  bands != bands1:
-            print( 'Number of bands must be equal' )
-            return 0
-    #  create the output file 
-        driver = inDataset1.GetDriver() 
-        outDataset = driver.Create(outfile,cols,rows,bands,GDT_Float32)
-        projection0 = inDataset0.GetProjection()
-        geotransform0 = inDataset0.GetGeoTransform()
-        geotransform1 = inDataset1.GetGeoTransform()
-        gt0 = list(geotransform0)               
-        gt1 = list(geotransform1)    
-        if projection0 is not None:
-            outDataset.SetProjection(projection0)                          
-    #  find the upper left corner (x0,y0) of reference subset in target (x1,y1)    
-        ulx0 = gt0[0] + x0*gt0[1] + y0*gt0[2]
-        uly0 = gt0[3] + x0*gt0[4] + y0*gt0[5]
-        GT1 = np.mat([[gt1[1],gt1[2]],[gt1[4],gt1[5]]])
-        ul1 = np.mat([[ulx0-gt1[0]],[uly0-gt1[3]]])
-        tmp = GT1.I*ul1
-        x1 = int(round(tmp[0,0]))
-        y1 = int(round(tmp[1,0]))
-    #  create output geotransform 
-        gt1 = gt0   
-        gt1[0] = ulx0 
-        gt1[3] = uly0   
-        outDataset.SetGeoTransform(tuple(gt1)) 
-    #  get matching subsets from geotransform     
-        rasterBand = inDataset0.GetRasterBand(1)   
-        span0 = rasterBand.ReadAsArray(x0, y0, cols, rows)
-        rasterBand = inDataset1.GetRasterBand(1)
-        span1 = rasterBand.ReadAsArray(x1, y1, cols, rows)
-        if bands == 9:
-    #      get warp parameters using span images         
-            print( 'warping 9 bands (quad pol)...' ) 
-            rasterBand = inDataset0.GetRasterBand(6)
-            span0 += rasterBand.ReadAsArray(x0, y0, cols, rows)
-            rasterBand = inDataset0.GetRasterBand(9)
-            span0 += rasterBand.ReadAsArray(x0, y0, cols, rows)  
-            span0 = np.log(np.nan_to_num(span0)+0.001)                                   
-            rasterBand = inDataset1.GetRasterBand(6)
-            span1 += rasterBand.ReadAsArray(x1, y1, cols, rows)
-            rasterBand = inDataset1.GetRasterBand(9)
-            span1 += rasterBand.ReadAsArray(x1, y1, cols, rows)  
-            span1 = np.log(np.nan_to_num(span1)+0.001)                           
-            scale, angle, shift = auxil.similarity(span0, span1)   
-    #      warp the target to the reference and clip
-            for k in range(9): 
-                rasterBand = inDataset1.GetRasterBand(k+1)
-                band = rasterBand.ReadAsArray(0, 0, cols1, rows1).astype(np.float32)
-                bn1 = np.nan_to_num(band)                  
-                bn2 = ndii.zoom(bn1, 1.0 / scale)
-                bn2 = ndii.rotate(bn2, angle)
-                bn2 = ndii.shift(bn2, shift)
-                bn = bn2[y1:y1+rows,x1:x1+cols] 
-                outBand = outDataset.GetRasterBand(k+1)
-                outBand.WriteArray(bn)
-                outBand.FlushCache()
-        elif bands == 4:
-    #      get warp parameters using span images         
-            print( 'warping 4 bands (dual pol)...' )
-            rasterBand = inDataset0.GetRasterBand(4)
-            span0 += rasterBand.ReadAsArray(x0, y0, cols, rows)
-            span0 = np.log(np.nan_to_num(span0)+0.001)                                   
-            rasterBand = inDataset1.GetRasterBand(4)
-            span1 += rasterBand.ReadAsArray(x1, y1, cols, rows)
-            span1 = np.log(np.nan_to_num(span1)+0.001)                           
-            scale, angle, shift = auxil.similarity(span0, span1)   
-    #      warp the target to the reference and clip
-            for k in range(4): 
-                rasterBand = inDataset1.GetRasterBand(k+1)
-                band = rasterBand.ReadAsArray(0, 0, cols1, rows1).astype(np.float32)
-                bn1 = np.nan_to_num(band)                  
-                bn2 = ndii.zoom(bn1, 1.0 / scale)
-                bn2 = ndii.rotate(bn2, angle)
-                bn2 = ndii.shift(bn2, shift)
-                bn = bn2[y1:y1+rows,x1:x1+cols] 
-                outBand = outDataset.GetRasterBand(k+1)
-                outBand.WriteArray(bn)
-                outBand.FlushCache()           
-        elif bands ==3:
-    #      get warp parameters using span images         
-            print( 'warping 3 bands (quad pol diagonal)...' ) 
-            rasterBand = inDataset0.GetRasterBand(2)
-            span0 += rasterBand.ReadAsArray(x0, y0, cols, rows)
-            rasterBand = inDataset0.GetRasterBand(3)
-            span0 += rasterBand.ReadAsArray(x0, y0, cols, rows)
-            span0 = np.log(np.nan_to_num(span0)+0.001)                                   
-            rasterBand = inDataset1.GetRasterBand(2)
-            span1 += rasterBand.ReadAsArray(x1, y1, cols, rows)
-            rasterBand = inDataset1.GetRasterBand(3)
-            span1 += rasterBand.ReadAsArray(x1, y1, cols, rows)
-            span1 = np.log(np.nan_to_num(span1)+0.001)                           
-            scale, angle, shift = auxil.similarity(span0, span1)   
-    #      warp the target to the reference and clip
-            for k in range(3): 
-                rasterBand = inDataset1.GetRasterBand(k+1)
-                band = rasterBand.ReadAsArray(0, 0, cols1, rows1).astype(np.float32)
-                bn1 = np.nan_to_num(band)                  
-                bn2 = ndii.zoom(bn1, 1.0 / scale)
-                bn2 = ndii.rotate(bn2, angle)
-                bn2 = ndii.shift(bn2, shift)
-                bn = bn2[y1:y1+rows,x1:x1+cols] 
-                outBand = outDataset.GetRasterBand(k+1)
-                outBand.WriteArray(bn)
-                outBand.FlushCache()            
-        elif bands == 2:
-    #      get warp parameters using span images         
-            print( 'warping 2 bands (dual pol diagonal)...' ) 
-            rasterBand = inDataset0.GetRasterBand(2)
-            span0 += rasterBand.ReadAsArray(x0, y0, cols, rows)
-            span0 = np.log(np.nan_to_num(span0)+0.001)                                   
-            rasterBand = inDataset1.GetRasterBand(2)
-            span1 += rasterBand.ReadAsArray(x1, y1, cols, rows)
-            span1 = np.log(np.nan_to_num(span1)+0.001)                           
-            scale, angle, shift = auxil.similarity(span0, span1)   
-    #      warp the target to the reference and clip
-            for k in range(2): 
-                rasterBand = inDataset1.GetRasterBand(k+1)
-                band = rasterBand.ReadAsArray(0, 0, cols1, rows1).astype(np.float32)
-                bn1 = np.nan_to_num(band)                  
-                bn2 = ndii.zoom(bn1, 1.0 / scale)
-                bn2 = ndii.rotate(bn2, angle)
-                bn2 = ndii.shift(bn2, shift)
-                bn = bn2[y1:y1+rows,x1:x1+cols] 
-                outBand = outDataset.GetRasterBand(k+1)
-                outBand.WriteArray(bn)
-                outBand.FlushCache()            
-        elif bands == 1:
-    #      get warp parameters using span images         
-            print( 'warping 1 band (single pol)...' ) 
-            span0 = np.log(np.nan_to_num(span0)+0.001)                                   
-            span1 = np.log(np.nan_to_num(span1)+0.001)                           
-            scale, angle, shift = auxil.similarity(span0, span1)   
-    #      warp the target to the reference and clip
-            for k in range(1): 
-                rasterBand = inDataset1.GetRasterBand(k+1)
-                band = rasterBand.ReadAsArray(0, 0, cols1, rows1).astype(np.float32)
-                bn1 = np.nan_to_num(band)                  
-                bn2 = ndii.zoom(bn1, 1.0 / scale)
-                bn2 = ndii.rotate(bn2, angle)
-                bn2 = ndii.shift(bn2, shift)
-                bn = bn2[y1:y1+rows,x1:x1+cols] 
-                outBand = outDataset.GetRasterBand(k+1)
-                outBand.WriteArray(bn)
-                outBand.FlushCache()           
-        inDataset0 = None
-        inDataset1 = None
-        outDataset = None    
+        print( 'warping %i band(s) ...'%ref['bands'] )
+        outfile, _, _, _ = warp(ref, file1, outfile)
         print( 'Warped image written to: %s'%outfile )
         print( 'elapsed time: ' + str(time.time() - start)  )
         return outfile
     except Exception as e:
         print( 'registersar failed: %s'%e )    
         return None     
-    
 
-    
+# reference shared by the worker processes of register_stack()
+_ref = None
+
+def _set_reference(ref):
+    global _ref
+    _ref = ref
+
+def _warp(file1):
+    try:
+        return warp(_ref, file1)
+    except Exception as e:
+        print( 'registersar failed for %s: %s'%(file1,e) )    
+        return (None, None, None, None)
+
+def _warp_with(arg):
+#  reference passed with each target, for map functions without an initializer
+    ref, file1 = arg
+    _set_reference(ref)
+    return _warp(file1)
+
+def register_stack(file0, files, dims=None, workers=None, pmap=None):
+    '''Register all SAR images in files to (the spatial subset dims of) file0.
+       The reference span image and its spectra are computed once and shared
+       with a pool of worker processes (workers = 1: no pool), or passed to
+       the map function pmap (e.g. of a thread pool or an ipyparallel view)
+       with each target. Returns the list of warped files (None where 
+       registration failed) and the table of warp parameters, one row 
+       (file, scale, angle, shift) per target'''
+    import time
+    from concurrent.futures import ProcessPoolExecutor
+    print( '========================= ' )
+    print( '    Register SAR stack'     )
+    print( '========================='  )
+    print( time.asctime() )     
+    start = time.time()   
+    print( 'Reference SAR image:\n %s' % file0 )  
+    ref = reference(file0, dims)
+    print( 'registering %i target(s) ...'%len(files) )
+    if pmap is not None:
+        results = list(pmap(_warp_with,[(ref,file1) for file1 in files]))
+    elif workers == 1:
+        _set_reference(ref)
+        results = list(map(_warp,files))
+    else:
+        with ProcessPoolExecutor(max_workers=workers,initializer=_set_reference,initargs=(ref,)) as ex:
+            results = list(ex.map(_warp,files))
+    table = [(file1,scale,angle,shift) for file1,(_,scale,angle,shift) in zip(files,results)]
+    print( '%-40s %10s %10s %20s'%('target','scale','angle','shift (rows, cols)') )
+    for file1,scale,angle,shift in table:
+        if scale is None:
+            print( '%-40s %10s'%(file1,'failed') )
+        else:
+            print( '%-40s %10.5f %10.4f %9.2f, %9.2f'%(file1,scale,angle,shift[0],shift[1]) )
+    print( 'elapsed time: ' + str(time.time() - start)  )
+    return [result[0] for result in results], table
+
 def main(): 
     usage = '''
 Usage:
 ------------------------------------------------
 
-python %s [OPTIONS] reffilename warpfilename
+python %s [OPTIONS] reffilename warpfilename [warpfilename ...]
     
     
-Perform image-image registration of two polarimetric SAR images   
+Perform image-image registration of polarimetric SAR images   
     
 Options:
 
    -h         this help
    -d  <list> spatial subset list e.g. -d [0,0,500,500]
+   -w  <int>  number of worker processes when registering several 
+              warp images (default: number of CPUs)
    
 The reference image should be smaller than the warp image 
 (i.e., the warp image should overlap the reference image completely) 
@@ -246,21 +220,26 @@ dimensions of the reference image.
    
 --------------------------------------------'''%sys.argv[0]
 
-    options,args = getopt.getopt(sys.argv[1:],'hd:')
+    options,args = getopt.getopt(sys.argv[1:],'hd:w:')
     dims = None
+    workers = None
     for option, value in options: 
         if option == '-h':
             print( usage )
             return 
         elif option == '-d':
             dims = eval(value)          
-    if len(args) != 2:
+        elif option == '-w':
+            workers = eval(value)
+    if len(args) < 2:
         print( 'Incorrect number of arguments' )
         print( usage )
         sys.exit(1)        
     fn0 = args[0]
-    fn1 = args[1]
-    outfile = register(fn0,fn1,dims=dims)     
+    if len(args) == 2:
+        outfile = register(fn0,args[1],dims=dims)     
+    else:
+        outfiles, _ = register_stack(fn0,args[1:],dims=dims,workers=workers)
 
 if __name__ == '__main__':
     main()    
@@ -4,24 +4,31 @@
 #  Purpose:  spatial and spectral subsetting
 #  Usage:     
 #    import subset
-#    subset.subset(filename,dims,pos,outfile) 
+#    subset.subset(filename,dims,pos,outfile,vrt) 
 #          or        
 #    python subset.py [OPTIONS] filename
 # MIT License
 # 
 # Copyright (c) 2018 Mort Canty
 
-import numpy as np
 import os, sys, getopt, time
 from osgeo import gdal
-from osgeo.gdalconst import GA_ReadOnly,GDT_Float32
+from osgeo.gdalconst import GA_ReadOnly
 
-def subset(infile, dims=None, pos=None, outfile=None): 
+# minimum number of rows copied at a time
+BLOCKROWS = 256
+
+def subset(infile, dims=None, pos=None, outfile=None, vrt=False): 
+    '''Spatial/spectral subset of infile, copied block by block in the
+       data type of the input. With vrt=True only a GDAL VRT window
+       onto infile is written (no pixels are copied)'''
     gdal.AllRegister()
     if outfile is None:
         path = os.path.dirname(infile)
         basename = os.path.basename(infile)
         root, ext = os.path.splitext(basename)
+        if vrt:
+            ext = '.vrt'
         outfile = path+'/'+root+'_sub'+ext    
     print( '===========================' )
     print( 'Spatial/spectral subsetting' )
@@ -43,18 +50,18 @@ def subset(infile, dims=None, pos=None, outfile=None):
             bands = len(pos)
         else:
             pos = range(1,bands+1)     
-    #   subset
-        G = np.zeros((rows,cols,bands)) 
-        k = 0                               
-        for b in pos:
-            band = inDataset.GetRasterBand(b)
-            G[:,:,k] = band.ReadAsArray(x0,y0,cols,rows)\
-                                  .astype(float)
-            k += 1         
-    #  write to disk       
+        if vrt:
+    #      virtual subset, georeferencing is adjusted by GDAL        
+            outDataset = gdal.Translate(outfile,inDataset,format='VRT',
+                                        srcWin=[x0,y0,cols,rows],bandList=list(pos))
+            outDataset = None
+            inDataset = None
+            print( 'elapsed time: %s'%str(time.time()-start) )
+            return outfile
+    #  create output in the data type of the input     
         driver = inDataset.GetDriver() 
         outDataset = driver.Create(outfile,
-                    cols,rows,bands,GDT_Float32)
+                    cols,rows,bands,inDataset.GetRasterBand(pos[0]).DataType)
         projection = inDataset.GetProjection()
         geotransform = inDataset.GetGeoTransform()
         if geotransform is not None:
@@ -64,9 +71,15 @@ def subset(infile, dims=None, pos=None, outfile=None):
             outDataset.SetGeoTransform(tuple(gt))
         if projection is not None:
             outDataset.SetProjection(projection)        
-        for k in range(bands):        
+    #  copy in strips of whole blocks of the input (at least BLOCKROWS rows)    
+        for k,b in enumerate(pos):
+            inBand = inDataset.GetRasterBand(b)
             outBand = outDataset.GetRasterBand(k+1)
-            outBand.WriteArray(G[:,:,k],0,0) 
+            blockrows = inBand.GetBlockSize()[1]
+            nrows = blockrows*max(1,-(-BLOCKROWS//blockrows))
+            for i in range(0,rows,nrows):
+                n = min(nrows,rows-i)
+                outBand.WriteArray(inBand.ReadAsArray(x0,y0+i,cols,n),0,i)
             outBand.FlushCache() 
         outDataset = None    
         inDataset = None        
@@ -91,11 +104,14 @@ Options:
    -h          this help
    -d <list>   spatial subset list e.g. -d [0,0,500,500]
    -p <list>   band position list e.g. -p [1,2,3,4,5,7]
+   -v          write a VRT window onto the input file instead
+               of copying the pixels
    
 --------------------------------------------'''%sys.argv[0]
-    options,args = getopt.getopt(sys.argv[1:],'hd:p:')
+    options,args = getopt.getopt(sys.argv[1:],'hd:p:v')
     dims = None
     pos = None
+    vrt = False
     for option, value in options: 
         if option == '-h':
             print( usage )
@@ -104,12 +120,14 @@ Options:
             dims = eval(value)  
         elif option == '-p':
             pos = eval(value)
+        elif option == '-v':
+            vrt = True
     if len(args) != 1:
         print( 'Incorrect number of arguments' )
         print( usage )
         sys.exit(1)                 
     infile = args[0] 
-    outfile = subset(infile,dims,pos)
+    outfile = subset(infile,dims,pos,vrt=vrt)
     print( 'Subset image written to: %s' % outfile )
      
 if __name__ == '__main__':
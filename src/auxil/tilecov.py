@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     tilecov.py
+#  Purpose:  map-reduce weighted covariance matrix and means of the stacked
+#            bands of co-registered images, e.g. the two images of an IR-MAD
+#            pair. The images are split into strips of rows, each worker
+#            reads its strip and returns the partial statistics (sum of
+#            weights, means, centered cross products), which are merged with
+#            the formulas of Chan, Golub and LeVeque. The workers can be a
+#            local process pool or the engines of an ipyparallel cluster
+#            (which must see the image files under the same paths, e.g. on
+#            an NFS share). For subsampled statistics only every step-th
+#            image row is read
+#  Usage:
+#    from auxil import tilecov
+#    pmap, pool = tilecov.get_map('processes')
+#    S, means = tilecov.covariance([fn1,fn2],dims,pos,pmap=pmap)
+#
+# MIT License
+#
+# Copyright (c) 2018 Mort Canty
+
+import numpy as np
+from scipy import stats
+from osgeo import gdal
+from osgeo.gdalconst import GA_ReadOnly
+from auxil.auxil1 import Cpm
+
+def tiles(cols,rows,tile=256):
+    '''strips of tile rows as windows (x,y,cols,rows)'''
+    return [(0,y,cols,min(tile,rows-y)) for y in range(0,rows,tile)]
+
+def read_tile(fns,pos,offsets,window,step=1):
+    '''pixel matrix of the bands pos of the images fns stacked side by side
+       in the window (x,y,cols,rows) relative to the image offsets (x0,y0),
+       and the mask of the pixels which are nonzero in every image.
+       step > 1: only the rows of the window which are multiples of step'''
+    x,y,cols,rows = window
+    bands = len(pos)
+    rws = range(y+(-y)%step,y+rows,step)
+    X = np.empty((cols*len(rws),len(fns)*bands))
+    valid = np.ones(cols*len(rws),dtype=bool)
+    for i,fn in enumerate(fns):
+        x0,y0 = offsets[i]
+        inDataset = gdal.Open(fn,GA_ReadOnly)
+        for k,b in enumerate(pos):
+            band = inDataset.GetRasterBand(b)
+            if step == 1:
+                X[:,i*bands+k] = band.ReadAsArray(x0+x,y0+y,cols,rows).ravel()
+            else:
+                for j,r in enumerate(rws):
+                    X[j*cols:(j+1)*cols,i*bands+k] = band.ReadAsArray(x0+x,y0+r,cols,1).ravel()
+        inDataset = None
+#      eliminate no-data pixels
+        valid &= np.sum(np.nan_to_num(X[:,i*bands:(i+1)*bands]),axis=1) != 0
+    return X, valid
+
+def madweights(tile,params):
+    '''IR-MAD no-change probabilities of the pixels in tile for the
+       transformation params = (means,A,B,sigMADs) of the last iteration'''
+    means,A,B,sigMADs = params
+    bands = len(sigMADs)
+    W = np.vstack((A,-B))
+    mads = tile.dot(W) - means.dot(W)
+    chisqr = np.sum((mads/sigMADs)**2,axis=1)
+    return 1-stats.chi2.cdf(chisqr,[bands])
+
+def partial(arg):
+    '''partial statistics (sum of weights, means, centered cross products)
+       of the valid pixels in one window, with IR-MAD weights if params
+       is not None'''
+    fns,pos,offsets,window,params,step = arg
+    X, valid = read_tile(fns,pos,offsets,window,step)
+    X = np.nan_to_num(X[valid])
+    cpm = Cpm(X.shape[1])
+    if params is None:
+        cpm.update(X)
+    else:
+        cpm.update(X,madweights(X,params))
+    return cpm.moments()
+
+def covariance(fns,dims,pos,offsets=None,params=None,tile=256,pmap=map,step=1):
+    '''weighted covariance matrix and means of the bands pos of the images
+       fns over the spatial subset dims = [x0,y0,cols,rows], mapping
+       partial() over strips of tile sampled rows with pmap. step > 1:
+       systematic subsample of every step-th row'''
+    x0,y0,cols,rows = dims
+    pos = list(pos)
+    if offsets is None:
+        offsets = [(x0,y0)]*len(fns)
+    args = [(fns,pos,offsets,window,params,step) for window in tiles(cols,rows,tile*step)]
+    cpm = Cpm(len(fns)*len(pos))
+    for moments in pmap(partial,args):
+        cpm.merge(moments)
+    return cpm.covariance(), cpm.means()
+
+def get_map(executor,workers=None,push=None):
+    '''Return (map function, pool) for executor serial, threads, processes
+       or ipyparallel. The map function returns an iterator over the
+       results in order. push: dict of module level names which the
+       functions mapped on the ipyparallel engines need'''
+    if executor == 'threads':
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(max_workers=workers)
+        return pool.map, pool
+    elif executor == 'processes':
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=workers)
+        return pool.map, pool
+    elif executor == 'ipyparallel':
+        try:
+            from ipyparallel import Client
+            c = Client()
+            v = c[c.ids[:workers]]
+            print( 'available engines %s'%str(v.targets) )
+            if push is not None:
+                v.push(push,block=True)
+            return v.map_async, None
+        except Exception as e:
+            print( '%s \nFailed, so running sequentially ...'%e )
+    return map, None
@@ -3,6 +3,7 @@
 #  Name:     gamma_filter.py
 #  Purpose: ;    gamma MAP adaptive filtering for polarized SAR intensity images
 #            Ref: Oliver and Quegan (2004) Understanding SAR Images, Scitech 
+#            Whole-array implementation, processed in blocks of rows
 #  Usage:             
 #    python gamma_filter.py [OPTIONS] infile enl
 #
@@ -16,19 +17,10 @@ from ipyparallel import Client
 
 def gamma_filter(tpl): 
     k,inimage,rows,cols,m = tpl   
-    from scipy.ndimage import zoom   
-    def get_windex(j,cols):     
-        windex = np.zeros(49,dtype=int)
-        six = np.array([0,1,2,3,4,5,6])      
-        windex[0:7]   = (j-3)*cols + six
-        windex[7:14]  = (j-2)*cols + six
-        windex[14:21] = (j-1)*cols + six
-        windex[21:28] = (j)*cols   + six 
-        windex[28:35] = (j+1)*cols + six 
-        windex[35:42] = (j+2)*cols + six
-        windex[42:49] = (j+3)*cols + six
-        return windex  
-
+    import numpy as np
+    from scipy.ndimage import correlate
+#  rows processed at a time
+    blockrows = 256
     templates = np.zeros((8,7,7),dtype=int)
     for j in range(7):
         templates[0,j,0:3] = 1
@@ -45,60 +37,48 @@ def gamma_filter(tpl):
     templates[6] = np.rot90(templates[4])
     templates[7] = np.rot90(templates[5])
     
-    tmp = np.zeros((8,21),dtype=int)
-    for i in range(8):
-        tmp[i,:] = np.where(templates[i].ravel())[0] 
-    templates = tmp
-    
     edges = np.zeros((4,3,3),dtype=int)
     edges[0] = [[-1,0,1],[-1,0,1],[-1,0,1]]
     edges[1] = [[0,1,1],[-1,0,1],[-1,-1,0]]
     edges[2] = [[1,1,1],[0,0,0],[-1,-1,-1]]
     edges[3] = [[1,1,0],[1,0,-1],[0,-1,-1]]        
     result = np.copy(inimage[k])
-    arr = inimage[k].ravel()
-    zf = 3./7
-    for j in range(3,rows-3):
-        windex = get_windex(j,cols)
-        for i in range(3,cols-3):
-            g = inimage[k,j,i]            
-            wind = np.reshape(arr[windex],(7,7))
-#          3x3 compression             
-            w = zoom(wind,zf,order=1,prefilter=False)              
-#          get appropriate edge mask
-            es = [np.sum(edges[p]*w) for p in range(4)]
-            idx = np.argmax(es)  
-            if idx == 0:
-                if np.abs(w[1,1]-w[1,0]) < np.abs(w[1,1]-w[1,2]):
-                    edge = templates[0]
-                else:
-                    edge = templates[4]
-            elif idx == 1:
-                if np.abs(w[1,1]-w[2,0]) < np.abs(w[1,1]-w[0,2]):
-                    edge = templates[1]
-                else:
-                    edge = templates[5]                
-            elif idx == 2:
-                if np.abs(w[1,1]-w[0,1]) < np.abs(w[1,1]-w[2,1]):
-                    edge = templates[6]
-                else:
-                    edge = templates[2]  
-            elif idx == 3:
-                if np.abs(w[1,1]-w[0,0]) < np.abs(w[1,1]-w[2,2]):
-                    edge = templates[7]
-                else:
-                    edge = templates[3] 
-            wind = wind.ravel()[edge] 
-            var = np.var(wind)
-            if var > 0: 
-                mu = np.mean(wind)  
-                alpha = (1 +1.0/m)/(var/mu**2 - 1/m)
-                if alpha < 0:
-                    alpha = np.abs(alpha)
-                a = mu*(alpha-m-1)
-                x = (a+np.sqrt(4*g*m*alpha*mu+a**2))/(2*alpha)        
-                result[j,i] = x
-            windex += 1  
+    for j0 in range(3,rows-3,blockrows):
+        j1 = min(j0+blockrows,rows-3)
+        n = j1-j0
+#      block with 3 halo rows, all windows centred in its interior     
+        band = np.asarray(inimage[k,j0-3:j1+3],dtype=float)
+        g = band[3:-3,3:cols-3]
+#      3x3 compression of the 7x7 windows (linear zoom by 3/7 samples 
+#      the pixels at offsets -3, 0, 3)
+        w = [[band[3*p:3*p+n,3*q:3*q+cols-6] for q in range(3)] for p in range(3)]
+#      get appropriate edge mask   
+        es = [sum(edges[p,r,q]*w[r][q] for r in range(3) for q in range(3) if edges[p,r,q]) 
+              for p in range(4)]
+        idx = np.argmax(es,axis=0)
+        es = None
+        c = w[1][1]
+        edge = np.where(idx == 0, np.where(np.abs(c-w[1][0]) < np.abs(c-w[1][2]),0,4),
+               np.where(idx == 1, np.where(np.abs(c-w[2][0]) < np.abs(c-w[0][2]),1,5),
+               np.where(idx == 2, np.where(np.abs(c-w[0][1]) < np.abs(c-w[2][1]),6,2),
+                                  np.where(np.abs(c-w[0][0]) < np.abs(c-w[2][2]),7,3))))
+#      mean and variance over the selected templates            
+        mu = np.zeros((n,cols-6))
+        var = np.zeros((n,cols-6))
+        for t in range(8):
+            where = edge == t
+            if np.any(where):
+                s1 = correlate(band,templates[t]/21.0)[3:-3,3:-3]
+                s2 = correlate(band*band,templates[t]/21.0)[3:-3,3:-3]
+                np.copyto(mu,s1,where=where)
+                np.copyto(var,s2-s1*s1,where=where)
+#      gamma MAP estimate where the template variance is positive
+        pos = var > 1e-12*mu*mu
+        with np.errstate(divide='ignore',invalid='ignore'):
+            alpha = np.abs((1 +1.0/m)/(var/mu**2 - 1/m))
+            a = mu*(alpha-m-1)
+            x = (a+np.sqrt(4*g*m*alpha*mu+a**2))/(2*alpha)
+        result[j0:j1,3:cols-3] = np.where(pos,x,g)
                    
     return result          
 
@@ -215,8 +195,8 @@ enl:
         elif (bands == 4) or (bands == 2):
             print ('filtering 2 diagonal matrix element bands ...') 
 
-            outimage = map(gamma_filter,[(0,inimage,rows,cols,m),
-                                         (1,inimage,rows,cols,m)])
+            outimage = list(map(gamma_filter,[(0,inimage,rows,cols,m),
+                                              (1,inimage,rows,cols,m)]))
         else:
             print('filtering scalar image ...')
             outimage = gamma_filter((0,inimage,rows,cols,m))                             
@@ -3,18 +3,80 @@
 #  Name:     iMad.py
 #  Purpose:  Perfrom IR-MAD change detection on bitemporal, multispectral
 #            imagery 
+#            The two images are read once into a float32 pixel matrix
+#            (in memory or a temporary memmap), the weighted statistics
+#            of each iteration are accumulated block by block in parallel.
+#            Alternatively the statistics are map-reduced over image strips
+#            on a process pool or an ipyparallel cluster (auxil.tilecov).
+#            Optionally the iterations run on a growing pixel subsample
+#            until the canonical correlations are stable, followed by
+#            full resolution iterations until they are stable again
 #  Usage:             
 #    python iMad.py -h
 #
 #  Copyright (c) 2018 Mort Canty
 
 import auxil.auxil1 as auxil    
+from auxil import tilecov
 import numpy as np    
 import matplotlib.pyplot as plt
-from scipy import linalg, stats 
+from scipy import linalg
 from osgeo import gdal
 from osgeo.gdalconst import GA_ReadOnly, GDT_Float32
-import os, sys,time, getopt
+from concurrent.futures import ThreadPoolExecutor
+import os, sys,time, getopt, tempfile
+
+# image rows per block of the pixel matrix
+BLOCKROWS = 256
+
+# growth factor of the pixel subsample once the correlations are stable
+GROWTH = 4
+
+# the canonical correlations are stable when no change exceeds this
+TOL = 0.001
+
+def cache(rasterBands1,rasterBands2,x0,y0,x2,y2,cols,rows,memmap=False):
+    '''read the bitemporal image once into a float32 pixel matrix of shape
+       (rows*cols,2*bands), in memory or as a temporary memmap, and flag the
+       pixels which are nonzero in both images'''
+    bands = len(rasterBands1)
+    if memmap:
+        X = np.memmap(tempfile.TemporaryFile(),dtype=np.float32,mode='w+',
+                      shape=(rows*cols,2*bands))
+    else:
+        X = np.empty((rows*cols,2*bands),dtype=np.float32)
+    valid = np.empty(rows*cols,dtype=bool)
+    for y in range(0,rows,BLOCKROWS):
+        h = min(BLOCKROWS,rows-y)
+        block = X[y*cols:(y+h)*cols]
+        for k in range(bands):
+            block[:,k] = rasterBands1[k].ReadAsArray(x0,y0+y,cols,h).ravel()
+            block[:,bands+k] = rasterBands2[k].ReadAsArray(x2,y2+y,cols,h).ravel()
+#      eliminate no-data pixels
+        tile = np.nan_to_num(block.astype(np.float64))
+        valid[y*cols:(y+h)*cols] = (np.sum(tile[:,:bands],axis=1) != 0) \
+                                 & (np.sum(tile[:,bands:],axis=1) != 0)
+    return X, valid
+
+def statistics(X,valid,cols,params=None,workers=None):
+    '''weighted covariance matrix and means of the valid pixels of the
+       pixel matrix X, one provisional means object per block on a
+       thread pool, merged at the end'''
+    step = BLOCKROWS*cols
+    def block(i):
+        idx = valid[i:i+step]
+        tile = np.nan_to_num(X[i:i+step][idx].astype(np.float64))
+        cpm = auxil.Cpm(X.shape[1])
+        if params is None:
+            cpm.update(tile)
+        else:
+            cpm.update(tile,tilecov.madweights(tile,params))
+        return cpm
+    cpm = auxil.Cpm(X.shape[1])
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for c in ex.map(block,range(0,X.shape[0],step)):
+            cpm.merge(c)
+    return cpm.covariance(), cpm.means()
 
 def main():   
     usage = '''
@@ -33,6 +95,18 @@ Options:
    -l  <float>  regularization (default 0)
    -n           suppress graphics
    -c           append canonical variates to output
+   -m           cache the images in a temporary memmap
+                (default: in memory)
+   -e  <str>    executor for the statistics: threads (on the cached
+                images), processes or ipyparallel (image strips read
+                by the workers) (default threads)
+   -w  <int>    number of workers for the statistics
+                (default: number of CPUs or engines)
+   -f  <float>  iterate on a random pixel subsample of this
+                fraction (rows for -e processes or ipyparallel),
+                grown fourfold whenever the canonical correlations
+                are stable, then iterate at full resolution until
+                they are stable again (default 1.0: all pixels)
     
     
 The output MAD variate file is has the same format
@@ -45,13 +119,17 @@ where filename1 = path/filebasename1.ext1
 
 For ENVI files, ext1 or ext2 is the empty string.       
 -----------------------------------------------------''' %sys.argv[0]
-    options, args = getopt.getopt(sys.argv[1:],'hncl:p:i:d:')
+    options, args = getopt.getopt(sys.argv[1:],'hncml:p:i:d:e:w:f:')
     pos = None
     dims = None  
     niter = 50 
     graphics = True  
     cvs = False     
     lam = 0.0 
+    memmap = False
+    workers = None
+    executor = 'threads'
+    fraction = 1.0
     for option, value in options:
         if option == '-h':
             print(usage)
@@ -60,6 +138,14 @@ For ENVI files, ext1 or ext2 is the empty string.
             graphics = False
         elif option == '-c':
             cvs = True
+        elif option == '-m':
+            memmap = True
+        elif option == '-e':
+            executor = value
+        elif option == '-w':
+            workers = eval(value)
+        elif option == '-f':
+            fraction = eval(value)
         elif option == '-p':
             pos = eval(value)
         elif option == '-d':
@@ -72,6 +158,9 @@ For ENVI files, ext1 or ext2 is the empty string.
         print('Incorrect number of arguments')
         print(usage)
         return                                    
+    if executor not in ('threads','processes','ipyparallel'):
+        print('unknown executor %s'%executor)
+        return
     gdal.AllRegister()
     fn1 = args[0]
     fn2 = args[1]
@@ -117,49 +206,41 @@ For ENVI files, ext1 or ext2 is the empty string.
     print('first scene:  '+fn1)
     print('second scene: '+fn2)   
     start = time.time()
-#  iteration of MAD    
-    cpm = auxil.Cpm(2*bands)   
-    delta = 1.0
-    oldrho = np.zeros(bands)     
-    itr = 0
-    tile = np.zeros((cols,2*bands))
-    sigMADs = 0 
-    means1 = 0
-    means2 = 0
-    A = 0
-    B = 0
     rasterBands1 = []
     rasterBands2 = [] 
-    rhos = np.zeros((niter,bands))
     for b in pos:
         rasterBands1.append(inDataset1.GetRasterBand(b)) 
     for b in pos:
         rasterBands2.append(inDataset2.GetRasterBand(b))                    
-    while (delta > 0.001) and (itr < niter):   
-#      spectral tiling for statistics
-        for row in range(rows):
-            for k in range(bands):
-                tile[:,k] = rasterBands1[k].ReadAsArray(x0,y0+row,cols,1)
-                tile[:,bands+k] = rasterBands2[k].ReadAsArray(x2,y2+row,cols,1)
-#          eliminate no-data pixels    
-            tile = np.nan_to_num(tile)              
-            tst1 = np.sum(tile[:,0:bands],axis=1) 
-            tst2 = np.sum(tile[:,bands::],axis=1) 
-            idx1 = set(np.where(  (tst1 != 0)  )[0]) 
-            idx2 = set(np.where(  (tst2 != 0)  )[0]) 
-            idx = list(idx1.intersection(idx2))   
-            if itr>0:
-                mads = np.asarray((tile[:,0:bands]-means1)*A - (tile[:,bands::]-means2)*B)
-                chisqr = np.sum((mads/sigMADs)**2,axis=1)
-                wts = 1-stats.chi2.cdf(chisqr,[bands])
-                cpm.update(tile[idx,:],wts[idx])
-            else:
-                cpm.update(tile[idx,:])               
+    offsets = [(x0,y0),(x2,y2)]
+    if executor == 'threads':
+#      read both images once
+        X, valid = cache(rasterBands1,rasterBands2,x0,y0,x2,y2,cols,rows,memmap)
+    else:
+        X = None
+        pmap, pool = tilecov.get_map(executor,workers)
+#  random keys for nested pixel subsamples
+    subsample = fraction < 1.0
+    if subsample:
+        print('sample fraction: %f'%fraction)
+        if X is not None:
+            keys = np.random.default_rng().integers(0,65536,X.shape[0],dtype=np.uint16)
+            sample = valid & (keys < max(fraction*65536,1))
+#  iteration of MAD    
+    delta = 1.0
+    oldrho = np.zeros(bands)     
+    itr = 0
+    params = None
+    rhos = np.zeros((niter+1,bands))
+    while True:   
 #      weighted covariance matrices and means 
-        S = cpm.covariance() 
-        means = cpm.means()    
-#      reset prov means object           
-        cpm.__init__(2*bands)  
+        if X is not None:
+            mask = sample if fraction < 1.0 else valid
+            S, means = statistics(X,mask,cols,params,workers)
+        else:
+            step = max(int(round(1/fraction)),1)
+            S, means = tilecov.covariance([fn1,fn2],[x0,y0,cols,rows],pos,
+                                  offsets,params,BLOCKROWS,pmap,step)
         s11 = S[0:bands,0:bands]
         s11 = (1-lam)*s11 + lam*np.identity(bands)
         s22 = S[bands:,bands:] 
@@ -195,10 +276,6 @@ For ENVI files, ext1 or ext2 is the empty string.
         delta = max(abs(rho-oldrho))
         rhos[itr,:] = rho
         oldrho = rho  
-#      tile the sigmas and means             
-        sigMADs = np.tile(sigma,(cols,1)) 
-        means1 = np.tile(means[0:bands],(cols,1)) 
-        means2 = np.tile(means[bands::],(cols,1))
 #      ensure sum of positive correlations between X and U is positive
         D = np.diag(1/np.sqrt(np.diag(s11)))
         s = np.ravel(np.sum(D*s11*A,axis=0)) 
@@ -206,7 +283,28 @@ For ENVI files, ext1 or ext2 is the empty string.
 #      ensure positive correlation between each pair of canonical variates        
         cov = np.diag(A.T*s12*B)    
         B = B*np.diag(cov/np.abs(cov))          
+#      transformation for the weights of the next iteration
+        params = (means,np.asarray(A),np.asarray(B),np.asarray(sigma).ravel())
         itr += 1    
+        if (delta < TOL) or (itr >= niter):
+            if fraction >= 1.0:
+                break
+#          correlations stable, grow the subsample            
+            fraction = min(GROWTH*fraction,1.0) if itr < niter else 1.0
+            if fraction < 1.0:
+                print('iteration %i, sample fraction: %f'%(itr,fraction))
+                if X is not None:
+                    sample = valid & (keys < max(fraction*65536,1))
+            else:
+                print('iteration %i, full resolution'%itr)
+                rhosample = rho
+#              converged only when two full resolution iterations agree
+                oldrho = np.zeros(bands)
+    if X is None and pool is not None:
+        pool.shutdown()
+    if subsample:
+        print('rho (last subsample): %s'%str(rhosample))
+        print('rho difference converged full resolution - last subsample: %s'%str(rho-rhosample))
 #  canonical correlations          
     print('rho: %s'%str(rho)) 
        
@@ -230,22 +328,25 @@ For ENVI files, ext1 or ext2 is the empty string.
         outDataset.SetGeoTransform(tuple(gt))
     if projection is not None:
         outDataset.SetProjection(projection)            
-    for row in range(rows):
-        for k in range(bands):
-            tile[:,k] = rasterBands1[k].ReadAsArray(x0,y0+row,cols,1)
-            tile[:,bands+k] = rasterBands2[k].ReadAsArray(x2,y2+row,cols,1)     
-            cv1 = (tile[:,0:bands]-means1)*A 
-            cv2 = (tile[:,bands::]-means2)*B
-        mads = np.asarray(cv1 - cv2)
-        chisqr = np.sum((mads/(sigMADs))**2,axis=1) 
+    means, A, B, sigMADs = params
+    for y in range(0,rows,BLOCKROWS):
+        h = min(BLOCKROWS,rows-y)
+        if X is not None:
+            tile = X[y*cols:(y+h)*cols].astype(np.float64)
+        else:
+            tile, _ = tilecov.read_tile([fn1,fn2],pos,offsets,(0,y,cols,h))
+        cv1 = (tile[:,0:bands]-means[0:bands]).dot(A)
+        cv2 = (tile[:,bands::]-means[bands::]).dot(B)
+        mads = cv1 - cv2
+        chisqr = np.sum((mads/sigMADs)**2,axis=1) 
         for k in range(bands):
-            outBands[k].WriteArray(np.reshape(mads[:,k],(1,cols)),0,row)
-        outBands[bands].WriteArray(np.reshape(chisqr,(1,cols)),0,row)  
+            outBands[k].WriteArray(np.reshape(mads[:,k],(h,cols)),0,y)
+        outBands[bands].WriteArray(np.reshape(chisqr,(h,cols)),0,y)  
         if cvs:
             for k in range(bands+1,2*bands+1):
-                outBands[k].WriteArray(np.reshape(cv1[:,k-bands-1],(1,cols)),0,row)
+                outBands[k].WriteArray(np.reshape(cv1[:,k-bands-1],(h,cols)),0,y)
             for k in range(2*bands+1,3*bands+1):
-                outBands[k].WriteArray(np.reshape(cv2[:,k-2*bands-1],(1,cols)),0,row)                                     
+                outBands[k].WriteArray(np.reshape(cv2[:,k-2*bands-1],(h,cols)),0,y)                                     
     for outBand in outBands: 
         outBand.FlushCache()
     outDataset = None
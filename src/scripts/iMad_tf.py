@@ -1,5 +1,15 @@
 #!/usr/bin/env python
 # coding: utf-8
+#******************************************************************************
+#  Name:     iMad_tf.py
+#  Purpose:  IR-MAD on the tensorflow API. The pixels of the two images are
+#            streamed through a tf.data pipeline in batches of image rows,
+#            so the scenes need not fit into memory. The weighted moments
+#            of each iteration are accumulated by a compiled reduction over
+#            the batches, the iterations stop when the canonical
+#            correlations change by less than a tolerance
+#  Usage:
+#    python iMad_tf.py -h
 
 import tensorflow as tf
 import tensorflow_probability as tfp
@@ -10,12 +20,15 @@ import getopt, sys, os, time
 
 tfd = tfp.distributions
 
-def read_image(fn,dims=None,pos=None):
-#  read image into data matrix    
+def image_dataset(fn1,fn2,dims=None,pos=None,batchrows=256,cache=False):
+    '''tf.data pipeline of (row, pixels of fn1, pixels of fn2) for strips
+       of batchrows image rows, read from disk as they are needed (or
+       cached in memory after the first pass). Returns the dataset and
+       (cols,rows,bands,inDataset,x0,y0) of fn2'''
     gdal.AllRegister()
-    inDataset = gdal.Open(fn,GA_ReadOnly)
+    inDataset = gdal.Open(fn2,GA_ReadOnly)
     cols = inDataset.RasterXSize
-    rows = inDataset.RasterYSize    
+    rows = inDataset.RasterYSize
     bands = inDataset.RasterCount
     if dims:
         x0,y0,cols,rows = tuple(dims)
@@ -25,115 +38,196 @@ def read_image(fn,dims=None,pos=None):
     if pos is not None:
         bands = len(pos)
     else:
-        pos = range(1,bands+1)           
-    G = np.zeros((rows*cols,bands))
-    k = 0                               
-    for b in pos:
-        band = inDataset.GetRasterBand(b)
-        G[:,k] = band.ReadAsArray(x0,y0,cols,rows).astype(float).ravel()
-        k += 1      
-    return (G,cols,rows,bands,inDataset,x0,y0)
-
-def tf_covw(x,ws):
-    '''weighted covariance matrix and weighted means of uncentered data tensor x'''  
-    x = tf.transpose(x) # transposed data matrix
-    S = tf.shape(x)
-    N = S[0]
-    sumw = tf.reduce_sum(ws)
-    ws = tf.reshape( tf.tile(ws,[N]), S ) 
-    xw = tf.multiply(x,ws)
-    mx = tf.divide( tf.reduce_sum(xw, axis=1, keepdims=True), sumw )
-    mx1 = tf.matmul(mx,tf.transpose(mx))
-    xw = tf.multiply(x,tf.sqrt(ws))
-    vx = tf.matmul(xw, tf.transpose(xw))/sumw
-    return vx-mx1, mx
+        pos = range(1,bands+1)
+    pos = list(pos)
+    def strips():
+        inDatasets = [gdal.Open(fn,GA_ReadOnly) for fn in (fn1,fn2)]
+        for y in range(0,rows,batchrows):
+            h = min(batchrows,rows-y)
+            x1, x2 = [np.stack([ds.GetRasterBand(b).ReadAsArray(x0,y0+y,cols,h).astype(float).ravel()
+                                for b in pos],axis=1) for ds in inDatasets]
+            yield y, x1, x2
+    spec = tf.TensorSpec(shape=(None,bands),dtype=tf.float64)
+    dataset = tf.data.Dataset.from_generator(strips,
+                output_signature=(tf.TensorSpec(shape=(),dtype=tf.int64),spec,spec))
+    if cache:
+        dataset = dataset.cache()
+    return dataset.prefetch(tf.data.AUTOTUNE), (cols,rows,bands,inDataset,x0,y0)
 
 def geneiv(A,B):
-    '''solves A*x = lambda*B*x for tensors A, B 
+    '''solves A*x = lambda*B*x for tensors A, B
        returns eigenvectors in columns'''
     Li = tf.linalg.inv(tf.linalg.cholesky(B))
     C = tf.matmul(tf.matmul(Li,A),Li,transpose_b=True)
     lambdas,V = tf.linalg.eigh(C)
     return lambdas, tf.matmul(tf.transpose(Li),V)
 
-def imad(x1,x2,pvs,niter):  
-    '''IR.MAD algorithm'''
-    m = tf.shape(x1)[0]
-    N = tf.shape(x1)[1]
-    x = tf.concat([x1,x2],axis=1)
+@tf.function
+def mads(x1,x2,ms1,ms2,A,B,sig2s):
+    '''MAD variates and chi-square values of the pixels x1, x2,
+       the means and variances are broadcast over the pixels'''
+    MADs = tf.matmul(x1-ms1,A) - tf.matmul(x2-ms2,B)
+    chisqr = tf.reduce_sum(tf.square(MADs)/sig2s, axis=1)
+    return MADs, chisqr
+
+@tf.function
+def moments(dataset,ms1,ms2,A,B,sig2s,fraction):
+    '''sum of weights, weighted means and centered cross products of the
+       pixels of dataset (of a random subsample for fraction < 1), the
+       weights are the no-change probabilities for the transformation
+       ms1,ms2,A,B,sig2s. Batches are merged with the formulas of Chan,
+       Golub and LeVeque'''
+    N = tf.shape(A)[0]
+    chi2 = tfd.Chi2(tf.cast(N,tf.float64))
+    def accumulate(state,batch):
+        sw, mn, M2 = state
+        y, x1, x2 = batch
+    #  the same keys in every pass, so the subsamples are nested
+        keys = tf.random.stateless_uniform(tf.shape(x1)[:1],
+                   seed=tf.stack([y,tf.constant(0,tf.int64)]),dtype=tf.float64)
+        sample = keys < fraction
+        x1 = tf.boolean_mask(x1,sample)
+        x2 = tf.boolean_mask(x2,sample)
+        _, chisqr = mads(x1,x2,ms1,ms2,A,B,sig2s)
+        ws = chi2.survival_function(chisqr)
+        x = tf.concat([x1,x2],axis=1)
+    #  batch moments
+        swb = tf.reduce_sum(ws)
+        mnb = tf.math.divide_no_nan(tf.linalg.matvec(x,ws,transpose_a=True),swb)
+        d = x - mnb
+        M2b = tf.matmul(d*ws[:,tf.newaxis],d,transpose_a=True)
+    #  merge
+        total = sw + swb
+        delta = mnb - mn
+        mn = mn + delta*tf.math.divide_no_nan(swb,total)
+        M2 = M2 + M2b + tf.tensordot(delta,delta,axes=0)*tf.math.divide_no_nan(sw*swb,total)
+        return total, mn, M2
+    state = (tf.constant(0.0,dtype=tf.float64),
+             tf.zeros([2*N],dtype=tf.float64),
+             tf.zeros([2*N,2*N],dtype=tf.float64))
+    return dataset.reduce(state,accumulate)
+
+@tf.function
+def transform(sw,mn,M2):
+    '''MAD transformation from the weighted moments'''
+    N = tf.shape(mn)[0]//2
+    cov = M2/sw
+    ms1 = mn[:N]
+    ms2 = mn[N:]
+    s11 = cov[:N,:N]
+    s12 = cov[:N,N:]
+    s21 = cov[N:,:N]
+    s22 = cov[N:,N:]
+    c1 = tf.matmul(tf.matmul(s12,tf.linalg.inv(s22)),s21)
+    b1 = s11
+    c2 = tf.matmul(tf.matmul(s21,tf.linalg.inv(s11)),s12)
+    b2 = s22
+    rho2,A = geneiv(c1,b1)
+    _   ,B = geneiv(c2,b2)
+    rho = tf.sqrt(rho2[::-1])
+    A = A[:,::-1]
+    B = B[:,::-1]
+#  ensure positive correlation between each pair of canonical variates
+    cov = tf.linalg.diag_part(tf.matmul(tf.matmul(tf.transpose(A),s12),B))
+    B = B*tf.divide(cov,tf.abs(cov))
+    return ms1, ms2, A, B, rho, 2*(1-rho)
+
+def imad(dataset,N,niter=50,fraction=1.0,tol=0.001):
+    '''IR.MAD algorithm over the batches of dataset, stops when the
+       canonical correlations change by less than tol. fraction < 1: the
+       iterations run on a random pixel subsample, grown fourfold whenever
+       the canonical correlations are stable, followed by full resolution
+       iterations until they are stable again. Returns the transformation
+       (ms1,ms2,A,B,sig2s) and the canonical correlations'''
+#  unit weights in the first iteration (chi-square values zero)
+    ms1 = tf.zeros([N],dtype=tf.float64)
+    ms2 = tf.zeros([N],dtype=tf.float64)
+    A = tf.zeros([N,N],dtype=tf.float64)
+    B = tf.zeros([N,N],dtype=tf.float64)
+    sig2s = tf.ones([N],dtype=tf.float64)
+    oldrho = tf.zeros([N],dtype=tf.float64)
+    subsample = fraction < 1.0
     itr = 0
-    while itr<niter:
-        itr += 1 
-    #  weighted covariance and means    
-        cov,ms = tf_covw(x,pvs)
-        ms1 = tf.transpose(ms[:N]) #row vectors
-        ms2 = tf.transpose(ms[N:])
-        s11 = cov[:N,:N]
-        s12 = cov[:N,N:]
-        s21 = cov[N:,:N]
-        s22 = cov[N:,N:]
-        c1 = tf.matmul(tf.matmul(s12,tf.linalg.inv(s22)),s21)
-        b1 = s11
-        c2 = tf.matmul(tf.matmul(s21,tf.linalg.inv(s11)),s12)
-        b2 = s22
-        rho2,A = geneiv(c1,b1)
-        _   ,B = geneiv(c2,b2)
-        rho = tf.sqrt(rho2[::-1])
-        A = A[:,::-1]  
-        B = B[:,::-1]
-    #  ensure positive correlation between each pair of canonical variates        
-        cov = tf.linalg.diag_part(tf.matmul(tf.matmul(tf.transpose(A),s12),B))
-        cov = tf.linalg.diag(tf.divide(cov,tf.abs(cov)))
-        B = tf.matmul(B,cov)  
-    #  calculate p-value weights
-        sig2s = 2*(1-rho)
-        sig2s = tf.reshape( tf.tile(sig2s,[m]), (m,N) )
-        ms1 = tf.reshape( tf.tile(ms1[0],[m]), (m,N) )
-        ms2 = tf.reshape( tf.tile(ms2[0],[m]), (m,N) )
-        CV1 = tf.matmul( x1-ms1, A )
-        CV2 = tf.matmul( x2-ms2, B )
-        MADs = CV1 - CV2
-        chisqr = tf.reduce_sum(tf.square(MADs)/sig2s, axis=1) 
-        N1 = tf.cast(N,dtype=tf.float64)
-        one = tf.constant(1.0,dtype=tf.float64)
-        pvs = tf.subtract(one,tfd.Chi2(N1).cdf(chisqr))
-    return (MADs, chisqr, rho)
-
-def main():   
+    while True:
+        itr += 1
+        sw, mn, M2 = moments(dataset,ms1,ms2,A,B,sig2s,tf.constant(fraction,dtype=tf.float64))
+        ms1, ms2, A, B, rho, sig2s = transform(sw,mn,M2)
+        delta = float(tf.reduce_max(tf.abs(rho-oldrho)))
+        oldrho = rho
+        if fraction < 1.0:
+            rhosample = rho
+        if (delta < tol) or (itr >= niter):
+            if fraction >= 1.0:
+                break
+    #      correlations stable, grow the subsample
+            fraction = min(4*fraction,1.0) if itr < niter else 1.0
+            if fraction < 1.0:
+                print('iteration %i, sample fraction: %f'%(itr,fraction))
+            else:
+                print('iteration %i, full resolution'%itr)
+    #          converged only when two full resolution iterations agree
+                oldrho = tf.zeros([N],dtype=tf.float64)
+    print('iterations: %i'%itr)
+    if subsample:
+        print('rho (last subsample): %s'%str(rhosample.numpy()))
+        print('rho difference converged full resolution - last subsample: %s'%str((rho-rhosample).numpy()))
+    return (ms1, ms2, A, B, sig2s), rho
+
+def main():
     usage = '''
 Usage:
 ------------------------------------------------
 Run the iterated MAD algorithm on two multispectral images
-on the tensorflow API   
+on the tensorflow API
 
 python %s [OPTIONS] filename1 filename2
-    
+
 Options:
    -h           this help
    -i  <int>    maximum iterations (default 50)
+   -t  <float>  tolerance for the change in the canonical
+                correlations (default 0.001)
    -d  <list>   spatial subset list e.g. -d [0,0,500,500]
-   -p  <list>   spectral subset list e.g. -p [1,2,3,4] 
-   -s  <string> TF session e.g. -s grpc://localhost:2222 (defaults to default_session)
+   -p  <list>   spectral subset list e.g. -p [1,2,3,4]
+   -f  <float>  iterate on a random pixel subsample of this fraction,
+                grown fourfold whenever the canonical correlations
+                are stable, then iterate at full resolution until
+                they are stable again (default 1.0: all pixels)
+   -b  <int>    image rows per batch (default 256)
+   -c           cache the batches in memory after the first pass
+                (default: read from disk in every iteration)
 -----------------------------------------------------''' %sys.argv[0]
-    options, args = getopt.getopt(sys.argv[1:],'hi:d:p:')
-    dims = None 
-    pos = None 
+    options, args = getopt.getopt(sys.argv[1:],'hci:t:d:p:f:b:')
+    dims = None
+    pos = None
     niter = 50
+    tol = 0.001
+    fraction = 1.0
+    batchrows = 256
+    cache = False
     for option, value in options:
         if option == '-h':
             print(usage)
             return
         elif option == '-i':
-            niter = eval(value) 
+            niter = eval(value)
+        elif option == '-t':
+            tol = eval(value)
         elif option == '-d':
-            dims = eval(value) 
+            dims = eval(value)
         elif option == '-p':
             pos = eval(value)
-            
+        elif option == '-f':
+            fraction = eval(value)
+        elif option == '-b':
+            batchrows = eval(value)
+        elif option == '-c':
+            cache = True
+
     if len(args) != 2:
         print('Incorrect number of arguments')
         print(usage)
-        return                                    
+        return
     fn1 = args[0]
     fn2 = args[1]
     path = os.path.dirname(fn1)
@@ -141,30 +235,24 @@ Options:
     root1, _ = os.path.splitext(basename1)
     basename2 = os.path.basename(fn2)
     root2, _ = os.path.splitext(basename2)
-    outfn = path + '/' + 'MAD_%s-%s%s'%(root1,root2,'.tif') 
-    
+    outfn = path + '/' + 'MAD_%s-%s%s'%(root1,root2,'.tif')
+
     print('------------IRMAD (tensorflow) -------------')
-    print(time.asctime())     
+    print(time.asctime())
     print('first scene:  '+fn1)
-    print('second scene: '+fn2)   
-    start = time.time()    
-
-
-    img1,_,_,_,_,_,_ = read_image(fn1,dims=dims,pos=pos)
-    img2,cols,rows,bands,inDataset,x0,y0 = read_image(fn2,dims=dims,pos=pos)
-    m,_ = img1.shape
-    pvs = np.ones(m)
-    
-    MADs,chisqr,rho = imad(img1,img2,pvs,niter)
-    MADs = np.reshape(MADs,(rows,cols,bands))
-    chisqr = np.reshape(chisqr,(rows,cols))
-    
-    print('canonical corr: %s'%str(rho))
-    
+    print('second scene: '+fn2)
+    start = time.time()
+
+    dataset,(cols,rows,bands,inDataset,x0,y0) = image_dataset(fn1,fn2,dims,pos,batchrows,cache)
+
+    (ms1,ms2,A,B,sig2s),rho = imad(dataset,bands,niter,fraction,tol)
+
+    print('canonical corr: %s'%str(rho.numpy()))
+
     driver = gdal.GetDriverByName('GTiff')
     outDataset = driver.Create(outfn,
-                cols,rows,bands+1,GDT_Float32)      
-    
+                cols,rows,bands+1,GDT_Float32)
+
     projection = inDataset.GetProjection()
     geotransform = inDataset.GetGeoTransform()
     if geotransform is not None:
@@ -173,19 +261,22 @@ Options:
         gt[3] = gt[3] + y0*gt[5]
         outDataset.SetGeoTransform(tuple(gt))
     if projection is not None:
-        outDataset.SetProjection(projection)     
-        
-    for k in range(bands):        
-        outBand = outDataset.GetRasterBand(k+1)
-        outBand.WriteArray(MADs[:,:,k],0,0) 
-        outBand.FlushCache() 
-    outBand = outDataset.GetRasterBand(bands+1)
-    outBand.WriteArray(chisqr,0,0) 
-    outBand.FlushCache()
-    print('MAD variates written to: %s'%outfn)  
+        outDataset.SetProjection(projection)
+
+#  stream the MAD variates and chi-square values to disk
+    for y,x1,x2 in dataset:
+        MADs,chisqr = mads(x1,x2,ms1,ms2,A,B,sig2s)
+        y = int(y)
+        h = x1.shape[0]//cols
+        MADs = np.reshape(MADs.numpy(),(h,cols,bands))
+        for k in range(bands):
+            outDataset.GetRasterBand(k+1).WriteArray(MADs[:,:,k],0,y)
+        outDataset.GetRasterBand(bands+1).WriteArray(np.reshape(chisqr.numpy(),(h,cols)),0,y)
+    for k in range(bands+1):
+        outDataset.GetRasterBand(k+1).FlushCache()
+    print('MAD variates written to: %s'%outfn)
     print('elapsed time: %s'%str(time.time()-start))
     outDataset = None
-    
-if __name__ == '__main__':
-    main()    
 
+if __name__ == '__main__':
+    main()
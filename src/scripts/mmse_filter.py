@@ -5,14 +5,16 @@
 #    for polSAR covariance images
 #    Lee et al. (1999) IEEE TGARS 37(5), 2363-2373
 #    Oliver and Quegan (2004) Understanding SAR Images, Scitech 
+#    Whole-array implementation streaming over blocks of rows
 #  Usage:             
 #    python mmse_filter.py [OPTIONS] infile enl
 #
 #  Copyright (c) 2018, Mort Canty
 
-import auxil.congrid as congrid
+import auxil.hermitian as hermitian
 import os, sys, time, getopt
 import numpy as np
+from scipy.ndimage import correlate, correlate1d, map_coordinates
 from osgeo import gdal
 from osgeo.gdalconst import GA_ReadOnly, GDT_Float32
 
@@ -32,30 +34,56 @@ templates[5] = np.rot90(templates[3])
 templates[6] = np.rot90(templates[4])
 templates[7] = np.rot90(templates[5])
 
-tmp = np.zeros((8,21),dtype=int)
-for i in range(8):
-    tmp[i,:] = np.where(templates[i].ravel())[0] 
-templates = tmp
-
 edges = np.zeros((4,3,3),dtype=int)
 edges[0] = [[-1,0,1],[-1,0,1],[-1,0,1]]
 edges[1] = [[0,1,1],[-1,0,1],[-1,-1,0]]
 edges[2] = [[1,1,1],[0,0,0],[-1,-1,-1]]
 edges[3] = [[1,1,0],[1,0,-1],[0,-1,-1]]   
-    
-   
-def get_windex(j,cols):
-#  first window for row j    
-    windex = np.zeros(49,dtype=int)
-    six = np.array([0,1,2,3,4,5,6])
-    windex[0:7]   = (j-3)*cols + six
-    windex[7:14]  = (j-2)*cols + six
-    windex[14:21] = (j-1)*cols + six
-    windex[21:28] = (j)*cols   + six 
-    windex[28:35] = (j+1)*cols + six 
-    windex[35:42] = (j+2)*cols + six
-    windex[42:49] = (j+3)*cols + six
-    return windex
+
+# the 3x3 compression congrid.congrid(wind,(3,3),method='spline',centre=True)
+# of a 7x7 window is separable and linear: w = P.wind.P^T 
+P = np.array([map_coordinates(np.eye(7)[i],[(np.arange(3)+0.5)*7/3.-0.5]) 
+              for i in range(7)]).T
+
+# rows processed at a time
+BLOCKROWS = 256
+
+def template_means(band,t):
+#  mean over template t for all 7x7 windows of band    
+    return correlate(band,templates[t]/21.0)[3:-3,3:-3]
+
+def edge_weights(span,m):
+    '''edge (template) index and filter weights b for the windows centred
+       in the interior of the span image block (3 halo rows/cols)'''
+    rows, cols = span.shape[0]-6, span.shape[1]-6
+#  3x3 compression: w[p][q] for all windows
+    r = [correlate1d(span,P[p],axis=0)[3:-3] for p in range(3)]
+    w = [[correlate1d(r[p],P[q],axis=1)[:,3:-3] for q in range(3)] for p in range(3)]
+    r = None
+#  get appropriate edge mask
+    es = [sum(edges[p,i,j]*w[i][j] for i in range(3) for j in range(3) if edges[p,i,j]) 
+          for p in range(4)]
+    idx = np.argmax(es,axis=0)
+    es = None
+    c = w[1][1]
+    edge_idx = np.where(idx == 0, np.where(np.abs(c-w[1][0]) < np.abs(c-w[1][2]),0,4),
+               np.where(idx == 1, np.where(np.abs(c-w[2][0]) < np.abs(c-w[0][2]),1,5),
+               np.where(idx == 2, np.where(np.abs(c-w[0][1]) < np.abs(c-w[2][1]),6,2),
+                                  np.where(np.abs(c-w[0][0]) < np.abs(c-w[2][2]),7,3))))
+#  template mean and variance of the span
+    gbar = np.zeros((rows,cols))
+    varg = np.zeros((rows,cols))
+    for t in range(8):
+        where = edge_idx == t
+        if np.any(where):
+            mean = template_means(span,t)
+            np.copyto(gbar,mean,where=where)
+            np.copyto(varg,template_means(span*span,t)-mean*mean,where=where)
+    b = np.ones((rows,cols))
+    pos = varg > 1e-12*gbar*gbar
+    with np.errstate(divide='ignore',invalid='ignore'):
+        np.copyto(b,np.maximum((1.0 - gbar**2/(varg*m))/(1.0+1.0/m),0.0),where=pos)
+    return edge_idx, b
 
 def mmse_filter(infile, m, dims=None):
     gdal.AllRegister()                  
@@ -70,72 +98,14 @@ def mmse_filter(infile, m, dims=None):
     basename = os.path.basename(infile)
     root, ext = os.path.splitext(basename)
     outfile = path + '/' + root + '_mmse' + ext  
-#  get filter weights from span image
-    b = np.ones((rows,cols))
-    band = inDataset.GetRasterBand(1)
-    span = band.ReadAsArray(x0,y0,cols,rows).ravel()
-    if bands==9:      
-        band = inDataset.GetRasterBand(6)
-        span += band.ReadAsArray(x0,y0,cols,rows).ravel()
-        band = inDataset.GetRasterBand(9)
-        span += band.ReadAsArray(x0,y0,cols,rows).ravel()
-    elif bands==4:
-        band = inDataset.GetRasterBand(4)
-        span += band.ReadAsArray(x0,y0,cols,rows).ravel()    
-    elif bands==2:
-        band = inDataset.GetRasterBand(2)
-        span += band.ReadAsArray(x0,y0,cols,rows).ravel()            
-    edge_idx = np.zeros((rows,cols),dtype=int)
     print ('=========================')
     print ('       MMSE_FILTER')
     print ('=========================')
     print (time.asctime())
     print ('infile:  %s'%infile)
     print ('number of looks: %f'%m)     
-    print ('Determining filter weights from span image')    
+    print ('Filtering covariance matrix elements in blocks of %i rows'%BLOCKROWS)    
     start = time.time()
-    print( 'row: ',end=' ')   
-    for j in range(3,rows-3):
-        if j%100 == 0:
-            print( '%i '%j,end=' ') 
-        windex = get_windex(j,cols)
-        for i in range(3,cols-3):            
-            wind = np.reshape(span[windex],(7,7))         
-#          3x3 compression
-            w = congrid.congrid(wind,(3,3),method='spline',centre=True)
-#          get appropriate edge mask
-            es = [np.sum(edges[p]*w) for p in range(4)]
-            idx = np.argmax(es)  
-            if idx == 0:
-                if np.abs(w[1,1]-w[1,0]) < np.abs(w[1,1]-w[1,2]):
-                    edge_idx[j,i] = 0
-                else:
-                    edge_idx[j,i] = 4
-            elif idx == 1:
-                if np.abs(w[1,1]-w[2,0]) < np.abs(w[1,1]-w[0,2]):
-                    edge_idx[j,i] = 1
-                else:
-                    edge_idx[j,i] = 5                
-            elif idx == 2:
-                if np.abs(w[1,1]-w[0,1]) < np.abs(w[1,1]-w[2,1]):
-                    edge_idx[j,i] = 6
-                else:
-                    edge_idx[j,i] = 2  
-            elif idx == 3:
-                if np.abs(w[1,1]-w[0,0]) < np.abs(w[1,1]-w[2,2]):
-                    edge_idx[j,i] = 7
-                else:
-                    edge_idx[j,i] = 3 
-            edge = templates[edge_idx[j,i]]  
-            wind = wind.ravel()[edge]
-            gbar = np.mean(wind)
-            varg = np.var(wind)
-            if varg > 0:
-                b[j,i] = np.max( ((1.0 - gbar**2/(varg*m))/(1.0+1.0/m), 0.0) )        
-            windex += 1
-    print( ' done')        
-#  filter the image
-    outim = np.zeros((rows,cols),dtype=np.float32)
     driver = inDataset.GetDriver()    
     outDataset = driver.Create(outfile,cols,rows,bands,GDT_Float32)
     geotransform = inDataset.GetGeoTransform()
@@ -147,26 +117,33 @@ def mmse_filter(infile, m, dims=None):
     projection = inDataset.GetProjection()        
     if projection is not None:
         outDataset.SetProjection(projection) 
-    print('Filtering covariance matrix elements')  
-    for k in range(1,bands+1):
-        print( 'band: %i'%(k))
-        band = inDataset.GetRasterBand(k)
-        band = band.ReadAsArray(0,0,cols,rows)
-        gbar = band*0.0
-#      get window means
-        for j in range(3,rows-3):        
-            windex = get_windex(j,cols)
-            for i in range(3,cols-3):
-                wind = band.ravel()[windex]
-                edge = templates[edge_idx[j,i]]
-                wind = wind[edge]
-                gbar[j,i] = np.mean(wind)
-                windex += 1
-#      apply adaptive filter and write to disk
-        outim = np.reshape(gbar + b*(band-gbar),(rows,cols))   
-        outBand = outDataset.GetRasterBand(k)
-        outBand.WriteArray(outim,0,0) 
-        outBand.FlushCache() 
+    print( 'row: ',end=' ')   
+    for j0 in range(0,rows,BLOCKROWS):
+        print( '%i '%j0,end=' ') 
+        j1 = min(j0+BLOCKROWS,rows)
+#      block with (up to) 3 halo rows   
+        ja = max(j0-3,0)
+        jb = min(j1+3,rows)
+        img = [inDataset.GetRasterBand(i+1).ReadAsArray(x0,y0+ja,cols,jb-ja).astype(float) 
+               for i in range(bands)]
+#      filter weights from the span image, pixels closer than 3 to the 
+#      image border are not filtered            
+        edge_idx = np.zeros((jb-ja,cols),dtype=int)
+        b = np.ones((jb-ja,cols))
+        if (jb-ja > 6) and (cols > 6):
+            edge_idx[3:-3,3:-3], b[3:-3,3:-3] = edge_weights(hermitian.span(img),m)
+        for k in range(bands):
+            band = img[k]
+            gbar = band*0.0
+            for t in range(8):
+                np.copyto(gbar[3:-3,3:-3],template_means(band,t),where=edge_idx[3:-3,3:-3]==t)
+#          apply adaptive filter and write to disk
+            outim = gbar + b*(band-gbar)   
+            outBand = outDataset.GetRasterBand(k+1)
+            outBand.WriteArray(outim[j0-ja:j1-ja],0,j0) 
+    print( ' done')        
+    for k in range(bands):
+        outDataset.GetRasterBand(k+1).FlushCache() 
     outDataset = None
     print( 'result written to: '+outfile) 
     print( 'elapsed time: '+str(time.time()-start))     
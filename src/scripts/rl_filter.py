@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#******************************************************************************
+#  Name:     rl_filter.py
+#  Purpose:  refined Lee speckle filter for SAR intensity images, a local
+#            NumPy version of the Earth Engine filter auxil/eeRL.rl
+#            (transcribed from G. Lemoine's 2017 JavaScript implementation).
+#            All window statistics are sums over the kernel rows taken from
+#            row-wise cumulative sums, the image is processed in strips and
+#            the bands in parallel. At the image border, as with the masked
+#            pixels outside an Earth Engine image, the statistics of each
+#            window (including the sampled 3x3 windows around a pixel) are
+#            taken over the pixels inside the image only. In the outermost
+#            rows and columns some sampled windows have no such pixels and
+#            the input value is kept, as for other pixels left masked
+#  Usage:
+#    python rl_filter.py [OPTIONS] infile
+#
+# MIT License
+#
+# Copyright (c) 2018 Mort Canty
+
+import os, sys, time, getopt
+import numpy as np
+from osgeo import gdal
+from osgeo.gdalconst import GA_ReadOnly, GDT_Float32
+from concurrent.futures import ThreadPoolExecutor
+
+# 3x3 window within the 7x7 window
+kernel3 = np.zeros((7,7),dtype=int)
+kernel3[2:5,2:5] = 1
+# directional kernels, anchored at the centre
+rect_kernel = np.zeros((7,7),dtype=int)
+rect_kernel[3:,:] = 1
+diag_kernel = np.tril(np.ones((7,7),dtype=int))
+# kernels for the directions 1 ... 8, ee.Kernel.rotate(i) turns clockwise
+kernels = []
+for i in range(4):
+    kernels += [np.rot90(rect_kernel,-i), np.rot90(diag_kernel,-i)]
+
+# halo rows needed around a strip
+HALO = 3
+
+def windowsum(S,kernel,rows,cols):
+    '''sums over the 7x7 0/1 kernel (rows of consecutive ones) for an output
+       of shape (rows,cols), given the row-wise cumulative sums S with a
+       leading zero column of the image padded by 3 all round'''
+    out = np.zeros((rows,cols))
+    for r in range(7):
+        c = np.nonzero(kernel[r])[0]
+        if c.size:
+            out += S[r:r+rows,c[-1]+1:c[-1]+1+cols]
+            out -= S[r:r+rows,c[0]:c[0]+cols]
+    return out
+
+def rl(img):
+    '''refined Lee filter of a single band img in natural units as in
+       auxil/eeRL.rl. As in Earth Engine, pixels outside the image are
+       ignored in the window statistics, pixels which Earth Engine leaves
+       masked (undefined statistics, ties in the maximum gradient) keep
+       their input value'''
+    img = np.nan_to_num(np.asarray(img,dtype=np.float64))
+    rows, cols = img.shape
+#  row-wise cumulative sums of pixel count (zero outside the image), intensity 
+#  and squared intensity, padded by 5 for the sampled 3x3 windows
+    S = [np.cumsum(np.pad(np.pad(a,5),((0,0),(1,0))),axis=1)
+         for a in (np.ones_like(img),img,img*img)]
+    def stats(kernel,extend=0):
+#      window statistics over the image extended by extend pixels all round,
+#      undefined (nan) for windows without pixels inside the image
+        Se = [s[2-extend:s.shape[0]-2+extend,2-extend:] for s in S]
+        n, s1, s2 = [windowsum(s,kernel,rows+2*extend,cols+2*extend) for s in Se]
+        mean = s1/n
+        return mean, np.maximum(s2/n-mean*mean,0.0)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        pm, pv = stats(kernel3,2)
+#      mean and variance of the sampled 3x3 windows inside the 7x7 window
+#      in the band order of ee.Image.neighborhoodToBands()
+        sample_mean = np.array([pm[dy:dy+rows,dx:dx+cols] for dy in (0,2,4) for dx in (0,2,4)])
+        sample_var = np.array([pv[dy:dy+rows,dx:dx+cols] for dy in (0,2,4) for dx in (0,2,4)])
+        pm = pv = None
+#      the 4 gradients and the pixels with maximum gradient
+        sm = sample_mean
+        gradients = np.abs([sm[1]-sm[7],sm[6]-sm[2],sm[3]-sm[5],sm[0]-sm[8]])
+        gradmask = gradients == np.max(gradients,axis=0)
+#      the 8 directions: 1 ... 4 if the test holds, otherwise 5 ... 8,
+#      summed over the maximum gradients
+        c = sm[4]
+        tests = np.array([sm[1]-c > c-sm[7],sm[6]-c > c-sm[2],
+                          sm[3]-c > c-sm[5],sm[0]-c > c-sm[8]])
+        ks = np.arange(1,5)[:,np.newaxis,np.newaxis]
+        directions = np.sum(np.where(gradmask,np.where(tests,ks,ks+4),0),axis=0)
+        gradients = gradmask = tests = None
+#      local noise variance: mean of the 5 smallest var/mean^2
+        sample_stats = sample_var/(sample_mean*sample_mean)
+        sigmaV = np.mean(np.partition(sample_stats,4,axis=0)[:5],axis=0)
+        sample_mean = sample_var = sample_stats = sm = None
+#      directional statistics
+        dir_mean = np.full((rows,cols),np.nan)
+        dir_var = np.full((rows,cols),np.nan)
+        for k in range(8):
+            mean, var = stats(kernels[k])
+            where = directions == k+1
+            np.copyto(dir_mean,mean,where=where)
+            np.copyto(dir_var,var,where=where)
+#      the filtered value
+        varX = (dir_var-dir_mean*dir_mean*sigmaV)/(sigmaV+1.0)
+        b = varX/dir_var
+        result = dir_mean+b*(img-dir_mean)
+    return np.where(np.isfinite(result),result,img)
+
+def rl_filter(infile,dims=None,outfile=None,tile=512,workers=None):
+    '''refined Lee filter all bands of infile in strips of tile rows,
+       the bands of each strip in parallel'''
+    gdal.AllRegister()
+    inDataset = gdal.Open(infile,GA_ReadOnly)
+    cols = inDataset.RasterXSize
+    rows = inDataset.RasterYSize
+    bands = inDataset.RasterCount
+    if dims == None:
+        dims = [0,0,cols,rows]
+    x0,y0,cols,rows = dims
+    if outfile is None:
+        path = os.path.dirname(infile)
+        basename = os.path.basename(infile)
+        root, ext = os.path.splitext(basename)
+        outfile = path + '/' + root + '_rl' + ext
+    print( '=========================' )
+    print( '   REFINED LEE FILTER' )
+    print( '=========================' )
+    print( time.asctime() )
+    print( 'infile:  %s'%infile )
+    print( 'filtering %i band(s) in strips of %i rows ...'%(bands,tile) )
+    start = time.time()
+    driver = inDataset.GetDriver()
+    outDataset = driver.Create(outfile,cols,rows,bands,GDT_Float32)
+    geotransform = inDataset.GetGeoTransform()
+    if geotransform is not None:
+        gt = list(geotransform)
+        gt[0] = gt[0] + x0*gt[1]
+        gt[3] = gt[3] + y0*gt[5]
+        outDataset.SetGeoTransform(tuple(gt))
+    projection = inDataset.GetProjection()
+    if projection is not None:
+        outDataset.SetProjection(projection)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for y in range(0,rows,tile):
+            h = min(tile,rows-y)
+#          strip with halo rows for exact window statistics
+            ya = max(y-HALO,0)
+            yb = min(y+h+HALO,rows)
+            strips = [inDataset.GetRasterBand(k+1).ReadAsArray(x0,y0+ya,cols,yb-ya)
+                      for k in range(bands)]
+            for k,result in enumerate(ex.map(rl,strips)):
+                outDataset.GetRasterBand(k+1).WriteArray(result[y-ya:y-ya+h].astype(np.float32),0,y)
+    for k in range(bands):
+        outDataset.GetRasterBand(k+1).FlushCache()
+    outDataset = None
+    inDataset = None
+    print( 'result written to: '+outfile )
+    print( 'elapsed time: '+str(time.time()-start) )
+    return outfile
+
+def main():
+    usage = '''
+Usage:
+------------------------------------------------
+
+Run a refined Lee filter over all bands
+of a polarimetric matrix image (e.g. as leefile
+for atsfthreshold.py)
+
+python %s [OPTIONS] filename
+
+Options:
+
+   -h         this help
+   -d <list>  spatial subset list e.g. -d [0,0,300,300]
+   -t <int>   number of rows processed at a time (default 512)
+   -w <int>   number of bands filtered in parallel
+              (default: number of CPUs)
+
+------------------------------------------------''' %sys.argv[0]
+    options,args = getopt.getopt(sys.argv[1:],'hd:t:w:')
+    dims = None
+    tile = 512
+    workers = None
+    for option, value in options:
+        if option == '-h':
+            print( usage )
+            return
+        elif option == '-d':
+            dims = eval(value)
+        elif option == '-t':
+            tile = eval(value)
+        elif option == '-w':
+            workers = eval(value)
+    if len(args) != 1:
+        print( 'Incorrect number of arguments' )
+        print( usage )
+        sys.exit(1)
+    rl_filter(args[0],dims,tile=tile,workers=workers)
+
+if __name__ == '__main__':
+    main()
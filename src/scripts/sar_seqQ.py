@@ -16,17 +16,39 @@
 # 
 # Copyright (c) 2018 Mort Canty
 
-def call_register(arg3):
-    from auxil.registersar import register
-    fn0,fni,dims = arg3
-    return register(fn0,fni,dims)
+def call_omnibus(arg):
+    '''Run omnibus() on one spatial window, padded with a halo, and save the 
+       cropped results in a scratch file of its own in the directory scratch,
+       so that no two workers (or ipyparallel engines on different hosts) 
+       write to the same file. Returns the window and the file name'''
+    import os
+    import numpy as np
+    from tempfile import mkstemp
+    fns,n,window,halo,cols,rows,bands,significance,medianfilter,precision,workers,scratch = arg
+    x,y,wcols,wrows = window
+    x0 = max(x-halo,0)
+    y0 = max(y-halo,0)
+    x1 = min(x+wcols+halo,cols)
+    y1 = min(y+wrows+halo,rows)
+    results = omnibus(fns,n,[x0,y0,x1-x0,y1-y0],bands,significance,medianfilter,precision,workers)
+    cropped = []
+    for result in results:
+        result = np.reshape(result,(y1-y0,x1-x0,-1))[y-y0:y-y0+wrows,x-x0:x-x0+wcols,:]
+        if result.dtype.kind == 'f':
+            result = result.astype(np.float32)
+        cropped.append(result)
+    fd, fn = mkstemp(dir=scratch,suffix='.npz')
+    with os.fdopen(fd,'wb') as f:
+        np.savez(f,*cropped)
+    return window, fn
 
 def call_median_filter(pv):
     from scipy import ndimage
     return ndimage.filters.median_filter(pv, size = (3,3))
 
-def getimg(fn):
+def getimg(fn,dims=None,dtype='float64'):
 #  read 9- 4- 3- 2- or 1-band preprocessed polarimetric matrix file 
+#  (optionally only the spatial window dims = [x0,y0,cols,rows])
     from osgeo.gdalconst import GA_ReadOnly
     from osgeo import gdal
     import numpy as np
@@ -37,233 +59,190 @@ def getimg(fn):
         cols = inDataset.RasterXSize
         rows = inDataset.RasterYSize    
         bands = inDataset.RasterCount
-        result = np.zeros((rows*cols,bands))
+        if dims is None:
+            dims = [0,0,cols,rows]
+        x0,y0,cols,rows = dims
+        result = np.zeros((rows*cols,bands),dtype=dtype)
         for k in range(bands):
-            result[:,k] = inDataset.GetRasterBand(k+1).ReadAsArray(0,0,cols,rows).ravel()
+            result[:,k] = inDataset.GetRasterBand(k+1).ReadAsArray(x0,y0,cols,rows).ravel()
         inDataset = None    
         return np.nan_to_num(result)  
     except Exception as e:
         print( 'Error: %s  -- Could not read file'%e )
         sys.exit(1)    
         
-def det(img):            
-    '''return determinant of 1, 2, 3, 4, or 9-band polarimetric image '''
-    bands = img.shape[1]
-    if bands==1:
-        return img
-    elif bands==2:
-        return img[:,0]*img[:,1]
-    elif bands==3:
-        return img[:,0]*img[:,1]*img[:,2]
-    elif bands==4:
-        return img[:,0]*img[:,3] - img[:,1]**2 - img[:,2]**2
-    else:
-        return img[:,0]*img[:,5]*img[:,8] + \
-               2*(img[:,1]*img[:,6]*img[:,3] + img[:,2]*img[:,7]*img[:,3] + img[:,2]*img[:,6]*img[:,4] + img[:,1]*img[:,7]*img[:,4]) - \
-               img[:,5]*(img[:,3]**2 + img[:,4]**2) - \
-               img[:,0]*(img[:,6]**2 + img[:,7]**2) - \
-               img[:,5]*(img[:,1]**2 + img[:,2]**2) 
-        
-def loewner(img):  
-    ''' return Loewner direction image: 1 positive definite
-                                        2 negative definite
-                                        3 neither ''' 
-    import numpy as np
-    bands = img.shape[1]  
-    dir3 = np.zeros(img.shape[0]) + 3
-    dir2 = np.zeros(img.shape[0]) + 2
-    dir1 = np.zeros(img.shape[0]) + 1
-    if bands <= 3:
-        dmy = np.where(np.min(img,1)>0,dir1,dir3)
-        result = np.where(np.max(img,1)<0,dir2,dmy)
-    elif bands == 4:
-        result = np.where( (img[:,0]>0) & (det(img)>0),dir1,dir3 )
-        result = np.where( (img[:,0]<0) & (det(img)<0) ,dir2,result )
-    elif bands == 9:
-        result = np.where( (img[:,0]>0) & (det(img[:,[0,1,2,5]])>0) & (det(img)>0),dir1,dir3 )
-        result = np.where( (img[:,0]<0) & (det(img[:,[0,1,2,5]])<0) & (det(img)<0),dir2,result )    
-    return result    
-         
-def PV(arg5):
-    '''Return p-values for change indices R^ell_j'''        
-    import numpy as np
-    import sys
-    from scipy import stats   
-    from osgeo.gdalconst import GA_ReadOnly 
-    from osgeo import gdal
-    
-    def getmat(fn,cols,rows,bands):
-    #  read 9- 4- 3- 2- or 1-band preprocessed polarimetric matrix file 
-    #  and return (complex) matrix elements      
-        try:
-            inDataset1 = gdal.Open(fn,GA_ReadOnly)     
-            if bands == 9:
-        #      T11 (k1)
-                b = inDataset1.GetRasterBand(1)
-                k1 = b.ReadAsArray(0,0,cols,rows)
-        #      T12  (a1)
-                b = inDataset1.GetRasterBand(2)
-                a1 = b.ReadAsArray(0,0,cols,rows)
-                b = inDataset1.GetRasterBand(3)    
-                im = b.ReadAsArray(0,0,cols,rows)
-                a1 = (a1 + 1j*im)
-        #      T13  (rho1)
-                b = inDataset1.GetRasterBand(4)
-                rho1 = b.ReadAsArray(0,0,cols,rows)
-                b = inDataset1.GetRasterBand(5)
-                im = b.ReadAsArray(0,0,cols,rows)
-                rho1 = (rho1 + 1j*im)      
-        #      T22 (xsi1)
-                b = inDataset1.GetRasterBand(6)
-                xsi1 = b.ReadAsArray(0,0,cols,rows)    
-        #      T23 (b1)        
-                b = inDataset1.GetRasterBand(7)
-                b1 = b.ReadAsArray(0,0,cols,rows)
-                b = inDataset1.GetRasterBand(8)
-                im = b.ReadAsArray(0,0,cols,rows)
-                b1 = (b1 + 1j*im)      
-        #      T33 (zeta1)
-                b = inDataset1.GetRasterBand(9)
-                zeta1 = b.ReadAsArray(0,0,cols,rows) 
-                result = (k1,a1,rho1,xsi1,b1,zeta1)             
-            elif bands == 4:
-        #      C11 (k1)
-                b = inDataset1.GetRasterBand(1)
-                k1 = b.ReadAsArray(0,0,cols,rows)
-        #      C12  (a1)
-                b = inDataset1.GetRasterBand(2)
-                a1 = b.ReadAsArray(0,0,cols,rows)
-                b = inDataset1.GetRasterBand(3)
-                im = b.ReadAsArray(0,0,cols,rows)
-                a1 = (a1 + 1j*im)        
-        #      C22 (xsi1)
-                b = inDataset1.GetRasterBand(4)
-                xsi1 = b.ReadAsArray(0,0,cols,rows)   
-                result = (k1,a1,xsi1)
-            elif bands == 3:
-        #      T11 (k1)
-                b = inDataset1.GetRasterBand(1)
-                k1 = b.ReadAsArray(0,0,cols,rows)
-        #      T22 (xsi1)
-                b = inDataset1.GetRasterBand(2)
-                xsi1 = b.ReadAsArray(0,0,cols,rows)    
-        #      T33 (zeta1)
-                b = inDataset1.GetRasterBand(3)
-                zeta1 = b.ReadAsArray(0,0,cols,rows) 
-                result = (k1,xsi1,zeta1)          
-            elif bands == 2:
-        #      C11 (k1)
-                b = inDataset1.GetRasterBand(1)
-                k1 = b.ReadAsArray(0,0,cols,rows)    
-        #      C22 (xsi1)
-                b = inDataset1.GetRasterBand(2)
-                xsi1 = b.ReadAsArray(0,0,cols,rows)  
-                result = (k1,xsi1)         
-            elif bands == 1:        
-        #      C11 (k1)
-                b = inDataset1.GetRasterBand(1)
-                k1 = b.ReadAsArray(0,0,cols,rows) 
-                result = (k1,)
-            inDataset1 = None
-            return result
-        except Exception as e:
-            print( 'Error: %s  -- Could not read file'%e )
-            sys.exit(1)   
-            
-    fns,n,cols,rows,bands = arg5
-              
-    j = np.float64(len(fns))
-    eps = sys.float_info.min
-    k = 0.0; a = 0.0; rho = 0.0; xsi = 0.0; b = 0.0; zeta = 0.0
-    for fn in fns:
-        result = getmat(fn,cols,rows,bands)
-        if bands==9:
-            k1,a1,rho1,xsi1,b1,zeta1 = result
-            k1 = n*np.float64(k1)
-            a1 = n*np.complex128(a1)
-            rho1 = n*np.complex128(rho1)
-            xsi1 = n*np.float64(xsi1)
-            b1 = n*np.complex128(b1)
-            zeta1 = n*np.float64(zeta1)
-            k += k1; a += a1; rho += rho1; xsi += xsi1; b += b1; zeta += zeta1  
-        elif bands==4:
-            k1,a1,xsi1 = result
-            k1 = n*np.float64(k1)
-            a1 = n*np.complex128(a1)
-            xsi1 = n*np.float64(xsi1)
-            k += k1; a += a1; xsi += xsi1
-        elif bands==3:
-            k1,xsi1,zeta1 = result
-            k1 = n*np.float64(k1)
-            xsi1 = n*np.float64(xsi1)
-            zeta1 = n*np.float64(zeta1)
-            k += k1; xsi += xsi1; zeta += zeta1  
-        elif bands==2:
-            k1,xsi1 = result
-            k1 = n*np.float64(k1)
-            xsi1 = n*np.float64(xsi1)
-            k += k1; xsi += xsi1
-        elif bands==1:
-            k1 = n*np.float64(result[0])
-            k += k1              
-    if bands==9: 
-        p = 3
-        detsumj = k*xsi*zeta + 2*np.real(a*b*np.conj(rho)) - xsi*(abs(rho)**2) - k*(abs(b)**2) - zeta*(abs(a)**2) 
-        k -= k1; a -= a1; rho -= rho1; xsi -= xsi1; b -= b1; zeta -= zeta1 
-        detsumj1 = k*xsi*zeta + 2*np.real(a*b*np.conj(rho)) - xsi*(abs(rho)**2) - k*(abs(b)**2) - zeta*(abs(a)**2)
-        detj = k1*xsi1*zeta1 + 2*np.real(a1*b1*np.conj(rho1)) - xsi1*(abs(rho1)**2) - k1*(abs(b1)**2) - zeta1*(abs(a1)**2)
-    elif bands==4:
-        p = 2
-        detsumj = k*xsi - abs(a)**2 
-        k -= k1; a -= a1; xsi -= xsi1
-        detsumj1 = k*xsi - abs(a)**2
-        detj = k1*xsi1 - abs(a1)**2
-    elif bands==3:
-        p = 3
-        detsumj = k*xsi*zeta 
-        k -= k1; xsi -= xsi1;  zeta -= zeta1 
-        detsumj1 = k*xsi*zeta 
-        detj = k1*xsi1*zeta1
-    elif bands==2:
-        p = 2
-        detsumj = k*xsi
-        k -= k1; xsi -= xsi1
-        detsumj1 = k*xsi
-        detj = k1*xsi1
-    elif bands==1:
-        p = 1
-        detsumj = k+0.0 # !!! deep copy
-        k -= k1
-        detsumj1 = k
-        detj = k1    
-    detsumj = np.nan_to_num(detsumj)    
-    detsumj = np.where(detsumj <= eps,eps,detsumj)
-    logdetsumj = np.log(detsumj)
-    detsumj1 = np.nan_to_num(detsumj1)
-    detsumj1 = np.where(detsumj1 <= eps,eps,detsumj1)
-    logdetsumj1 = np.log(detsumj1)
-    detj = np.nan_to_num(detj)
-    detj = np.where(detj <= eps,eps,detj)
-    logdetj = np.log(detj)
-#  test statistic
-    lnRj = n*( p*( j*np.log(j)-(j-1)*np.log(j-1.) ) + (j-1)*logdetsumj1 + logdetj - j*logdetsumj )  
+def mixRj(bands,j,n):
+    '''Return (f,rhoj,omega2j) of the chi-square mixture approximating the 
+       distribution of -2*rhoj*lnRj, j = number of images in the test'''
+    import math
     if (bands==9) or (bands==4) or (bands==1):
 #      full quad, dual pol or intensity (p = 3, 2 or 1)      
-        f =p**2
+        p = math.sqrt(bands)
+        f = p**2
     else:
 #      quad and dual diagonal matrix cases (f = 3 or 2, p1 = p2 (= p3) =: p = 1)
         f = bands
         p = 1
     rhoj = 1 - (2.*p**2 - 1)*(1. + 1./(j*(j-1)))/(6.*p*n)
     omega2j = -(f/4.)*(1.-1./rhoj)**2 + (1./(24.*n*n))*p*p*(p*p-1)*(1+(2.*j-1)/(j*(j-1))**2)/rhoj**2     
-#  return (p-values, lnRj)  
+    return (f,rhoj,omega2j)
+
+def getpvRj(lnRj,bands,j,n):
+    '''Return p-values for change indices R^ell_j given lnRj, j = number of images in the test'''
+    from auxil import chi2mix
+    f,rhoj,omega2j = mixRj(bands,j,n)
     Z = -2*rhoj*lnRj
-    return ( 1.0-((1.-omega2j)*stats.chi2.cdf(Z,[f])+omega2j*stats.chi2.cdf(Z,[f+4])), lnRj )
+    return chi2mix.sf(Z,f,omega2j)
+
+def critRj(significance,bands,j,n):
+    '''Return the critical value of lnRj: the p-value is <= significance if and only if lnRj <= critical value'''
+    from auxil import chi2mix
+    f,rhoj,omega2j = mixRj(bands,j,n)
+    return -chi2mix.isf(significance,f,omega2j)/(2*rhoj)
 
-def change_maps(pvarray,significance):
+def PVs(fns,n,dims,bands,pvarray,medianfilter=False,significance=None):
+    '''Calculate p-values for all change indices R^ell_j and for the omnibus
+       statistics Q^ell within the spatial window dims = [x0,y0,cols,rows]
+       and store them in pvarray. Each image is read only once:
+       running sums of the matrix elements are kept for every ell, so that all
+       determinants follow from the sums without re-reading earlier images.
+       The log-determinant of each image and the current log-determinant of
+       each running sum are cached, so that every (ell,j) costs only one 
+       determinant evaluation. If pvarray is float32 or uint16 (see encode_pv()),
+       the sums are accumulated in single precision with compensated (Kahan)
+       summation and the log-determinants are taken from the LDL pivots. 
+       If pvarray is uint8 of shape (k,k,ceil(rows*cols/8)), only the bit-packed 
+       decisions p-value <= significance are stored: the test statistics are 
+       compared with precomputed critical values and no p-values are evaluated'''
     import numpy as np
+    from tempfile import NamedTemporaryFile
+    from auxil.hermitian import logdet, logdet_ldl
+    k = len(fns)
+    _,_,cols,rows = dims
+    npix = rows*cols
+    n = float(n)
+    if bands in (9,3):
+        p = 3
+    elif bands in (4,2):
+        p = 2
+    else:
+        p = 1
+    if pvarray.dtype in (np.float32,np.uint16):
+        dtype = np.float32
+        ldet = logdet_ldl
+    else:
+        dtype = np.float64
+        ldet = logdet
+    decisions = pvarray.dtype == np.uint8
+    if decisions:
+#      critical values of lnRj for j = 2 ... k and of lnQ for ell = 0 ... k-2        
+        lnRcrit = {j: critRj(significance,bands,float(j),n) for j in range(2,k+1)}
+        lnQcrit = [critQ(significance,bands,k-ell,n) for ell in range(k-1)]
+#  running sums of n*(matrix elements) for ell = 0 ... k-2     
+    mm = NamedTemporaryFile()
+    sums = np.memmap(mm.name,dtype=dtype,mode='w+',shape=(k-1,bands,npix))
+    if dtype == np.float32:
+#      running compensations of the summation errors
+        mmc = NamedTemporaryFile()
+        comps = np.memmap(mmc.name,dtype=dtype,mode='w+',shape=(k-1,bands,npix))
+        y = np.empty((bands,npix),dtype=dtype)
+        t = np.empty((bands,npix),dtype=dtype)
+#  log-determinants of the running sums, carried forward from j-1 to j    
+    mm1 = NamedTemporaryFile()
+    logdetsums = np.memmap(mm1.name,dtype=dtype,mode='w+',shape=(k-1,npix))
+#  lnQ for each ell     
+    mm2 = NamedTemporaryFile()
+    lnQ = np.memmap(mm2.name,dtype=dtype,mode='w+',shape=(k-1,npix))
+#  log-determinant buffers    
+    logdetj = np.empty(npix,dtype=dtype)
+    logdetsumj = np.empty(npix,dtype=dtype)
+    work = np.empty((4,npix),dtype=dtype)
+    for i in range(k):
+        img = n*np.transpose(getimg(fns[i],dims,dtype))
+        ldet(img,logdetj,work)
+        pvs = []
+        for ell in range(i):
+            j = float(i-ell+1)
+            if dtype == np.float64:
+                sums[ell] += img
+            else:
+#              compensated summation                
+                np.subtract(img,comps[ell],out=y)
+                np.add(sums[ell],y,out=t)
+                np.subtract(t,sums[ell],out=comps[ell])
+                comps[ell] -= y
+                sums[ell] = t
+            ldet(sums[ell],logdetsumj,work)
+#          test statistic, logdetsums[ell] still holds the log-determinant of the sum up to j-1
+            lnRj = n*( p*( j*np.log(j)-(j-1)*np.log(j-1.) ) + (j-1)*logdetsums[ell] + logdetj - j*logdetsumj )
+            logdetsums[ell] = logdetsumj
+            if decisions:
+                pvs.append(np.uint8(lnRj <= lnRcrit[i-ell+1]))
+            else:
+                pvs.append(getpvRj(lnRj,bands,j,n))
+            lnQ[ell] += lnRj
+        if medianfilter:
+            pvs = [call_median_filter(np.reshape(pv,(rows,cols))).ravel() for pv in pvs]
+        for ell in range(i):
+            pvarray[ell,i-1,:] = encode_pv(pvs[ell],pvarray.dtype)
+        if i < k-1:
+            sums[i] = img
+            logdetsums[i] = logdetj
+    for ell in range(k-1):
+        if decisions:
+            pvarray[ell,k-1,:] = encode_pv(np.uint8(lnQ[ell] <= lnQcrit[ell]),pvarray.dtype)
+        else:
+            pvarray[ell,k-1,:] = encode_pv(getpvQ(lnQ[ell],bands,k-ell,n),pvarray.dtype)
+    del sums, logdetsums, lnQ
+
+def encode_pv(pv,dtype):
+    '''Return p-values as stored in a p-value array of type dtype: 
+       float64 or float32, quantized -log10(p) for uint16, or
+       bit-packed 0/1 decisions for uint8'''
+    import numpy as np
+    if dtype == np.uint8:
+        return np.packbits(pv)
+    elif dtype == np.uint16:
+        q = -np.log10(np.maximum(pv,1e-300))*PVSCALE
+        return np.clip(np.floor(q),0,65535).astype(np.uint16)
+    return pv
+
+def decode_pv(pv):
+    '''Inverse of encode_pv(), to within the quantization'''
+    import numpy as np
+    if pv.dtype == np.uint16:
+        return 10.0**(-(pv/PVSCALE))
+    return pv
+
+def significant(pv,significance):
+    '''Return pv <= significance for p-values as stored by encode_pv(),
+       decisions (uint8) must have been unpacked'''
+    import numpy as np
+    if pv.dtype == np.uint8:
+        return pv != 0
+    elif pv.dtype == np.uint16:
+#      conservative: q >= level implies p <= significance         
+        level = np.ceil(np.round(-np.log10(significance)*PVSCALE,6))
+        return pv >= level
+    return pv <= significance
+
+def change_maps(pvarray,significance,chunk=None,workers=1,npix=None):
+    '''Return change maps (cmap,smap,fmap,bmap) from the (k,k,n) p-value array
+       as stored by encode_pv(), or from the bit-packed (k,k,ceil(npix/8))
+       decision array if npix is given.
+       Single pass over j: each pixel carries its current ell (the interval 
+       following its most recent change) and only p-values for that ell are 
+       tested. The pixel axis is processed in chunks, optionally on several threads'''
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
     k = pvarray.shape[0] 
-    n = pvarray.shape[2]
+    n = pvarray.shape[2] if npix is None else npix
+    if chunk is None:
+#      about 16M p-values per chunk    
+        chunk = max(2**24//(k*k),1024)
+    if npix is not None:
+#      whole bytes of packed decisions
+        chunk = -(-chunk//8)*8
 #  map of most recent change occurrences
     cmap = np.zeros(n,dtype=np.byte)    
 #  map of first change occurrence
@@ -272,22 +251,44 @@ def change_maps(pvarray,significance):
     fmap = np.zeros(n,dtype=np.byte)
 #  bitemporal change maps
     bmap = np.zeros((n,k-1),dtype=np.byte)  
-    for ell in range(k-1):        
-        pvQ = pvarray[ell,k-1,:]    
-        for j in range(ell,k-1): 
-            pv = pvarray[ell,j,:] 
-            idx = np.where((pv<=significance)&(pvQ<=significance)&(cmap==ell)) 
-            fmap[idx] += 1 
-            cmap[idx] = j+1 
-            bmap[idx,j] = 1 
-            if ell==0:
-                smap[idx] = j+1    
+    
+    def kernel(start):
+        stop = min(start+chunk,n)
+        if npix is None:
+            pv = pvarray[:,:,start:stop]
+        else:
+            pv = np.unpackbits(pvarray[:,:,start//8:-(-stop//8)],axis=2,count=stop-start)
+        tstQ = significant(pv[:,k-1,:],significance)
+        ell = np.zeros((1,stop-start),dtype=np.intp)
+        cm = cmap[start:stop]
+        sm = smap[start:stop]
+        fm = fmap[start:stop]
+        for j in range(k-1): 
+#          change at j+1 if both R^ell_j and Q^ell are significant for the current ell
+            hit = significant(np.take_along_axis(pv[:,j,:],ell,axis=0)[0],significance)
+            hit &= np.take_along_axis(tstQ,ell,axis=0)[0]
+            fm += hit
+            np.copyto(sm,j+1,where=hit&(ell[0]==0),casting='unsafe')
+            np.copyto(ell[0],j+1,where=hit)
+            bmap[start:stop,j] = hit
+        cm[:] = ell[0]
+            
+    starts = range(0,n,chunk)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(kernel,starts))
+    else:
+        for start in starts:
+            kernel(start)
     return (cmap,smap,fmap,bmap) 
 
-def getpvQ(lnQ,bands,k,n):
+# quantization of p-values stored as uint16: floor(-log10(p)*PVSCALE)
+PVSCALE = 1000.0
+
+def mixQ(bands,k,n):
+    '''Return (f,rho,omega2) of the chi-square mixture approximating the 
+       distribution of -2*rho*lnQ, k = number of images in the test'''
     import math
-    from scipy import stats
-#  test statistic 
     if (bands==9) or (bands==4) or (bands==1):
 #      full quad, dual pol or intensity (p = 3, 2 or 1)   
         p = math.sqrt(bands)   
@@ -304,18 +305,353 @@ def getpvQ(lnQ,bands,k,n):
         f = 3.0*(k-1)
         rho = 1.0 - (k/n-1.0/(n*k))/(6.0*(k-1))
         omega2 = -3.0*(k-1)*(1.0-1/rho)**2/4.0  
+    return (f,rho,omega2)
+
+def getpvQ(lnQ,bands,k,n):
+    from auxil import chi2mix
+    f,rho,omega2 = mixQ(bands,k,n)
 #  return p-value  
     Z = -2*rho*lnQ 
-    return 1.0-((1.-omega2)*stats.chi2.cdf(Z,[f])+omega2*stats.chi2.cdf(Z,[f+4]))   
+    return chi2mix.sf(Z,f,omega2)
+
+def critQ(significance,bands,k,n):
+    '''Return the critical value of lnQ: the p-value is <= significance if and only if lnQ <= critical value'''
+    from auxil import chi2mix
+    f,rho,omega2 = mixQ(bands,k,n)
+    return -chi2mix.isf(significance,f,omega2)/(2*rho)
+                       
+def omnibus(fns,n,dims,bands,significance,medianfilter=False,precision='float64',workers=1):
+    '''Run the sequential omnibus algorithm on the spatial window dims = [x0,y0,cols,rows]
+       and return (cmap,smap,fmap,bmap,avimglog,atsf) as pixel vectors. The p-values
+       are stored with precision float64, float32 or uint16 (see encode_pv()), or
+       only the bit-packed decisions at the significance level are kept (bits). 
+       The change maps are derived on workers threads'''
+    import numpy as np
+    from tempfile import NamedTemporaryFile
+    from auxil.hermitian import loewner
+    k = len(fns)
+    _,_,cols,rows = dims
+#  create temporary, memory-mapped array of change indices p(Ri<ri) for this window
+    mm = NamedTemporaryFile()
+    if precision == 'bits':
+        pvarray = np.memmap(mm.name,dtype=np.uint8,mode='w+',shape=(k,k,-(-rows*cols//8)))  
+        npix = rows*cols
+    else:
+        pvarray = np.memmap(mm.name,dtype=precision,mode='w+',shape=(k,k,rows*cols))  
+        npix = None
+    PVs(fns,n,dims,bands,pvarray,medianfilter,significance)
+    cmap,smap,fmap,bmap = change_maps(pvarray,significance,workers=workers,npix=npix)   
+    del pvarray
+#  post process bmap for Loewner direction   
+    avimg = getimg(fns[0],dims)
+    avimglog = cmap*0+k
+    r = 1.0 
+    for i in range(k-1):
+        img = getimg(fns[i+1],dims)
+        direct = loewner(np.transpose(img-avimg))
+        bmap[:,i] = np.where(bmap[:,i],direct,bmap[:,i])
+        avimglog = np.where(bmap[:,i],k-i,avimglog)
+#      provisional means        
+        r += 1.0
+        avimg = avimg + (img-avimg)/r
+        for j in range(bands): 
+#          reset avimg where change occurred
+            avimg[:,j] = np.where(bmap[:,i],img[:,j],avimg[:,j])
+    return (cmap,smap,fmap,bmap,avimglog,avimg)
                        
+def append(statedir,fn,n,significance,medianfilter=False):
+    '''Append the image fn (co-registered with the first one) to the persistent 
+       state in directory statedir, creating the state if necessary, and update 
+       the change maps and the ATSF, which are the same as those of omnibus() 
+       over all images in the state. A pixel can enter the interval starting 
+       with image ell only if R^ell'_ell is significant for an interval ell' 
+       which it can be in, so the state holds each interval on these pixels 
+       only (with their 3x3 neighbours for the median filter): the running sum 
+       of the matrix elements, its log-determinant, lnQ^ell, the provisional 
+       mean image and, in one growing array, the tests of R^ell_j for the later
+       images j (0: not significant, otherwise the Loewner order of the 
+       change). Intervals which no pixel can enter are not kept. Appending 
+       costs one update per interval, then the maps take one step for the new 
+       image (see stream_maps()). Q^ell depends on all images, so pixels whose 
+       path went through an interval whose Q^ell test changes are followed 
+       again over the earlier images from the stored tests. The enl n, 
+       significance and median filter are those with which the state was 
+       created, the image must have the bands and size of the first one'''
+    import os, json
+    import numpy as np
+    from osgeo import gdal
+    from osgeo.gdalconst import GA_ReadOnly
+    from scipy import ndimage
+    from auxil.hermitian import logdet, loewner
+    metafn = os.path.join(statedir,'state.json')
+    
+    def path(name):
+        return os.path.join(statedir,name+'.npy')
+    
+    def get(name):
+        return np.load(path(name),mmap_mode='r+')
+    
+    def new_interval(ell,reach,img,logdetimg,raw):
+#      state of the interval starting with image ell on the pixels which can enter it
+        if meta['medianfilter']:
+            support = ndimage.binary_dilation(np.reshape(reach,(rows,cols)),np.ones((3,3),dtype=bool)).ravel()
+        else:
+            support = reach
+        support = np.flatnonzero(support)
+        np.save(path('support_%i'%ell),support)
+        np.save(path('reach_%i'%ell),reach[support])
+        np.save(path('sum_%i'%ell),img[:,support])
+        np.save(path('logdetsum_%i'%ell),logdetimg[support])
+        np.save(path('lnQ_%i'%ell),np.zeros(support.size))
+        np.save(path('avimg_%i'%ell),raw[support,:])
+        meta['intervals'].append(ell)
+        
+    inDataset = gdal.Open(fn,GA_ReadOnly)
+    bands = inDataset.RasterCount
+    cols = inDataset.RasterXSize
+    rows = inDataset.RasterYSize
+    inDataset = None
+    if not os.path.exists(metafn):
+#      first image
+        if not os.path.exists(statedir):
+            os.makedirs(statedir)
+        meta = {'fns':[fn],'n':float(n),'significance':significance,'medianfilter':medianfilter,
+                'bands':bands,'cols':cols,'rows':rows,'intervals':[]}
+        raw = getimg(fn)
+        img = meta['n']*np.transpose(raw)
+        new_interval(0,np.ones(rows*cols,dtype=bool),img,logdet(img),raw)
+        stream_maps(statedir,meta)
+        with open(metafn,'w') as f:
+            json.dump(meta,f)
+        return
+    with open(metafn) as f:
+        meta = json.load(f)
+    if (bands,cols,rows) != (meta['bands'],meta['cols'],meta['rows']):
+        raise ValueError('%s has %i bands of %i x %i pixels, the images in %s have %i bands of %i x %i pixels'
+                         %(fn,bands,cols,rows,statedir,meta['bands'],meta['cols'],meta['rows']))
+    n = meta['n']
+    significance = meta['significance']
+    if bands in (9,3):
+        p = 3
+    elif bands in (4,2):
+        p = 2
+    else:
+        p = 1
+#  index of the new image
+    i = len(meta['fns'])
+    r = float(i+1)
+    raw = getimg(fn)
+    img = n*np.transpose(raw)
+    logdetj = logdet(img)
+#  pixels which can enter the interval starting with the new image
+    reach_new = np.zeros(rows*cols,dtype=bool)
+    for ell in meta['intervals']:
+        support = np.load(path('support_%i'%ell))
+        reach = np.load(path('reach_%i'%ell))
+        sums = get('sum_%i'%ell)
+        logdetsums = get('logdetsum_%i'%ell)
+        lnQ = get('lnQ_%i'%ell)
+        avimg = get('avimg_%i'%ell)
+        j = float(i-ell+1)
+        logdetsumj1 = np.array(logdetsums)
+        sums += img[:,support]
+        logdet(sums,logdetsums,np.empty((2,support.size)))
+        lnRj = n*( p*( j*np.log(j)-(j-1)*np.log(j-1.) ) + (j-1)*logdetsumj1 + logdetj[support] - j*logdetsums )
+        lnQ += lnRj
+        pv = getpvRj(lnRj,bands,j,n)
+        if meta['medianfilter']:
+            pvs = np.ones(rows*cols)
+            pvs[support] = pv
+            pv = call_median_filter(np.reshape(pvs,(rows,cols))).ravel()[support]
+        hit = pv <= significance
+#      Loewner order of a change against the provisional mean of the interval         
+        test = np.where(hit,loewner(np.transpose(raw[support,:]-avimg)),0).astype(np.uint8)
+        with open(os.path.join(statedir,'tests_%i.dat'%ell),'ab') as f:
+            f.write(test.tobytes())
+        avimg[:] = avimg + (raw[support,:]-avimg)/r
+        reach_new[support[hit & reach]] = True
+        for a in (sums,logdetsums,lnQ,avimg):
+            a.flush()
+        del sums, logdetsums, lnQ, avimg
+    if reach_new.any():
+        new_interval(i,reach_new,img,logdetj,raw)
+    meta['fns'].append(fn)
+    stream_maps(statedir,meta)
+    with open(metafn+'.tmp','w') as f:
+        json.dump(meta,f)
+    os.replace(metafn+'.tmp',metafn)
+
+def stream_maps(statedir,meta):
+    '''Update cmap, smap, fmap, bmap and the ATSF avimg in the persistent state 
+       in directory statedir for the last image in meta, from the tests of 
+       R^ell_j and lnQ^ell in the state, following each pixel from interval to 
+       interval as change_maps() and the post processing in omnibus() do. 
+       Every pixel takes one step for the new image, which appends a column to 
+       bmap. The new image changes Q^ell, so a pixel whose path went through an
+       interval ell where the test of Q^ell changes is first followed again 
+       over the earlier images'''
+    import os
+    import numpy as np
+    
+    def path(name):
+        return os.path.join(statedir,name+'.npy')
+    
+    def groups(ell):
+#      positions of the pixels ell grouped by their current interval 
+        order = np.argsort(ell,kind='stable')
+        starts, first = np.unique(ell[order],return_index=True)
+        return zip(starts,np.split(order,first[1:]))
+    
+    k = len(meta['fns'])
+    bands = meta['bands']
+    npix = meta['rows']*meta['cols']
+    bmapfn = os.path.join(statedir,'bmap.dat')
+    if k == 1:
+        for name in ['cmap','smap','fmap']:
+            np.save(path(name),np.zeros(npix,dtype=np.byte))
+        np.save(path('avimg'),np.load(path('avimg_0')))
+        open(bmapfn,'wb').close()
+        return
+    supports = {ell: np.load(path('support_%i'%ell)) for ell in meta['intervals']}
+    tests = {ell: np.memmap(os.path.join(statedir,'tests_%i.dat'%ell),dtype=np.uint8,mode='r').reshape(-1,supports[ell].size) 
+                                                              for ell in meta['intervals'] if ell < k-1}
+    cmap = np.load(path('cmap')).astype(np.intp)
+    smap = np.load(path('smap'))
+    fmap = np.load(path('fmap'))
+#  Q^ell over all k images     
+    tstQ = {}
+    changed = np.zeros(npix,dtype=bool)
+    for ell in tests:
+        tstQ[ell] = getpvQ(np.load(path('lnQ_%i'%ell)),bands,k-ell,meta['n']) <= meta['significance']
+        if ell < k-2:
+#          pixels whose path went through interval ell and whose test of Q^ell changed            
+            idx = supports[ell][np.load(path('tstQ_%i'%ell)) != tstQ[ell]]
+            if ell > 0:
+                idx = idx[np.memmap(bmapfn,dtype=np.byte,mode='r',offset=(ell-1)*npix,shape=(npix,))[idx] > 0]
+            changed[idx] = True
+        np.save(path('tstQ_%i'%ell),tstQ[ell])
+    changed = np.flatnonzero(changed)
+    if changed.size:
+#      follow these pixels again over the earlier images        
+        bmap = np.memmap(bmapfn,dtype=np.byte,mode='r+',shape=(k-2,npix))
+        ell = np.zeros(changed.size,dtype=np.intp)
+        sm = np.zeros(changed.size,dtype=np.byte)
+        fm = np.zeros(changed.size,dtype=np.byte)
+        for j in range(k-2):
+            bm = np.zeros(changed.size,dtype=np.byte)
+            for start,sel in groups(ell):
+                pos = np.searchsorted(supports[start],changed[sel])
+                test = tests[start][j-start][pos]
+                bm[sel] = np.where(tstQ[start][pos],test,0)
+            hit = bm > 0
+            fm += hit
+            np.copyto(sm,j+1,where=hit&(ell==0),casting='unsafe')
+            np.copyto(ell,j+1,where=hit)
+            bmap[j,changed] = bm
+        bmap.flush()
+        del bmap
+        cmap[changed] = ell
+        smap[changed] = sm
+        fmap[changed] = fm
+#  one step for the new image     
+    bm = np.zeros(npix,dtype=np.byte)
+    for start,sel in groups(cmap):
+        pos = np.searchsorted(supports[start],sel)
+        bm[sel] = np.where(tstQ[start][pos],tests[start][k-2-start][pos],0)
+    hit = bm > 0
+    fmap += hit
+    np.copyto(smap,k-1,where=hit&(cmap==0),casting='unsafe')
+    np.copyto(cmap,k-1,where=hit)
+    with open(bmapfn,'ab') as f:
+        f.write(bm.tobytes())
+    avimg = np.empty((npix,bands))
+    for start,sel in groups(cmap):
+        avimg[sel] = np.load(path('avimg_%i'%start),mmap_mode='r')[np.searchsorted(supports[start],sel)]
+    np.save(path('cmap'),cmap.astype(np.byte))
+    np.save(path('smap'),smap)
+    np.save(path('fmap'),fmap)
+    np.save(path('avimg'),avimg)
+
+def stream_results(statedir):
+    '''Return the file names in the persistent state in directory statedir and 
+       (cmap,smap,fmap,bmap,avimglog,atsf) as pixel vectors, as for omnibus()'''
+    import os, json
+    import numpy as np
+    with open(os.path.join(statedir,'state.json')) as f:
+        meta = json.load(f)
+    fns = meta['fns']
+    k = len(fns)
+    results = [np.load(os.path.join(statedir,name+'.npy')) for name in ['cmap','smap','fmap']]
+    npix = meta['rows']*meta['cols']
+    if k > 1:
+        bmap = np.memmap(os.path.join(statedir,'bmap.dat'),dtype=np.byte,mode='r',shape=(k-1,npix))
+        results.append(np.ascontiguousarray(bmap.T))
+        del bmap
+    else:
+        results.append(np.zeros((npix,0),dtype=np.byte))
+    cmap = results[0]
+    avimglog = np.where(cmap>0,k-cmap+1,k).astype(np.byte)
+    avimg = np.load(os.path.join(statedir,'avimg.npy'))
+    return fns, results+[avimglog,avimg]
+
+def validate(fns,n,dims,bands,significance,medianfilter,precision):
+    '''Print a report comparing the p-values (or decisions) and change maps 
+       for the given precision (float32, uint16 or bits) with those of the 
+       float64 path within the spatial window dims'''
+    import numpy as np
+    from tempfile import NamedTemporaryFile
+    k = len(fns)
+    _,_,cols,rows = dims
+    mm = NamedTemporaryFile()
+    if precision == 'bits':
+        pvarray = np.memmap(mm.name,dtype=np.uint8,mode='w+',shape=(k,k,-(-rows*cols//8)))
+        npix = rows*cols
+    else:
+        pvarray = np.memmap(mm.name,dtype=precision,mode='w+',shape=(k,k,rows*cols))
+        npix = None
+    mm64 = NamedTemporaryFile()
+    pvarray64 = np.memmap(mm64.name,dtype=np.float64,mode='w+',shape=(k,k,rows*cols))
+    PVs(fns,n,dims,bands,pvarray,medianfilter,significance)
+    PVs(fns,n,dims,bands,pvarray64,medianfilter)
+    maxdiff = 0.0
+    ndiff = 0
+    ntests = 0
+    for ell in range(k-1):
+        for j in list(range(ell,k-1))+[k-1]:
+            pv64 = pvarray64[ell,j,:]
+            if npix is None:
+                pv = pvarray[ell,j,:]
+#              compare -log10(p) up to 40 (p-values below 1e-40 are not resolved in float32)
+                lp = np.minimum(-np.log10(np.maximum(decode_pv(pv),1e-300)),40)
+                lp64 = np.minimum(-np.log10(np.maximum(pv64,1e-300)),40)
+                maxdiff = max(maxdiff,np.max(np.abs(lp-lp64)))
+            else:
+                pv = np.unpackbits(pvarray[ell,j,:],count=npix)
+            ndiff += np.sum(significant(pv,significance) != significant(pv64,significance))
+            ntests += pv.size
+    maps = change_maps(pvarray,significance,npix=npix)
+    maps64 = change_maps(pvarray64,significance)
+    print( '===============================================' )
+    print( 'validation of %s against float64, window %s'%(precision,str(dims)) )
+    if npix is None:
+        print( 'max |log10(p)-log10(p_float64)|: %g'%maxdiff )
+    print( 'tests decided differently: %i of %i'%(ndiff,ntests) )
+    for name,m,m64 in zip(['cmap','smap','fmap','bmap'],maps,maps64):
+        ndiffpix = np.sum(np.any(np.reshape(m!=m64,(rows*cols,-1)),axis=1))
+        print( '%s pixels differing: %i of %i'%(name,ndiffpix,rows*cols) )
+    print( 'p-value array size: %i bytes (float64: %i bytes)'%(pvarray.nbytes,pvarray64.nbytes) )
+    print( '===============================================' )
+    del pvarray, pvarray64
+
 def main():  
     import numpy as np
-    import os, sys, time, getopt
+    import os, sys, time, getopt, shutil
     from osgeo import gdal
-    from auxil import subset
-    from ipyparallel import Client 
+    from auxil import subset, registersar
+    from tempfile import mkdtemp
     from osgeo.gdalconst import GA_ReadOnly, GDT_Byte, GDT_Float32
-    from tempfile import NamedTemporaryFile
+    from auxil.geotiff import Writer
+    from auxil.tilecov import get_map
     usage = '''
 Usage:
 ------------------------------------------------
@@ -331,6 +667,28 @@ Options:
                it is assumed that the images are co-registered and have identical spatial dimensions  
   -m           run 3x3 median filter over p-values   
   -s  <float>  significance level for change detection (default 0.0001)
+  -t  <int>    (or --tile) process the images in square spatial windows of this size 
+               so that memory and scratch disk usage are bounded by the window size
+               (default: the whole image in one window, or one strip of rows per worker
+               for a parallel executor)
+  -e  <str>    (or --executor) serial, threads, processes or ipyparallel (default serial)
+               for co-registration and for processing the spatial windows in parallel
+  -w  <int>    (or --workers) number of workers (default: number of CPUs), those not 
+               needed for the parallel windows derive the change maps on threads
+  -p  <str>    (or --precision) float64 (default), float32, uint16 or bits: float32 and uint16 
+               accumulate in single precision with compensated summation and store the p-values 
+               as float32 or as quantized -log10(p) in uint16, halving or quartering the scratch 
+               disk usage. bits compares the test statistics with precomputed critical values 
+               and stores only the bit-packed decisions at the significance level (1 bit per test)
+  --validate   compare the chosen precision with float64 on the first window and print a report
+  --pack       write cmap, smap, fmap and bmap as the bands of one file outfile_stub_maps
+  --state <dir> streaming mode: keep a persistent state in the directory dir and append the
+               infiles which are not yet in the state one at a time, then write the outputs from 
+               the state. The outputs are the same as for a run over all images in the state. Each 
+               image updates the state once per interval and adds one column to the maps, earlier 
+               columns are re-derived only for pixels whose omnibus (Q) test changes. The 
+               enl, -s and -m are fixed when the state is created, the images must be co-registered 
+               (no -d) with the bands and size of the first one and the whole image is processed
 
 infiles:
 
@@ -344,20 +702,29 @@ enl:
 
   equivalent number of looks
   
-files written:
+files written (tiled, compressed cloud-optimized GeoTIFFs with overviews):
    outfile_stub_cmap
    outfile_stub_fmap
    outfile_stub_bmap
    outfile_stub_smap
+   (or outfile_stub_maps with --pack)
    infile_last_atsflog
    infile_last_atsf  
 
 -------------------------------------------------'''%sys.argv[0]
 
-    options,args = getopt.getopt(sys.argv[1:],'hmd:s:')
+    options,args = getopt.getopt(sys.argv[1:],'hmd:s:t:e:w:p:',
+                                 ['tile=','executor=','workers=','precision=','validate','state=','pack'])
     dims = None
     significance = 0.0001
     medianfilter = False
+    tile = None
+    executor = 'serial'
+    workers = os.cpu_count()
+    precision = 'float64'
+    validation = False
+    statedir = None
+    pack = False
     for option, value in options: 
         if option == '-h':
             print( usage )
@@ -368,7 +735,33 @@ files written:
             dims = eval(value)
         elif option == '-s':
             significance = eval(value)   
-    if len(args)<4:
+        elif option in ('-t','--tile'):
+            tile = eval(value)
+        elif option in ('-e','--executor'):
+            executor = value
+        elif option in ('-w','--workers'):
+            workers = eval(value)
+        elif option in ('-p','--precision'):
+            precision = value
+        elif option == '--validate':
+            validation = True
+        elif option == '--state':
+            statedir = value
+        elif option == '--pack':
+            pack = True
+    if executor not in ('serial','threads','processes','ipyparallel'):
+        print( 'unknown executor %s'%executor )
+        print( usage )
+        sys.exit()
+    if precision not in ('float64','float32','uint16','bits'):
+        print( 'unknown precision %s'%precision )
+        print( usage )
+        sys.exit()
+    if (statedir is not None) and (dims is not None):
+        print( 'streaming mode requires co-registered images' )
+        print( usage )
+        sys.exit()
+    if len(args) < (4 if statedir is None else 3):
         print('incorrect number of arguments')
         print( usage )
         sys.exit()
@@ -379,194 +772,173 @@ files written:
     outfn = args[-2]
     gdal.AllRegister()   
     start = time.time()    
-#  first SAR image   
-    try:            
-        inDataset1 = gdal.Open(fns[0],GA_ReadOnly)                             
-        cols = inDataset1.RasterXSize
-        rows = inDataset1.RasterYSize    
-        bands = inDataset1.RasterCount
-    except Exception as e:
-        print( 'Error: %s  -- Could not read file'%e)
-        sys.exit(1)    
-    if dims is not None:
-#      images are assumed not yet co-registered, so subset first image and register the others
-        _,_,cols,rows = dims
-        fn0 = subset.subset(fns[0],dims)
-        args1 = [(fns[0],fns[i],dims) for i in range(1,k)]
-        try:
-            print( ' \nattempting parallel execution of co-registration ...' ) 
+#  the engines need the module level functions called by call_omnibus()
+    pmap, pool = get_map(executor,workers,
+                         push=dict(omnibus=omnibus,PVs=PVs,change_maps=change_maps,getpvQ=getpvQ,getpvRj=getpvRj,
+                                   getimg=getimg,call_median_filter=call_median_filter,encode_pv=encode_pv,
+                                   significant=significant,PVSCALE=PVSCALE,mixRj=mixRj,mixQ=mixQ,
+                                   critRj=critRj,critQ=critQ))
+    scratch = None
+    targets = []
+    try:
+#      first SAR image   
+        try:            
+            inDataset1 = gdal.Open(fns[0],GA_ReadOnly)                             
+            cols = inDataset1.RasterXSize
+            rows = inDataset1.RasterYSize    
+            bands = inDataset1.RasterCount
+        except Exception as e:
+            print( 'Error: %s  -- Could not read file'%e)
+            sys.exit(1)    
+        if dims is not None:
+#          images are assumed not yet co-registered, so subset first image and register the others
+            _,_,cols,rows = dims
+            fn0 = subset.subset(fns[0],dims,vrt=True)
+            print( ' \nco-registration with executor %s ...'%executor ) 
             start1 = time.time()  
-            c = Client()
-            print( 'available engines %s'%str(c.ids) ) 
-            v = c[:]   
-            fns = v.map_sync(call_register,args1)
+#          reference spectra computed once, warp parameters tabulated            
+            if executor in ('threads','ipyparallel'):
+                fns, _ = registersar.register_stack(fns[0],fns[1:],dims,pmap=pmap)
+            else:
+                fns, _ = registersar.register_stack(fns[0],fns[1:],dims,
+                                       workers=1 if executor=='serial' else workers)
             print( 'elapsed time for co-registration: '+str(time.time()-start1) ) 
-        except Exception as e: 
-            start1 = time.time()
-            print( '%s \nFailed, so running sequential co-registration ...'%e )
-            fns = list(map(call_register,args1))  
-        fns.insert(0,fn0)  
-#      point inDataset1 to the subset image for correct georefrerencing         
-        inDataset1 = gdal.Open(fn0,GA_ReadOnly)           
-    print( '===============================================' )
-    print( '     Multi-temporal SAR Change Detection' )
-    print( '===============================================' )   
-    print( time.asctime() )  
-    print( 'First (reference) filename:  %s'%fns[0] )
-    print( 'number of images: %i'%k )
-    print( 'equivalent number of looks: %f'%n )
-    print( 'significance level: %f'%significance )
-    if bands==9:
-        print( 'Quad polarization')
-    elif bands==4:
-        print( 'Dual polarizaton' )
-    elif bands==3:
-        print( 'Quad polarization, diagonal only' )
-    elif bands==2:
-        print( 'Dual polarization, diagonal only' )
+            fns.insert(0,fn0)  
+#          point inDataset1 to the subset image for correct georefrerencing         
+            inDataset1 = gdal.Open(fn0,GA_ReadOnly)           
+        print( '===============================================' )
+        print( '     Multi-temporal SAR Change Detection' )
+        print( '===============================================' )   
+        print( time.asctime() )  
+        print( 'First (reference) filename:  %s'%fns[0] )
+        print( 'number of images: %i'%k )
+        print( 'equivalent number of looks: %f'%n )
+        print( 'significance level: %f'%significance )
+        print( 'precision: %s'%precision )
+        if bands==9:
+            print( 'Quad polarization')
+        elif bands==4:
+            print( 'Dual polarizaton' )
+        elif bands==3:
+            print( 'Quad polarization, diagonal only' )
+        elif bands==2:
+            print( 'Dual polarization, diagonal only' )
+        else:
+            print( 'Intensity images' )
+        if statedir is not None:
+#          streaming mode: append the new images to the state
+            start1 = time.time() 
+            fnsin = fns
+            fns = []
+            if os.path.exists(os.path.join(statedir,'state.json')):
+                fns, _ = stream_results(statedir)
+            for fn in fnsin:
+                if fn not in fns:
+                    print( 'appending %s to the state in %s'%(fn,statedir) )
+                    try:
+                        append(statedir,fn,n,significance,medianfilter)
+                    except ValueError as e:
+                        print( 'Error: %s'%e )
+                        sys.exit(1)
+                    fns.append(fn)
+            fns, results = stream_results(statedir)
+            k = len(fns)
+            lastfn = fns[-1]
+            print( 'number of images in the state: %i'%k )
+            if k < 2:
+                print( 'nothing to write' )
+                return
+            inDataset1 = gdal.Open(fns[0],GA_ReadOnly)
+#      output file
+        path = os.path.abspath(fns[0])    
+        dirn = os.path.dirname(path)
+        outfn = dirn + '/' + outfn 
+#      output files
+        geotransform = inDataset1.GetGeoTransform()
+        projection = inDataset1.GetProjection()        
+        basename = os.path.basename(outfn)
+        name, _ = os.path.splitext(basename)
+        outfn0=outfn.replace(name,name+'_maps')
+        outfn1=outfn.replace(name,name+'_cmap')
+        outfn2=outfn.replace(name,name+'_fmap')
+        outfn3=outfn.replace(name,name+'_bmap')
+        outfn4=outfn.replace(name,name+'_smap')
+        basename = os.path.basename(lastfn)
+        name, _ = os.path.splitext(basename)
+        outfn5=lastfn.replace(name,name+'_atsflog')
+        outfn6=lastfn.replace(name,name+'_atsf')
+        bmapnames = ['bmap %i'%(i+1) for i in range(k-1)]
+#      (writer, first band) for each of the results in the order returned by omnibus()    
+        if pack:
+            writer = Writer(outfn0,cols,rows,k+2,GDT_Byte,geotransform,projection,
+                            descriptions=['cmap','smap','fmap']+bmapnames)
+            targets = [(writer,1),(writer,2),(writer,3),(writer,4)]
+        else:
+            targets = [(Writer(outfn1,cols,rows,1,GDT_Byte,geotransform,projection,['cmap']),1),
+                       (Writer(outfn4,cols,rows,1,GDT_Byte,geotransform,projection,['smap']),1),
+                       (Writer(outfn2,cols,rows,1,GDT_Byte,geotransform,projection,['fmap']),1),
+                       (Writer(outfn3,cols,rows,k-1,GDT_Byte,geotransform,projection,bmapnames),1)]
+        targets += [(Writer(outfn5,cols,rows,1,GDT_Byte,geotransform,projection,['atsflog']),1),
+                    (Writer(outfn6,cols,rows,bands,GDT_Float32,geotransform,projection),1)]
+        nbs = [1,1,1,k-1,1,bands]
+        if statedir is not None:
+#          write the maps from the streaming state        
+            for (writer,band),nb,result in zip(targets,nbs,results):
+                writer.write(np.reshape(result,(rows,cols,nb)),0,0,band)
+        else:
+#          scratch directory in the output directory for the results of the windows 
+            scratch = mkdtemp(dir=dirn)
+#          spatial windows, padded with a halo for the median filter    
+            if tile is None:
+                if (pmap is map) or (workers < 2):
+                    windows = [(0,0,cols,rows)]
+                else:
+                    strip = -(-rows//workers)
+                    windows = [(0,y,cols,min(strip,rows-y)) for y in range(0,rows,strip)]
+            else:
+                windows = [(x,y,min(tile,cols-x),min(tile,rows-y)) for y in range(0,rows,tile) for x in range(0,cols,tile)]
+            halo = 1 if medianfilter else 0
+            if validation and precision != 'float64':
+                validate(fns,n,list(windows[0]),bands,significance,medianfilter,precision)
+            print( 'processing %i window(s) with executor %s ...'%(len(windows),executor) ) 
+            start1 = time.time() 
+#          threads for the change maps of each window
+            if pmap is map:
+                threads = workers
+            else:
+                threads = max(workers//len(windows),1)
+            args1 = [(fns,n,window,halo,cols,rows,bands,significance,medianfilter,precision,threads,scratch) 
+                                                                                    for window in windows]
+#          stream each finished window from its scratch file to the output files    
+            for (x,y,wcols,wrows),fn in pmap(call_omnibus,args1):
+                with np.load(fn) as results:
+                    for i,(writer,band) in enumerate(targets):
+                        writer.write(results['arr_%i'%i],x,y,band)
+                os.remove(fn)
+                if len(windows)>1:
+                    print( 'window %s done'%str([x,y,wcols,wrows]) )
+#      overviews and cloud-optimized layout            
+        for writer in set(writer for writer,_ in targets):
+            writer.close()
+    finally:
+#      also if an image cannot be read or a window fails, unfinished outputs are removed        
+        for writer in set(writer for writer,_ in targets):
+            writer.abort()
+        if pool is not None:
+            pool.shutdown()
+        if scratch is not None:
+            shutil.rmtree(scratch)
+    print( 'elapsed time for change detection: '+str(time.time()-start1) )    
+    if pack:
+        print( 'change maps (cmap, smap, fmap, bmap) written to: %s'%outfn0 )
     else:
-        print( 'Intensity images' )
-#  output file
-    path = os.path.abspath(fns[0])    
-    dirn = os.path.dirname(path)
-    outfn = dirn + '/' + outfn 
-#  create temporary, memory-mapped array of change indices p(Ri<ri)
-    mm = NamedTemporaryFile()
-    pvarray = np.memmap(mm.name,dtype=np.float64,mode='w+',shape=(k,k,rows*cols))  
-    print( 'pre-calculating Rj and p-values ...' ) 
-    start1 = time.time() 
-    try:
-        print( 'attempting parallel calculation ...' ) 
-        c = Client()
-        print( 'available engines %s'%str(c.ids) )
-        v = c[:] 
-        print( 'ell = ', end=' ' )     
-        for i in range(k-1):  
-            print( i+1, end=' ' )               
-            args1 = [(fns[i:j+2],n,cols,rows,bands) for j in range(i,k-1)]         
-            results = v.map_sync(PV,args1) # list of tuples (p-value, lnRj)
-            pvs = [result[0] for result in results] 
-            if medianfilter:
-                pvs = v.map_sync(call_median_filter,pvs)
-            lnRjs = np.array([result[1] for result in results]) 
-            lnQ = np.sum(lnRjs,axis=0)          
-            pvQ = getpvQ(lnQ,bands,k-i,n)       
-            for j in range(i,k-1):
-                pvarray[i,j,:] = pvs[j-i].ravel() 
-            pvarray[i,k-1,:] = pvQ.ravel()    
-    except Exception as e: 
-        print( '%s \nfailed, so running sequential calculation ...'%e )  
-        print( 'ell= ', end=' ')  
-        for i in range(k-1):        
-            print( i+1,end=' ')   
-            args1 = [(fns[i:j+2],n,cols,rows,bands) for j in range(i,k-1)]                         
-            results = list(map(PV,args1))  # list of tuples (p-value, lnRj)
-            pvs = [result[0] for result in results] 
-            if medianfilter:
-                pvs = list(map(call_median_filter,pvs)) 
-            lnRjs = np.array([result[1] for result in results]) 
-            lnQ = np.sum(lnRjs,axis=0)
-            pvQ = getpvQ(lnQ,bands,k-i,n)                   
-            for j in range(i,k-1):
-                pvarray[i,j,:] = pvs[j-i].ravel() 
-            pvarray[i,k-1,:] = pvQ.ravel()  
-    print( '\nelapsed time for p-value calculation: '+str(time.time()-start1) )    
-    
-    cmap,smap,fmap,bmap = change_maps(pvarray,significance)   
-#  post process bmap for Loewner direction   
-    avimg = getimg(fns[0])
-    avimglog = cmap*0+k
-    r = 1.0 
-    for i in range(k-1):
-        img = getimg(fns[i+1])
-        direct = loewner(img-avimg)
-        bmap[:,i] = np.where(bmap[:,i],direct,bmap[:,i])
-        avimglog = np.where(bmap[:,i],k-i,avimglog)
-#      provisional means        
-        r += 1.0
-        avimg = avimg + (img-avimg)/r
-        for j in range(bands): 
-#          reset avimg where change occurred
-            avimg[:,j] = np.where(bmap[:,i],img[:,j],avimg[:,j])
-#  write to file system    
-    cmap = np.reshape(cmap,(rows,cols))
-    fmap = np.reshape(fmap,(rows,cols))
-    smap = np.reshape(smap,(rows,cols))
-    bmap = np.reshape(bmap,(rows,cols,k-1))
-    atsf = np.reshape(avimg,(rows,cols,bands))
-    avimglog = np.reshape(avimglog,(rows,cols))
-    driver = inDataset1.GetDriver() 
-    basename = os.path.basename(outfn)
-    name, _ = os.path.splitext(basename)
-    outfn1=outfn.replace(name,name+'_cmap')
-    outDataset = driver.Create(outfn1,cols,rows,1,GDT_Byte)
-    geotransform = inDataset1.GetGeoTransform()
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)
-    projection = inDataset1.GetProjection()        
-    if projection is not None:
-        outDataset.SetProjection(projection)     
-    outBand = outDataset.GetRasterBand(1)
-    outBand.WriteArray(cmap,0,0) 
-    outBand.FlushCache() 
-    print( 'last change map written to: %s'%outfn1 )  
-    outfn2=outfn.replace(name,name+'_fmap')
-    outDataset = driver.Create(outfn2,cols,rows,1,GDT_Byte)
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)      
-    if projection is not None:
-        outDataset.SetProjection(projection)     
-    outBand = outDataset.GetRasterBand(1)
-    outBand.WriteArray(fmap,0,0) 
-    outBand.FlushCache() 
-    print( 'frequency map written to: %s'%outfn2 )     
-    outfn3=outfn.replace(name,name+'_bmap')
-    outDataset = driver.Create(outfn3,cols,rows,k-1,GDT_Byte)
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)       
-    if projection is not None:
-        outDataset.SetProjection(projection)  
-    for i in range(k-1):        
-        outBand = outDataset.GetRasterBand(i+1)
-        outBand.WriteArray(bmap[:,:,i],0,0) 
-        outBand.FlushCache() 
-    print( 'bitemporal map image written to: %s'%outfn3 )    
-    outfn4=outfn.replace(name,name+'_smap')
-    outDataset = driver.Create(outfn4,cols,rows,1,GDT_Byte)
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)      
-    if projection is not None:
-        outDataset.SetProjection(projection)     
-    outBand = outDataset.GetRasterBand(1)
-    outBand.WriteArray(smap,0,0) 
-    outBand.FlushCache() 
-    print( 'first change map written to: %s'%outfn4 )   
-    
-    basename = os.path.basename(lastfn)
-    name, _ = os.path.splitext(basename)
-    outfn5=lastfn.replace(name,name+'_atsflog')
-    outDataset = driver.Create(outfn5,cols,rows,1,GDT_Byte)
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)      
-    if projection is not None:
-        outDataset.SetProjection(projection)     
-    outBand = outDataset.GetRasterBand(1)
-    outBand.WriteArray(avimglog,0,0) 
-    outBand.FlushCache() 
+        print( 'last change map written to: %s'%outfn1 )  
+        print( 'frequency map written to: %s'%outfn2 ) 
+        print( 'bitemporal map image written to: %s'%outfn3 )    
+        print( 'first change map written to: %s'%outfn4 )   
     print( 'atsf log written to: %s'%outfn5 )   
-    outfn6=lastfn.replace(name,name+'_atsf')
-    outDataset = driver.Create(outfn6,cols,rows,bands,GDT_Float32)
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)      
-    if projection is not None:
-        outDataset.SetProjection(projection) 
-    for i in range(bands):    
-        outBand = outDataset.GetRasterBand(i+1)
-        outBand.WriteArray(atsf[:,:,i],0,0) 
-        outBand.FlushCache() 
     print( 'atsf written to: %s'%outfn6 )         
     print( 'total elapsed time: '+str(time.time()-start) )   
-    outDataset = None    
     inDataset1 = None        
     
 if __name__ == '__main__':
@@ -0,0 +1,61 @@
+#******************************************************************************
+#  Name:     test_hermitian.py
+#  Purpose:  check the closed-form determinants, log-determinants and the
+#            GEE determinant expressions of auxil.hermitian against
+#            numpy.linalg on random Hermitian matrices in the packed
+#            polarimetric band layouts
+#  Usage:
+#    python -m pytest tests
+#
+# MIT License
+#
+# Copyright (c) 2018 Mort Canty
+
+import numpy as np
+import pytest
+from auxil import hermitian
+
+def matrices(p,n=1000,seed=0):
+    '''n random positive definite Hermitian p x p matrices A*A^H'''
+    rng = np.random.default_rng(seed)
+    A = rng.normal(size=(n,p,p)) + 1j*rng.normal(size=(n,p,p))
+    return A @ np.conj(np.transpose(A,(0,2,1)))
+
+def pack(C):
+    '''packed band layout (bands,n) of the matrices C'''
+    if C.shape[1] == 3:
+        return np.array([C[:,0,0].real,C[:,0,1].real,C[:,0,1].imag,C[:,0,2].real,C[:,0,2].imag,
+                         C[:,1,1].real,C[:,1,2].real,C[:,1,2].imag,C[:,2,2].real])
+    return np.array([C[:,0,0].real,C[:,0,1].real,C[:,0,1].imag,C[:,1,1].real])
+
+@pytest.mark.parametrize('p',[2,3])
+def test_det(p):
+    C = matrices(p)
+    expected = np.linalg.det(C).real
+    img = pack(C)
+    np.testing.assert_allclose(hermitian.det(img),expected,rtol=1e-10)
+    np.testing.assert_allclose(hermitian.logdet(img),np.log(expected),rtol=1e-10)
+    np.testing.assert_allclose(hermitian.logdet_ldl(img),np.log(expected),rtol=1e-10)
+    np.testing.assert_allclose(hermitian.logdet_ldl(img.astype(np.float32)),np.log(expected),
+                               rtol=1e-3,atol=1e-3)
+
+@pytest.mark.parametrize('p',[2,3])
+def test_det_expr(p):
+#  the expressions passed to ee.Image.expression(), evaluated on numpy bands
+    C = matrices(p,seed=1)
+    img = pack(C)
+    result = eval(hermitian.DET_EXPR[len(img)],{'b': lambda i: img[i]})
+    np.testing.assert_allclose(result,np.linalg.det(C).real,rtol=1e-10)
+
+@pytest.mark.parametrize('p',[2,3])
+def test_loewner(p):
+    C = matrices(p,seed=2)
+    D = matrices(p,seed=3)
+    img = pack(C-D)
+    eigenvalues = np.linalg.eigvalsh(C-D)
+    expected = np.full(len(C),3)
+    expected[np.all(eigenvalues>0,axis=1)] = 1
+    expected[np.all(eigenvalues<0,axis=1)] = 2
+    np.testing.assert_array_equal(hermitian.loewner(img),expected)
+    np.testing.assert_array_equal(hermitian.loewner(pack(C)),1)
+    np.testing.assert_array_equal(hermitian.loewner(-pack(C)),2)
@@ -0,0 +1,99 @@
+#******************************************************************************
+#  Name:     test_iMad.py
+#  Purpose:  compare IR-MAD on a growing pixel subsample with IR-MAD on all
+#            pixels, and the tensorflow version iMad_tf.py with iMad.py, for
+#            a synthetic bitemporal image pair with a changed block
+#  Usage:
+#    python -m pytest tests
+#
+# MIT License
+#
+# Copyright (c) 2018 Mort Canty
+
+import os, sys
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','scripts'))
+import iMad
+
+COLS, ROWS, BANDS = 250, 300, 4
+
+def pair(path,seed=0,nodata=True):
+    '''write a bitemporal pair of correlated BANDS-band images with a
+       changed block (and no-data rows and columns), return the file names'''
+    from osgeo.gdalconst import GDT_Float32
+    rng = np.random.default_rng(seed)
+    base = rng.gamma(4.0,20.0,(ROWS,COLS,BANDS))
+    M = np.array([[1.1,0.1,0.0,0.0],[0.0,0.9,0.2,0.0],[0.0,0.0,1.2,0.0],[0.1,0.0,0.0,1.0]])
+    X1 = base + rng.normal(0,3,(ROWS,COLS,BANDS))
+    X2 = base.dot(M) + 5 + rng.normal(0,3,(ROWS,COLS,BANDS))
+    X2[100:150,50:120] += rng.normal(40,10,(50,70,BANDS))
+    if nodata:
+        X1[:5,:] = 0
+        X2[:,:3] = 0
+    fns = []
+    for name,X in (('a.tif',X1),('b.tif',X2)):
+        fn = os.path.join(str(path),name)
+        outDataset = gdal.GetDriverByName('GTiff').Create(fn,COLS,ROWS,BANDS,GDT_Float32)
+        for b in range(BANDS):
+            outDataset.GetRasterBand(b+1).WriteArray(X[:,:,b])
+        outDataset.FlushCache()
+        outDataset = None
+        fns.append(fn)
+    return fns
+
+def run(monkeypatch,capsys,script,fns,*options):
+    '''run the main() of the IR-MAD script, return the final canonical
+       correlations and the MADs and chi-square image'''
+    monkeypatch.setattr(sys,'argv',[script.__name__+'.py','-i','500']+list(options)+fns)
+    script.main()
+    out = capsys.readouterr().out
+    rho = [line for line in out.splitlines() if line.startswith(('rho: ','canonical corr: '))][-1]
+    rho = np.array(rho.split(':')[1].strip()[1:-1].split(),dtype=float)
+    inDataset = gdal.Open(os.path.join(os.path.dirname(fns[0]),'MAD_a-b.tif'))
+    result = np.array([inDataset.GetRasterBand(k+1).ReadAsArray()
+                       for k in range(inDataset.RasterCount)])
+    inDataset = None
+    return rho, result
+
+def test_subsample_equals_full(tmp_path,monkeypatch,capsys):
+#  iterated to a tight tolerance, subsampled and full IR-MAD reach the same
+#  fixed point: canonical correlations to 1e-5, MADs and chi-square to 1e-2
+#  of their largest value (the MADs of nearly equal correlations are the
+#  least well determined)
+    monkeypatch.setattr(iMad,'TOL',1e-7)
+    fns = pair(tmp_path)
+    rho, full = run(monkeypatch,capsys,iMad,fns,'-n')
+    rhosample, subsample = run(monkeypatch,capsys,iMad,fns,'-n','-f','0.05')
+    np.testing.assert_allclose(rhosample,rho,atol=1e-5)
+    for k in range(BANDS+1):
+        np.testing.assert_allclose(subsample[k],full[k],atol=1e-2*np.max(np.abs(full[k])))
+
+def test_tensorflow_equals_numpy(tmp_path,monkeypatch,capsys):
+#  same tolerances as above, the sign of each MAD is arbitrary
+    pytest.importorskip('tensorflow')
+    pytest.importorskip('tensorflow_probability')
+    import iMad_tf
+    monkeypatch.setattr(iMad,'TOL',1e-7)
+    fns = pair(tmp_path,nodata=False)
+    rho, expected = run(monkeypatch,capsys,iMad,fns,'-n')
+    rhotf, result = run(monkeypatch,capsys,iMad_tf,fns,'-t','1e-7','-b','64')
+    np.testing.assert_allclose(rhotf,rho,atol=1e-5)
+    for k in range(BANDS+1):
+        sign = np.sign(np.sum(result[k]*expected[k]))
+        np.testing.assert_allclose(sign*result[k],expected[k],atol=1e-2*np.max(np.abs(expected[k])))
+
+def test_tensorflow_subsample_niter(tmp_path,monkeypatch,capsys):
+#  the iteration limit reached while the sample grows to all pixels
+    pytest.importorskip('tensorflow')
+    pytest.importorskip('tensorflow_probability')
+    import iMad_tf
+    fns = pair(tmp_path,nodata=False)
+    monkeypatch.setattr(sys,'argv',['iMad_tf.py','-i','1','-f','0.25']+fns)
+    iMad_tf.main()
+    out = capsys.readouterr().out
+    assert 'iterations: 2' in out
+    assert 'rho (last subsample)' in out
@@ -0,0 +1,76 @@
+#******************************************************************************
+#  Name:     test_sar_seqQ.py
+#  Purpose:  compare the streaming mode of sar_seqQ.py with the batch
+#            omnibus algorithm on a synthetic diagonal-only polarimetric
+#            image sequence with changes
+#  Usage:
+#    python -m pytest tests
+#
+# MIT License
+#
+# Copyright (c) 2018 Mort Canty
+
+import os, sys
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','scripts'))
+import sar_seqQ
+
+ENL = 5.0
+COLS, ROWS, BANDS = 50, 40, 3
+
+def sequence(path,k=6,seed=0):
+    '''write k co-registered 3-band images of gamma distributed intensities,
+       the mean changes in a block at image 2 and back at image 4 and in a
+       second block at image 3, return the file names'''
+    from osgeo.gdalconst import GDT_Float32
+    rng = np.random.default_rng(seed)
+    means = np.ones((BANDS,ROWS,COLS))*np.array([1.0,0.2,0.5])[:,None,None]
+    fns = []
+    for t in range(k):
+        m = means.copy()
+        if 2 <= t < 4:
+            m[:,5:20,5:20] *= 4.0
+        if t >= 3:
+            m[:,25:35,30:45] *= 0.2
+        fn = os.path.join(str(path),'img_%i.tif'%t)
+        outDataset = gdal.GetDriverByName('GTiff').Create(fn,COLS,ROWS,BANDS,GDT_Float32)
+        for b in range(BANDS):
+            outDataset.GetRasterBand(b+1).WriteArray(rng.gamma(ENL,m[b]/ENL))
+        outDataset.FlushCache()
+        outDataset = None
+        fns.append(fn)
+    return fns
+
+@pytest.mark.parametrize('medianfilter',[False,True])
+@pytest.mark.parametrize('significance',[0.01,0.0001])
+def test_stream_equals_batch(tmp_path,medianfilter,significance):
+    fns = sequence(tmp_path)
+    batch = sar_seqQ.omnibus(fns,ENL,[0,0,COLS,ROWS],BANDS,significance,medianfilter)
+    statedir = str(tmp_path/'state')
+    for fn in fns:
+        sar_seqQ.append(statedir,fn,ENL,significance,medianfilter)
+    names, stream = sar_seqQ.stream_results(statedir)
+    assert names == fns
+    assert np.any(batch[0] > 0)
+    for result, expected in zip(stream,batch):
+        np.testing.assert_array_equal(result,np.reshape(expected,result.shape))
+
+def test_append_rejects_other_shape(tmp_path):
+    from osgeo.gdalconst import GDT_Float32
+    fns = sequence(tmp_path,k=2)
+    statedir = str(tmp_path/'state')
+    for fn in fns:
+        sar_seqQ.append(statedir,fn,ENL,0.01)
+    fn = os.path.join(str(tmp_path),'small.tif')
+    outDataset = gdal.GetDriverByName('GTiff').Create(fn,COLS-1,ROWS,BANDS,GDT_Float32)
+    for b in range(BANDS):
+        outDataset.GetRasterBand(b+1).WriteArray(np.ones((ROWS,COLS-1)))
+    outDataset = None
+    with pytest.raises(ValueError):
+        sar_seqQ.append(statedir,fn,ENL,0.01)
+    names, _ = sar_seqQ.stream_results(statedir)
+    assert names == fns